@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of CbioCSVWriter filters: vectorized filter engine vs. the per-element evaluation it replaced.
+
+    python -m benchmarks.filters --rows 1000000
+"""
+import re
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from cbio_importer.study_templates._utilities import CbioCSVWriter
+
+FILTERS = [
+    {"source_id": "measurement", "regex": "[xyz]"},
+    {"source_id": "score", "operator": {"command": ">=", "arg": 20}},
+    {"source_id": "status", "one_of": ["alive", "deceased"]},
+]
+
+
+def generate(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    score = rng.integers(0, 100, rows).astype(float)
+    score[rng.random(rows) < 0.05] = np.nan
+    measurement = rng.choice(np.array(["x", "y", "z", "a", "b"], dtype=object), rows)
+    measurement[rng.random(rows) < 0.05] = np.nan
+    return pd.DataFrame({
+        "measurement": measurement,
+        "score": score,
+        "status": rng.choice(["alive", "deceased", "unknown"], rows),
+    })
+
+
+def per_element(data):
+    """
+    The previous implementation: a Python call per element and a new DataFrame per filter
+    """
+    rule = FILTERS[0]["regex"]
+    data = data.loc[data["measurement"].apply(lambda x: bool(re.search(rule, x) if isinstance(x, str) else None))]
+    arg = FILTERS[1]["operator"]["arg"]
+    data = data.loc[data["score"].apply(lambda y: y >= arg)]
+    return data.loc[data["status"].isin(FILTERS[2]["one_of"])]
+
+
+def vectorized(data):
+    writer = CbioCSVWriter()
+    writer.input = data
+    writer.config = {"filter": FILTERS}
+    writer._filter_input()
+    return writer.input
+
+
+def measure(fn, data, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(data)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Filter engine micro-benchmark.")
+    parser.add_argument('--rows', type=int, default=1000000, help='Number of generated rows')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of N runs')
+    args = parser.parse_args()
+
+    data = generate(args.rows)
+    old_time, old_result = measure(per_element, data, args.repeat)
+    new_time, new_result = measure(vectorized, data, args.repeat)
+    assert old_result.index.equals(new_result.index), "Filter results differ!"
+    print(f"rows: {args.rows}, selected: {len(new_result)}")
+    print(f"per-element: {old_time:.3f}s")
+    print(f"vectorized:  {new_time:.3f}s ({old_time / new_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""
+Startup benchmark of the CLI: each scenario runs in fresh processes, the median wall time and the modules
+it loaded are reported. Fails (exit code 1) if a scenario loads modules it must not (e.g. pandas for --help
+or a study with cancer types only), exceeds --max-ms over the bare interpreter startup, or is slower than
+the compared results by more than --tolerance.
+
+    python -m benchmarks.startup --output startup.json
+    python -m benchmarks.startup --compare startup.json --max-ms 200
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+# Runs the CLI as python -m cbio_importer does, then records which of the given modules it loaded
+DRIVER = """
+import sys, json, runpy
+report, modules = sys.argv[1], sys.argv[2].split(",")
+sys.argv = ["cbio_importer"] + sys.argv[3:]
+try:
+    runpy.run_module("cbio_importer", run_name="__main__", alter_sys=True)
+except SystemExit:
+    pass
+finally:
+    with open(report, "w") as file:
+        json.dump(sorted(name for name in modules if name in sys.modules), file)
+"""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY = ["pandas", "numpy", "yaml", "pyarrow", "duckdb", "multiprocessing", "cbio_importer.study_templates",
+         "cbio_importer.study_templates._utilities"]
+
+CANCER_TYPES_STUDY = """
+study_id: startup
+cancer_type: brca
+study_name: Startup
+study_description: Study with cancer types only
+output_folder: output
+cancer_types:
+  brca:
+    name: Breast Cancer
+    ui_color: pink
+"""
+
+
+def scenarios(folder):
+    """
+    :return: {name: (CLI arguments, modules the scenario must not load)}
+    """
+    study = os.path.join(folder, "study.yaml")
+    with open(study, 'w') as file:
+        file.write(CANCER_TYPES_STUDY)
+    return {
+        "help": (["--help"], HEAVY),
+        "invalid_arguments": (["--jobs", "many"], HEAVY),
+        "cancer_types": (["--output_path_prefix", f"{folder}/", "--meta_helper_files_directory",
+                          os.path.join(folder, ".csv2cbio"), "--functions", os.path.join(folder, "none.py"), study],
+                         ["pandas", "numpy", "pyarrow", "duckdb", "multiprocessing",
+                          "cbio_importer.study_templates._utilities"]),
+    }
+
+
+def run_once(arguments, folder):
+    """
+    :return: (wall time in seconds, loaded HEAVY modules)
+    """
+    report = os.path.join(folder, "modules.json")
+    command = [sys.executable, "-c", DRIVER, report, ",".join(HEAVY)] + arguments
+    start = time.perf_counter()
+    subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   cwd=folder, env={**os.environ, "PYTHONPATH": ROOT})
+    elapsed = time.perf_counter() - start
+    with open(report) as file:
+        return elapsed, json.load(file)
+
+
+def interpreter(repeat):
+    """
+    Median wall time of a bare interpreter startup, subtracted from the scenario times
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"])
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "platform": platform.platform()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CLI startup benchmark.")
+    parser.add_argument('--repeat', type=int, default=7, help='Runs per scenario, the median is reported')
+    parser.add_argument('--max-ms', type=float, default=None,
+                        help='Fail if a scenario takes longer than this over the interpreter startup')
+    parser.add_argument('--output', type=str, default=None, help='Save results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='Previous JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='With --compare, fail if a scenario is slower by more than this ratio')
+    args = parser.parse_args()
+
+    base = interpreter(args.repeat)
+    print(f"{'interpreter':18} {base * 1000:8.1f} ms")
+    folder = tempfile.mkdtemp(prefix="cbio_startup_")
+    results = {}
+    try:
+        for name, (arguments, forbidden) in scenarios(folder).items():
+            runs = [run_once(arguments, folder) for _ in range(args.repeat)]
+            median = statistics.median(elapsed for elapsed, _ in runs)
+            modules = runs[-1][1]
+            results[name] = {"median": median, "overhead": median - base, "modules": modules,
+                             "unexpected": [module for module in modules if module in forbidden]}
+            print(f"{name:18} {median * 1000:8.1f} ms (+{(median - base) * 1000:.1f} ms), loaded: {modules}")
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    failures = [f"{name} loads {', '.join(result['unexpected'])}" for name, result in results.items()
+                if result["unexpected"]]
+    if args.max_ms is not None:
+        failures += [f"{name} takes {result['overhead'] * 1000:.1f} ms over the interpreter (max {args.max_ms} ms)"
+                     for name, result in results.items() if result["overhead"] * 1000 > args.max_ms]
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)["scenarios"]
+        for name, result in results.items():
+            old = previous.get(name)
+            if old is None or old["overhead"] <= 0:
+                continue
+            ratio = result["overhead"] / old["overhead"]
+            print(f"{name:18} {old['overhead'] * 1000:8.1f} ms -> {result['overhead'] * 1000:8.1f} ms {ratio:.2f}x")
+            if ratio > args.tolerance:
+                failures.append(f"{name} is {ratio:.2f}x slower than in {args.compare}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"environment": environment(), "interpreter": base, "scenarios": results}, file, indent=2)
+        print(f"Results saved to {args.output}")
+    if failures:
+        print("FAILED:\n  " + "\n  ".join(failures), file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
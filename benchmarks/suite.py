@@ -0,0 +1,167 @@
+"""
+Throughput benchmark: generates a synthetic study (see benchmarks.synthetic) and times study_templates.process
+end to end and per CbioCSVWriter stage. Each run uses a fresh process and helper files directory.
+Results are saved as JSON, a previous result can be compared with the current one.
+
+    python -m benchmarks.suite --patients 100000 --output results.json
+    python -m benchmarks.suite --patients 100000 --output new.json --compare results.json
+
+Stage times are inclusive and summed over all entities: write_data of streamed sources (--chunk-size)
+contains preprocessing of the chunks. With --jobs > 1 entities are generated in worker processes,
+only the end to end time is measured.
+"""
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import functools
+import contextlib
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from benchmarks import synthetic
+
+STAGES = ["with_input", "_read_input", "_filter_input", "_join_input", "_group_input", "_create_columns",
+          "write_data"]
+
+
+def instrument(cls, stages, timings):
+    """
+    Wraps the class methods to sum up their wall time and number of calls into timings
+    """
+    def timed(name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                timing = timings.setdefault(name, {"time": 0.0, "calls": 0})
+                timing["time"] += time.perf_counter() - start
+                timing["calls"] += 1
+        return wrapper
+
+    for name in stages:
+        setattr(cls, name, timed(name, getattr(cls, name)))
+
+
+def run_once(folder, jobs=1, chunk_size=None):
+    """
+    Generates the study in the folder once (in a fresh process)
+    :return: {"total": seconds, "stages": {stage: {"time": seconds, "calls": count}}}
+    """
+    from cbio_importer.study_templates._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue
+    target = tempfile.mkdtemp(prefix="cbio_benchmark_")
+    try:
+        SeedValue(10)
+        FunctionDefinitionFile(os.path.join(folder, "functions.py"))
+        TemporaryFilesDirectory(os.path.join(target, ".csv2cbio"))
+        os.makedirs(os.path.join(target, ".csv2cbio"))
+        os.makedirs(os.path.join(target, "output"))
+
+        from cbio_importer.study_templates import process
+        from cbio_importer.study_templates._utilities import CbioCSVWriter
+        timings = {}
+        instrument(CbioCSVWriter, STAGES, timings)
+        with open(os.path.join(folder, "study.yaml")) as file:
+            study = yaml.safe_load(file)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            process(target_folder=os.path.join(target, "output"), study_yaml=study, source_prefix=f"{folder}/",
+                    chunk_size=chunk_size, jobs=jobs, force=True)
+        return {"total": time.perf_counter() - start, "stages": timings}
+    finally:
+        shutil.rmtree(target, ignore_errors=True)
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "python": platform.python_version(), "pandas": pd.__version__,
+            "numpy": np.__version__, "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def summarize(runs):
+    """
+    Best (minimum) time of the runs, end to end and per stage
+    """
+    stages = {name: min(run["stages"].get(name, {"time": 0.0})["time"] for run in runs)
+              for name in STAGES if any(name in run["stages"] for run in runs)}
+    return {"total": min(run["total"] for run in runs), "stages": stages}
+
+
+def compare(previous, current):
+    print(f"{'':16} {'previous':>10} {'current':>10} {'ratio':>7}")
+    rows = [("total", previous["best"]["total"], current["best"]["total"])]
+    rows += [(name, previous["best"]["stages"].get(name), current["best"]["stages"].get(name)) for name in STAGES]
+    for name, old, new in rows:
+        if old is None or new is None:
+            continue
+        ratio = f"{new / old:.2f}x" if old > 0 else "-"
+        print(f"{name:16} {old:10.3f} {new:10.3f} {ratio:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end and per-stage throughput benchmark.")
+    synthetic.add_arguments(parser)
+    parser.add_argument('--data', type=str, default=None, help='Generate the study into (or reuse) this folder')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+    parser.add_argument('--jobs', type=int, default=1, help='Entities generated in parallel (see --jobs of the CLI)')
+    parser.add_argument('--chunk-size', type=int, default=None, help='Stream sources in chunks of this many rows')
+    parser.add_argument('--output', type=str, default=None, help='Save results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='Previous JSON results to compare with')
+    args = parser.parse_args()
+
+    parameters = {"patients": args.patients, "samples_per_patient": args.samples_per_patient,
+                  "resources": args.resources, "fanout": args.fanout, "timeline": args.timeline, "seed": args.seed,
+                  "jobs": args.jobs, "chunk_size": args.chunk_size}
+    folder = args.data or tempfile.mkdtemp(prefix="cbio_synthetic_")
+    try:
+        if not os.path.isfile(os.path.join(folder, "study.yaml")):
+            synthetic.generate(folder, args.patients, args.samples_per_patient, args.resources, args.fanout,
+                               args.timeline, args.seed)
+        folder = os.path.abspath(folder)
+
+        runs = []
+        context = multiprocessing.get_context("spawn")
+        for index in range(args.repeat):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                run = executor.submit(run_once, folder, args.jobs, args.chunk_size).result()
+            print(f"run {index + 1}/{args.repeat}: {run['total']:.3f}s")
+            runs.append(run)
+    finally:
+        if args.data is None:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    result = {"parameters": parameters, "environment": environment(), "runs": runs, "best": summarize(runs)}
+    print(f"best: {result['best']['total']:.3f}s")
+    for name, seconds in result["best"]["stages"].items():
+        print(f"  {name:16} {seconds:.3f}s")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+        print(f"Results saved to {args.output}")
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        if previous.get("parameters") != parameters:
+            print(f"WARN: compared results use different parameters: {previous.get('parameters')}", file=sys.stderr)
+        compare(previous, result)
+
+
+if __name__ == "__main__":
+    main()
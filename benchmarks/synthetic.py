@@ -0,0 +1,191 @@
+"""
+Synthetic study generator: source CSVs, the study YAML and functions.py scaled by the number of patients,
+samples per patient, resources, join fan-out and timeline length.
+
+    python -m benchmarks.synthetic /tmp/study --patients 100000 --samples-per-patient 3
+    python -m cbio_importer --csv_path_prefix=/tmp/study --functions=/tmp/study/functions.py /tmp/study/study.yaml
+"""
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import yaml
+
+FUNCTIONS = '''import pandas as pd
+
+from cbio_importer.study_templates.default_functions import pure
+
+
+@pure
+def age_band(value, width: int = 10):
+    if pd.isna(value):
+        return None
+    low = int(value) // width * width
+    return f"{low}-{low + width - 1}"
+
+
+def join_values(values: pd.Series, delimiter: str = ";"):
+    return delimiter.join(str(value) for value in values if not pd.isna(value))
+
+
+def score_level(row: pd.Series):
+    if pd.isna(row["score"]):
+        return "unknown"
+    return "high" if row["score"] >= 50 and row["measurement"] != "a" else "low"
+'''
+
+
+def generate_sources(folder, patients=1000, samples_per_patient=3, fanout=2, timeline_length=5, seed=0):
+    """
+    Writes samples.csv (one row per sample), sample_attributes.csv (fanout rows per sample)
+    and timeline.csv (timeline_length events per patient) into the folder
+    """
+    rng = np.random.default_rng(seed)
+    rows = patients * samples_per_patient
+    patient_ids = np.array([f"PAT{index:08d}" for index in range(patients)], dtype=object)
+    patient = np.repeat(patient_ids, samples_per_patient)
+    sample = np.array([f"SMP{index:09d}" for index in range(rows)], dtype=object)
+
+    score = rng.integers(0, 100, rows).astype(float)
+    score[rng.random(rows) < 0.05] = np.nan
+    pd.DataFrame({
+        "patient": patient,
+        "sample": sample,
+        "measurement": rng.choice(np.array(["x", "y", "z", "a"], dtype=object), rows),
+        "score": score,
+        "vital_status": np.repeat(rng.choice(["alive", "deceased"], patients), samples_per_patient),
+        "age": np.repeat(rng.integers(18, 95, patients), samples_per_patient),
+        "slide": [f"/data/slides/{value}.mrxs" for value in sample],
+    }).to_csv(os.path.join(folder, "samples.csv"), sep="\t", index=False)
+
+    pd.DataFrame({
+        "sample_id": np.repeat(sample, fanout),
+        "attribute": rng.choice(np.array(["ER+", "PR+", "HER2+", "KI67"], dtype=object), rows * fanout),
+    }).to_csv(os.path.join(folder, "sample_attributes.csv"), sep="\t", index=False)
+
+    events = patients * timeline_length
+    start = rng.integers(0, 3650, events)
+    pd.DataFrame({
+        "patient": np.repeat(patient_ids, timeline_length),
+        "start": start,
+        "stop": start + rng.integers(1, 365, events),
+        "treatment": rng.choice(np.array(["Chemotherapy", "Radiotherapy", "Surgery"], dtype=object), events),
+    }).to_csv(os.path.join(folder, "timeline.csv"), sep="\t", index=False)
+
+
+def column(key, source_id=None, data_type="STRING", **spec):
+    item = {"id": key, "name": key.replace("_", " ").title(), "description": key, "data_type": data_type, **spec}
+    if source_id is not None:
+        item["source_id"] = source_id
+    return item
+
+
+def study_definition(resources=1):
+    """
+    Study YAML using filters, a fan-out join, group aggregations, 'create' and column functions
+    """
+    study = {
+        "output_folder": "output",
+        "study_id": "synthetic_benchmark_study",
+        "cancer_type": "synthetic",
+        "study_name": "Synthetic Benchmark Study",
+        "study_description": "Generated by benchmarks.synthetic",
+        "cancer_types": {"synthetic": {"name": "Synthetic Cancer", "ui_color": "lightcoral"}},
+        "patients": {
+            "file": "samples.csv",
+            "filter": [{"source_id": "measurement", "regex": "[xyza]"}],
+            "group": {"by": ["patient"], "aggregate": [
+                {"id": "age_first", "source_id": "age", "function": {"name": "select_first"}},
+                {"id": "vital_first", "source_id": "vital_status", "function": {"name": "select_first"}},
+            ]},
+            "columns": [
+                column("PATIENT_ID", "patient"),
+                column("AGE", "age_first", "NUMBER"),
+                column("AGE_BAND", "age_first", function={"name": "age_band", "width": 10}),
+                column("OS_STATUS", "vital_first", function={"name": "os_status_alive_deceased"}),
+            ],
+        },
+        "samples": {
+            "file": "samples.csv",
+            "filter": [{"source_id": "score", "operator": {"command": ">=", "arg": 0}}],
+            "join": [{"file": "sample_attributes.csv", "how": "left", "left_on": "sample", "right_on": "sample_id"}],
+            "group": {"by": ["patient", "sample"], "aggregate": [
+                {"id": "attributes", "source_id": "attribute", "function": {"name": "join_values"}},
+                {"id": "score", "source_id": "score", "function": {"name": "select_first"}},
+                {"id": "measurement", "source_id": "measurement", "function": {"name": "select_first"}},
+            ]},
+            "create": [{"new_column": "level", "source_ids": ["score", "measurement"],
+                        "function": {"name": "score_level"}}],
+            "columns": [
+                column("PATIENT_ID", "patient"),
+                column("SAMPLE_ID", "sample"),
+                column("SCORE", "score", "NUMBER", convert="int"),
+                column("LEVEL", "level"),
+                column("ATTRIBUTES", "attributes"),
+            ],
+        },
+        "treatments": {
+            "file": "timeline.csv",
+            "series": {"id": "TREATMENT"},
+            "columns": [
+                column("PATIENT_ID", "patient"),
+                column("START_DATE", "start", "NUMBER"),
+                column("STOP_DATE", "stop", "NUMBER"),
+                column("EVENT_TYPE", value="TREATMENT"),
+                column("TREATMENT_TYPE", "treatment"),
+            ],
+        },
+    }
+    for index in range(resources):
+        study[f"slides_{index}"] = {
+            "file": "samples.csv",
+            "resource": {"id": f"SLIDES_{index}", "name": f"Slides {index}", "resource_type": "PATIENT"},
+            "group": {"by": ["patient"], "aggregate": [
+                {"id": "slides", "source_id": "slide", "function": {"name": "concat_paths", "prefix_remove": "/data"}},
+            ]},
+            "columns": [
+                column("PATIENT_ID", "patient"),
+                column("RESOURCE_ID", value=f"SLIDES_{index}"),
+                column("URL", "slides", function={"name": "template_string", "string": "https://wsi.example/?slides={value}"}),
+            ],
+        }
+    return study
+
+
+def generate(folder, patients=1000, samples_per_patient=3, resources=1, fanout=2, timeline_length=5, seed=0):
+    """
+    Writes the source files, study.yaml and functions.py of a synthetic study into the folder
+    :return: path to study.yaml
+    """
+    os.makedirs(folder, exist_ok=True)
+    generate_sources(folder, patients, samples_per_patient, fanout, timeline_length, seed)
+    with open(os.path.join(folder, "functions.py"), 'w') as file:
+        file.write(FUNCTIONS)
+    study_file = os.path.join(folder, "study.yaml")
+    with open(study_file, 'w') as file:
+        yaml.safe_dump(study_definition(resources), file, sort_keys=False)
+    return study_file
+
+
+def add_arguments(parser):
+    parser.add_argument('--patients', type=int, default=1000, help='Number of patients')
+    parser.add_argument('--samples-per-patient', type=int, default=3, help='Samples (source rows) per patient')
+    parser.add_argument('--resources', type=int, default=1, help='Number of resource entities')
+    parser.add_argument('--fanout', type=int, default=2, help='Joined rows per sample')
+    parser.add_argument('--timeline', type=int, default=5, help='Timeline events per patient')
+    parser.add_argument('--seed', type=int, default=0, help='Random generator seed')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic study generator.")
+    parser.add_argument('folder', type=str, help='Target folder')
+    add_arguments(parser)
+    args = parser.parse_args()
+    study_file = generate(args.folder, args.patients, args.samples_per_patient, args.resources, args.fanout,
+                          args.timeline, args.seed)
+    print(f"Study written to {study_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,8 @@
 import os
 import argparse
-import subprocess
 import sys
 import json
 import pathlib
-import random
-
-import yaml
-
-from cbio_importer.study_templates._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue
 
 
 def process_input(input_string):
@@ -36,15 +30,65 @@ def main():
                         default=os.environ.get('CBIO_OUTPUT_META_FILES_PREFIX', default=""))
     parser.add_argument('-s', '--seed', type=int, nargs="?", help='Seed value for (pseudo) random number generation',
                         default=os.environ.get('CBIO_SEED_VALUE', default=10))
+    parser.add_argument('--chunk_size', type=int, nargs="?", help='Stream source files in chunks of this many rows',
+                        default=os.environ.get('CBIO_CHUNK_SIZE', default=None))
+    parser.add_argument('-j', '--jobs', type=int, nargs="?", help='Number of entities to generate in parallel',
+                        default=os.environ.get('CBIO_JOBS', default=1))
     parser.add_argument('--clean-state', action='store_true', help="Erase all temporary files before processing")
+    parser.add_argument('--force', action='store_true', help="Generate all entities, even if their inputs did not change")
+    parser.add_argument('--profile', action='store_true',
+                        help="Measure time, rows and memory of entities and their rules, save a JSON report next to the output folder (implies --force)")
+    parser.add_argument('--cprofile', action='store_true', help="With --profile, dump cProfile statistics of the slowest entity")
     parser.add_argument('-v', '--verbose', action='store_true', help="Enable verbose output")
+    parser.add_argument('--batch', type=str, nargs="+", metavar="PATH",
+                        help="Generate all studies of these definition files and directories sharing worker processes "
+                             "and parsed sources, print a summary")
+    parser.add_argument('--watch', action='store_true',
+                        help="Keep running and generate entities again when the study file, functions or sources change")
+    parser.add_argument('--serve', action='store_true',
+                        help="Keep running and generate studies posted over HTTP, with warm caches (see --socket, --port). "
+                             "Posted studies run arbitrary functions, requests need the token of the server")
+    parser.add_argument('--port', type=int, nargs="?", help='With --serve, localhost port to listen on instead of the socket',
+                        default=os.environ.get('CBIO_SERVE_PORT', default=None))
+    parser.add_argument('--socket', type=str, nargs="?",
+                        help='With --serve, Unix socket to listen on (default serve.sock in the helper files directory)',
+                        default=os.environ.get('CBIO_SERVE_SOCKET', default=None))
     
     args = parser.parse_args()
+    # The study templates package is loaded only once the arguments are valid: --help and argument errors stay fast
+    from cbio_importer.study_templates._singletons import FunctionDefinitionFile, SeedValue
     verbose_env = os.environ.get('CBIO_VERBOSE', default=None)
     is_verbose = args.verbose or (verbose_env and verbose_env != "False" and verbose_env != "false")
     
     SeedValue(args.seed)
 
+    FunctionDefinitionFile(args.functions)
+    prefix, out_prefix = _path_prefixes(args)
+
+    def run(study_meta, force):
+        # long-running modes keep parsed sources between runs
+        return generate(study_meta, args, prefix, out_prefix, force=force, verbose=is_verbose, keep_sources=True)
+
+    if args.batch:
+        from ._batch import batch
+        prepare_meta_folder(args, prefix)
+        batch(args.batch, load_study, lambda study_meta: target_folder_of(study_meta, out_prefix), source_prefix=prefix,
+              chunk_size=int(args.chunk_size) if args.chunk_size else None, jobs=int(args.jobs), force=args.force)
+        return
+
+    if args.serve:
+        from ._server import serve
+        from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
+        prepare_meta_folder(args, prefix)
+        _stop_on_sigterm()
+        helper_files = TemporaryFilesDirectory(None).path
+        serve(load_study, lambda study_meta, force: run(study_meta, force or args.force),
+              token_file=os.path.join(helper_files, "serve.token"),
+              port=int(args.port) if args.port is not None else None,
+              socket_path=args.socket or os.path.join(helper_files, "serve.sock"),
+              token=os.environ.get('CBIO_SERVE_TOKEN', default=None))
+        return
+
     input_string = None
     if not sys.stdin.isatty():
         input_string = sys.stdin.read().strip()
@@ -53,6 +97,35 @@ def main():
     else:
         parser.error("No input provided. Either provide a filename, file content, or use stdin (directly or via CBIO_STUDY_DEFINITION variable).")
 
+    if args.watch:
+        if not os.path.isfile(input_string):
+            parser.error("--watch needs the path of the study definition file.")
+        from ._watch import watch
+        prepare_meta_folder(args, prefix)
+        _stop_on_sigterm()
+        try:
+            watch(input_string, load_study, run, lambda study_meta: watched_files(study_meta, args, prefix),
+                  force=args.force)
+        except KeyboardInterrupt:
+            print("Stopped.")
+        return
+
+    try:
+        study_meta = load_study(input_string)
+    except ValueError as e:
+        parser.error(str(e))
+
+    prepare_meta_folder(args, prefix)
+    generate(study_meta, args, prefix, out_prefix, force=args.force, verbose=is_verbose)
+
+
+def load_study(input_string):
+    """
+    Parses a study definition: a file path or JSON / YAML content (see process_input)
+    :return: dict
+    """
+    import yaml
+
     study_meta = {}
     try:
         try:
@@ -60,13 +133,32 @@ def main():
         except Exception as e:
             study_meta = yaml.safe_load(process_input(input_string))
     except Exception as e:
-        parser.error(f"Failed to load '{study_meta}' file! Is input {input_string} a valid JSON / YAML? Error {e}")
+        raise ValueError(f"Failed to load '{study_meta}' file! Is input {input_string} a valid JSON / YAML? Error {e}")
 
     if not isinstance(study_meta, dict):
-        parser.error(f"Failed to load data! Is input {input_string} a valid JSON / YAML? Got: {study_meta}")
+        raise ValueError(f"Failed to load data! Is input {input_string} a valid JSON / YAML? Got: {study_meta}")
+    return study_meta
 
-    FunctionDefinitionFile(args.functions)
 
+def watched_files(study_meta, args, prefix):
+    """
+    Files the study reads besides its definition: the functions file and source / joined files
+    """
+    from cbio_importer.study_templates._config import collect_source_files
+    return [args.functions] + [f"{prefix}{file}" for file in dict.fromkeys(collect_source_files(study_meta))]
+
+
+def _stop_on_sigterm():
+    # Long-running modes are stopped by service managers with SIGTERM: stop as on Ctrl+C, pending anonymization
+    # mappings are flushed at exit
+    import signal
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, interrupt)
+
+
+def _path_prefixes(args):
     prefix = args.csv_path_prefix
     if isinstance(prefix, str) and prefix:
         if not prefix.endswith("/"):
@@ -80,9 +172,15 @@ def main():
             out_prefix = f"{prefix}/"
     else:
         out_prefix = ""
-    target_folder = f"{out_prefix}{study_meta['output_folder'] or '.tmp/'}"
-    os.makedirs(target_folder, exist_ok=True)
-    
+    return prefix, out_prefix
+
+
+def prepare_meta_folder(args, prefix):
+    """
+    Sets up the folder of temporary & helper files (TemporaryFilesDirectory), cleans it with --clean-state
+    """
+    from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
+
     meta_folder = args.meta_helper_files_directory
     if not meta_folder:
         meta_folder = pathlib.Path(prefix) / pathlib.Path(".csv2cbio")
@@ -110,6 +208,23 @@ def main():
             os.makedirs(meta_folder_abspath)  # Create the directory if it doesn't exist
         except Exception as e:
             print(f"Failed to create directory {meta_folder}. {e}")
+
+
+def target_folder_of(study_meta, out_prefix):
+    """
+    Output folder of the study (created)
+    """
+    target_folder = f"{out_prefix}{study_meta['output_folder'] or '.tmp/'}"
+    os.makedirs(target_folder, exist_ok=True)
+    return target_folder
+
+
+def generate(study_meta, args, prefix, out_prefix, force=False, verbose=False, keep_sources=False):
+    """
+    Generates the study into its output folder (see study_templates.process)
+    :return: (target folder, per entity timings)
+    """
+    target_folder = target_folder_of(study_meta, out_prefix)
     
     # Newline before processing begins
     print()
@@ -117,9 +232,13 @@ def main():
     # Processing beings
     from .study_templates import process
     print(f"Processing data using data path {prefix}, output to {target_folder}")
-    if is_verbose:
+    if verbose:
+        import yaml
         yaml.dump(study_meta, sys.stdout)
-    process(target_folder=target_folder, study_yaml=study_meta, source_prefix=prefix)
+    timings = process(target_folder=target_folder, study_yaml=study_meta, source_prefix=prefix,
+                      chunk_size=int(args.chunk_size) if args.chunk_size else None, jobs=int(args.jobs),
+                      force=force, profile=args.profile, cprofile=args.cprofile, keep_sources=keep_sources)
+    return target_folder, timings
 
 
 if __name__ == "__main__":
@@ -0,0 +1,78 @@
+"""
+Batch mode (--batch): generates all studies of the given definition files and directories (*.yaml, *.yml, *.json)
+in one run, sharing worker processes and parsed source files (see study_templates.process_batch), then prints
+a summary table of timings and failures.
+"""
+import os
+import time
+
+STUDY_EXTENSIONS = (".yaml", ".yml", ".json")
+
+
+def study_files(paths):
+    """
+    :param paths: study definition files and directories containing them (not recursively)
+    :return: file paths, files of a directory sorted by name
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if name.endswith(STUDY_EXTENSIONS) and os.path.isfile(os.path.join(path, name)))
+        else:
+            files.append(path)
+    return files
+
+
+def _summary_table(rows):
+    header = ["Study file", "Study", "Status", "Generated", "Unchanged", "Failed", "Time"]
+    lines = [header] + [[
+        row["file"], str(row["study"]), row["status"],
+        *(str(sum(1 for item in row["entities"] if item["status"] == status))
+          for status in ("generated", "unchanged", "failed")),
+        f"{row['time']:.3f}s"
+    ] for row in rows]
+    widths = [max(len(line[column]) for line in lines) for column in range(len(header))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in lines)
+
+
+def batch(paths, load, target_folder, **options):
+    """
+    Generates the studies, prints the summary table
+    :param paths: study definition files and directories (see study_files)
+    :param load: study definition path -> study dict, raises ValueError for invalid definitions
+    :param target_folder: study dict -> output folder of the study
+    :param options: arguments of study_templates.process_batch (source_prefix, chunk_size, jobs, force)
+    :return: summary rows (see study_templates.process_batch), with the study file
+    """
+    from .study_templates import process_batch
+
+    start = time.perf_counter()
+    files = study_files(paths)
+    if not files:
+        raise ValueError(f"No study definitions ({', '.join(STUDY_EXTENSIONS)}) found in {', '.join(paths)}!")
+    rows = []
+    studies = []
+    for file in files:
+        try:
+            study_meta = load(file)
+            folder = target_folder(study_meta)
+        except (ValueError, KeyError) as e:
+            print(f"ERROR: invalid study definition {file}: {e}")
+            rows.append({"file": file, "study": None, "target_folder": None, "status": "failed", "error": str(e),
+                         "entities": [], "time": 0.0})
+            continue
+        rows.append(file)
+        studies.append((folder, study_meta))
+
+    summary = iter(process_batch(studies, **options))
+    rows = [{"file": row, **next(summary)} if isinstance(row, str) else row for row in rows]
+
+    print(f"\nGenerated {len(rows)} studies in {time.perf_counter() - start:.3f}s:")
+    print(_summary_table(rows))
+    failed = [row for row in rows if row["status"] == "failed"]
+    for row in failed:
+        print(f"ERROR: {row['file']}: {row['error']}")
+    if failed:
+        raise Exception(f"Failed to generate {len(failed)} of {len(rows)} studies!")
+    return rows
@@ -0,0 +1,174 @@
+"""
+Serve mode (--serve): the generator keeps running and generates studies posted to it over HTTP, on a Unix socket
+or a localhost port. The process keeps pandas loaded, parsed source files and anonymization mappings warm between
+runs, the functions definition file is executed again for each study: results are the same as of a new process.
+
+    POST /generate[?force=1]  body: study definition (JSON / YAML content or a file path, as the CLI input),
+                              Content-Type: application/json or application/yaml
+    GET /health
+
+Posted study definitions run arbitrary code: functions of the definition file and of any importable module.
+Requests must carry the token of the server (TOKEN_HEADER, see serve), requests from other hosts or web pages
+(Host / Origin headers other than localhost) are rejected.
+"""
+import io
+import os
+import hmac
+import json
+import stat
+import time
+import secrets
+import traceback
+import contextlib
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+TOKEN_HEADER = "X-Cbio-Token"
+CONTENT_TYPES = ("application/json", "application/yaml")
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class UnixHTTPServer(socketserver.UnixStreamServer):
+    def server_bind(self):
+        # a socket file left behind by a server that did not stop cleanly
+        if os.path.exists(self.server_address) and stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+            os.remove(self.server_address)
+        super().server_bind()
+        # only the user running the server can connect
+        os.chmod(self.server_address, 0o600)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+class StudyHandler(BaseHTTPRequestHandler):
+    """
+    Requests are served one by one: a study is generated only once the previous one is done
+    """
+    server_version = "cbio_importer"
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if urlsplit(self.path).path != "/health":
+            return self._respond(404, {"status": "not found"})
+        self._respond(200, {"status": "ok", "runs": self.server.runs, "uptime": time.time() - self.server.started})
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        url = urlsplit(self.path)
+        if url.path != "/generate":
+            return self._respond(404, {"status": "not found"})
+        # forms and plain text are what web pages can post without asking the server first
+        content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+        if content_type not in CONTENT_TYPES:
+            return self._respond(415, {"status": "invalid", "error": f"Content-Type must be one of {CONTENT_TYPES}"})
+        content = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8").strip()
+        force = parse_qs(url.query).get("force", ["0"])[-1].lower() not in ("0", "false", "")
+        self._respond(*self.server.generate(content, force))
+
+    def _authorized(self):
+        """
+        Rejects requests without the token of the server and requests of other hosts or web pages (DNS rebinding,
+        cross-site requests), responds to them
+        :return: True if the request can be served
+        """
+        origin = self.headers.get("Origin")
+        if not _local(self.headers.get("Host")) or (origin is not None and not _local(urlsplit(origin).netloc)):
+            self._respond(403, {"status": "forbidden", "error": "Only local clients are served"})
+            return False
+        token = self.headers.get(TOKEN_HEADER) or ""
+        if not hmac.compare_digest(token.encode("utf-8"), self.server.token.encode("utf-8")):
+            self._respond(401, {"status": "unauthorized", "error": f"Missing or invalid {TOKEN_HEADER} header"})
+            return False
+        return True
+
+    def address_string(self):
+        # clients of Unix sockets have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _respond(self, status: int, result: dict):
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _local(host):
+    """
+    True if the host (host[:port] of a Host header or an origin) is the local machine
+    """
+    if not host:
+        return False
+    hostname = urlsplit(f"//{host}").hostname
+    return hostname in LOCAL_HOSTS
+
+
+def _generate(server, load, run):
+    def generate(content, force):
+        """
+        :return: (HTTP status, response)
+        """
+        start = time.perf_counter()
+        log = io.StringIO()
+        try:
+            study_meta = load(content)
+        except ValueError as e:
+            return 400, {"status": "invalid", "error": str(e)}
+        server.runs += 1
+        result = {"study_id": study_meta.get("study_id")}
+        with contextlib.redirect_stdout(log):
+            try:
+                target_folder, timings = run(study_meta, force)
+                result.update(status="generated", output_folder=os.path.abspath(target_folder), entities=timings)
+            except Exception as e:
+                traceback.print_exc(file=log)
+                result.update(status="failed", error=str(e))
+        result.update(time=time.perf_counter() - start, log=log.getvalue())
+        print(f"Study {result['study_id']} {result['status']} in {result['time']:.3f}s.")
+        return (200 if result["status"] == "generated" else 500), result
+    return generate
+
+
+def serve(load, run, token_file: str, port: int = None, socket_path: str = None, token: str = None):
+    """
+    Generates posted studies until interrupted
+    :param load: study definition content -> study dict, raises ValueError for invalid definitions
+    :param run: (study dict, force) -> (target folder, per entity timings)
+    :param token_file: file the token is saved to (readable by the user only) while the server runs
+    :param port: localhost port to listen on instead of the Unix socket
+    :param socket_path: Unix socket to listen on
+    :param token: value of the TOKEN_HEADER requests must carry, a random one for each start if not given
+    """
+    if port is None:
+        server = UnixHTTPServer(socket_path, StudyHandler)
+        address = socket_path
+    else:
+        print("WARN: every local user can connect to the port, only the token protects the server "
+              "(prefer --socket).")
+        server = HTTPServer(("127.0.0.1", port), StudyHandler)
+        address = f"http://127.0.0.1:{server.server_port}"
+    server.runs = 0
+    server.started = time.time()
+    server.token = token or secrets.token_urlsafe(32)
+    server.generate = _generate(server, load, run)
+    descriptor = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    # a file left behind keeps its mode
+    os.fchmod(descriptor, 0o600)
+    with open(descriptor, "w") as file:
+        file.write(server.token)
+    print(f"Serving on {address}: POST /generate with a study definition, GET /health. "
+          f"Requests need the {TOKEN_HEADER} header, the token is saved in {token_file}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped.")
+    finally:
+        server.server_close()
+        os.remove(token_file)
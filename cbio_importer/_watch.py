@@ -0,0 +1,73 @@
+"""
+Watch mode (--watch): generates the study, then again whenever the study definition, the functions file or
+a source / joined file of the study changes. Runs are incremental (see BuildManifest): only entities whose
+YAML block, files or functions changed are generated again. Parsed source files that did not change, the functions
+file and anonymization mappings stay loaded between runs.
+"""
+import os
+import time
+import traceback
+
+POLL_SECONDS = 0.5
+
+
+def _stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _changes(snapshot: dict):
+    return [path for path, stat in snapshot.items() if _stat(path) != stat]
+
+
+def _wait_for_changes(snapshot: dict, interval: float):
+    """
+    :return: paths that changed, once they did not change for an interval (editors and exports write in steps)
+    """
+    while True:
+        time.sleep(interval)
+        changed = _changes(snapshot)
+        if not changed:
+            continue
+        while True:
+            current = {path: _stat(path) for path in snapshot}
+            time.sleep(interval)
+            if not _changes(current):
+                return changed
+
+
+def _report(timings):
+    generated = [f"{item['entity']} ({item['time']:.3f}s)" for item in timings if item["status"] == "generated"]
+    unchanged = sum(1 for item in timings if item["status"] == "unchanged")
+    print(f"Generated: {', '.join(generated) or 'nothing'}; {unchanged} unchanged.")
+
+
+def watch(study_file: str, load, run, watched, force: bool = False, interval: float = POLL_SECONDS):
+    """
+    Generates the study on every change until interrupted
+    :param study_file: path of the study definition
+    :param load: study definition path -> study dict, raises ValueError for invalid definitions
+    :param run: (study dict, force) -> (target folder, per entity timings)
+    :param watched: study dict -> paths of the other files the study reads
+    :param force: generate all entities in the first run
+    """
+    while True:
+        snapshot = {study_file: _stat(study_file)}
+        try:
+            study_meta = load(study_file)
+            snapshot.update((path, _stat(path)) for path in watched(study_meta))
+            start = time.perf_counter()
+            _, timings = run(study_meta, force)
+            _report(timings)
+            print(f"Done in {time.perf_counter() - start:.3f}s.")
+            force = False
+        except ValueError as e:
+            print(f"ERROR: {e}")
+        except Exception:
+            traceback.print_exc()
+        print(f"Watching {len(snapshot)} files for changes (Ctrl+C to stop).")
+        changed = _wait_for_changes(snapshot, interval)
+        print(f"\nChanged: {', '.join(changed)}")
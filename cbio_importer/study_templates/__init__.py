@@ -1,27 +1,28 @@
+import io
+import os
+import sys
+import time
 import random
 import hashlib
+import traceback
+import contextlib
 
-from ._utilities import write_meta_file, get_template_file_by_name, read_opt
+from ._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue
+from ._config import write_meta_file, get_template_file_by_name, read_opt, collect_function_names, get_rules, \
+    referenced_columns
+from ._manifest import BuildManifest
+from ._profile import Profiler
+from ._output import output_options, data_file_name
 
 from .patient import process as process_patient
 from .sample import process as process_sample
-from .resource import process as process_resources
+from .resource import process_definition as process_resource_definition, process_item as process_resource_item
 from .cancer_type import process as process_cancer_types
-from .time_series import process as process_time_series
+from .time_series import process_item as process_time_series_item
 
 reserved_keys = []
 
 
-def _process_item(name, fn, options, study_yaml, data_selector=None):
-    data = data_selector(study_yaml) if data_selector is not None else study_yaml.get(name, None)
-    reserved_keys.append(name)
-    if data is not None:
-        fn(options, data)
-        print(f"{name.capitalize()} generated.")
-    else:
-        print(f"{name.capitalize()} not defined - skipping.")
-
-
 # generic simple item collector:
 def _collect_top_level_nodes_that_have_child(study_yaml, child_name, child_type):
     result = []
@@ -50,11 +51,293 @@ def _collect_time_series(study_yaml):
 
 
 
-def process(target_folder, study_yaml, source_prefix=""):
+def _writers():
+    """
+    The _utilities module (CbioCSVWriter, caches, function registry), None if no entity loaded it yet:
+    it loads pandas, entities import it only when they write data from sources
+    """
+    return sys.modules.get(f"{__name__}._utilities")
+
+
+def _clear_source_cache(keep_unchanged=False):
+    if _writers() is not None:
+        _writers().SourceFileCache().clear(keep_unchanged)
+
+
+def _restart():
+    # Earlier runs of this process (serve mode) leave functions and their state behind, start as a new process would
+    if _writers() is not None:
+        _writers().FunctionRegistry().restart()
+        _writers().default_functions.reset_state()
+
+
+def _save_state():
+    # see default_functions.save_state, studies writing no data from sources do not load the functions (pandas)
+    functions = sys.modules.get(f"{__name__}.default_functions")
+    if functions is None:
+        return {"random": random.getstate()}
+    return functions.save_state()
+
+
+def _restore_state(state):
+    if "id_dealer" not in state:
+        random.setstate(state["random"])
+        return
+    from . import default_functions
+    default_functions.restore_state(state)
+
+
+def _end_state(data, stateless):
+    # Delta entities with side effects continue from the state their last run ended with (see BuildManifest.record)
+    delta = isinstance(data, dict) and data.get("delta") is True
+    return None if stateless or not delta else _save_state()
+
+
+def _timing(label, status, seconds=0.0):
+    return {"entity": label, "status": status, "time": seconds}
+
+
+def _is_stateless(data):
+    # Only pure functions (see default_functions.pure) can be evaluated independently of other entities,
+    # functions of the functions definition file seed random numbers once used (see CbioCSVWriter._seed)
+    names = list(collect_function_names(data))
+    if not names:
+        return True
+    from ._utilities import FunctionRegistry, is_pure
+    registry = FunctionRegistry()
+    return all(is_pure(registry.get(name)) and not registry.from_definition_file(name) for name in names)
+
+
+def _uses_definition_file(data):
+    # Entities calling only default functions or module paths do not depend on the functions file
+    names = list(collect_function_names(data))
+    if not names:
+        return False
+    from ._utilities import FunctionRegistry
+    registry = FunctionRegistry()
+    return any(registry.from_definition_file(name) for name in names)
+
+
+def _expect_source_columns(units, options):
+    # Sources are parsed once, with the columns all units read (see SourceFileCache)
+    cache = None
+    for _, _, data, *_ in units:
+        if not isinstance(data, dict) or not isinstance(data.get("file"), str):
+            continue
+        columns, keys = referenced_columns(data) if data.get("compact", True) is not False else (None, None)
+        files = [data["file"]] + [join["file"] for join in get_rules(data, "join") if isinstance(join.get("file"), str)]
+        for file in files:
+            path = f"{options['source_prefix']}{file}"
+            if os.path.isfile(path):
+                if cache is None:
+                    from ._utilities import SourceFileCache
+                    cache = SourceFileCache()
+                cache.expect(path, columns, keys)
+
+
+def _seed_study(study_yaml):
     # ensure stable results per study
     random.seed(int(hashlib.sha1(read_opt("study_id", study_yaml, assert_type=str).encode("utf-8"))
                     .hexdigest(), 16) % (10 ** 8))
 
+
+def _collect_units(study_yaml, options):
+    """
+    Splits the study into units of work: [(name, data, [(label, fn, data, stateless, outputs)...])]
+    in the processing order, outputs are names of the files the unit writes to the target folder
+    """
+    groups = []
+
+    def collect(name, data_selector=None):
+        data = data_selector(study_yaml) if data_selector is not None else study_yaml.get(name, None)
+        reserved_keys.append(name)
+        groups.append((name, data, []))
+        return data, groups[-1][2]
+
+    def outputs(name):
+        return [f"meta_{name}.txt", data_file_name(name, options)]
+
+    data, units = collect("cancer_types")
+    if data is not None:
+        units.append(("cancer types", process_cancer_types, data, False, outputs("cancer_type")))
+    data, units = collect("resources", _collect_resources)
+    if data is not None:
+        # the definition reads only the resource blocks: it does not depend on the files of the items
+        units.append(("resource definition", process_resource_definition,
+                      [{"resource": item["resource"]} for item in data], False, outputs("resource_definition")))
+        for item in data:
+            key = item['resource']['__key']
+            units.append((f"resource {key}", process_resource_item, item, _is_stateless(item),
+                          outputs(f"resource_item_{key}")))
+    data, units = collect("time_series", _collect_time_series)
+    if data is not None:
+        for item in data:
+            key = item['series']['__key']
+            units.append((f"time series {key}", process_time_series_item, item, _is_stateless(item),
+                          outputs(f"timeline_{key}")))
+    for name, fn, file in (("samples", process_sample, "clinical_samples"),
+                           ("patients", process_patient, "clinical_patient")):
+        data, units = collect(name)
+        if data is not None:
+            units.append((name, fn, data, _is_stateless(data), outputs(file)))
+    return groups
+
+
+def _report_group(name, data, group_units, selected, failed=()):
+    """
+    Prints the status line of a group of units
+    """
+    if data is None:
+        print(f"{name.capitalize()} not defined - skipping.")
+    elif group_units and not any(label in selected for label, *_ in group_units):
+        print(f"{name.capitalize()} unchanged - skipping.")
+    elif not any(label in failed for label, *_ in group_units):
+        print(f"{name.capitalize()} generated.")
+
+
+def _init_worker(functions_path, temporary_path, seed):
+    FunctionDefinitionFile(functions_path)
+    TemporaryFilesDirectory(temporary_path)
+    SeedValue(seed)
+
+
+def _run_units(units, options, study_yaml, state=None):
+    """
+    Worker: generates units in the given order, returns [(label, stdout, error, seconds, state, end state)]
+    """
+    return [result[1:] for result in _run_segments([(0, units, options, study_yaml, state)], [(units, options)])]
+
+
+def _run_segments(segments, expected, keep_sources=False):
+    """
+    Worker: generates units of studies in the given order, each study starts as in a new process (see _begin_study)
+    :param segments: [(study index, units, options, study_yaml, state to continue from (see BuildManifest.select))]
+    :param expected: [(units, options)] reading sources: files are parsed once, with the columns all of them read
+    :param keep_sources: keep parsed source files for later tasks of the worker (see process_batch)
+    :return: [(study index, label, stdout, error, seconds, state the unit started from (units with side effects),
+               state the unit ended with (delta units with side effects, see _end_state))]
+    """
+    for units, options in expected:
+        _expect_source_columns(units, options)
+    results = []
+    for index, units, options, study_yaml, state in segments:
+        with contextlib.redirect_stdout(io.StringIO()):
+            _begin_study(study_yaml, state)
+        for label, fn, data, stateless, _ in units:
+            output = io.StringIO()
+            error = None
+            state = None if stateless else _save_state()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(output):
+                try:
+                    fn(options, data)
+                except Exception:
+                    error = traceback.format_exc()
+            seconds = time.perf_counter() - start
+            end = None if error is not None else _end_state(data, stateless)
+            results.append((index, label, output.getvalue(), error, seconds, state, end))
+    with contextlib.redirect_stdout(io.StringIO()):
+        _clear_source_cache(keep_sources)
+    return results
+
+
+def _pool(jobs):
+    # multiprocessing is loaded only for parallel runs
+    from concurrent.futures import ProcessPoolExecutor
+    return ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker, initargs=(
+        FunctionDefinitionFile(None).path, TemporaryFilesDirectory(None).path, SeedValue(None).value
+    ))
+
+
+def _process_parallel(options, study_yaml, groups, selected, manifest, jobs):
+    units = [unit for _, _, group_units in groups for unit in group_units if unit[0] in selected]
+    # Units that might share state run in one task, in their original order
+    tasks = [[unit for unit in units if not unit[3]]] + [[unit] for unit in units if unit[3]]
+
+    results = {}
+    with _pool(jobs) as executor:
+        futures = [executor.submit(_run_units, task, options, study_yaml, manifest.state) for task in tasks if task]
+        for future in futures:
+            for label, output, error, seconds, state, end in future.result():
+                results[label] = (output, error, seconds, state, end)
+
+    timings, failed = _report_results(groups, selected, manifest, results)
+    if failed:
+        raise Exception(f"Failed to generate: {', '.join(failed)}!")
+    return timings
+
+
+def _report_results(groups, selected, manifest, results):
+    """
+    Prints outputs of units generated by workers in the same order as the sequential processing does,
+    records them in the manifest
+    :param results: label -> (stdout, error, seconds, state the unit started from, state it ended with)
+    :return: (timings, labels of failed units)
+    """
+    failed = []
+    timings = []
+    for name, data, group_units in groups:
+        for label, _, _, _, outputs in group_units:
+            if label not in selected:
+                timings.append(_timing(label, "unchanged"))
+                continue
+            output, error, seconds, state, end = results[label]
+            print(output, end='')
+            if error is not None:
+                print(f"ERROR: failed to generate {label}:\n{error}")
+                failed.append(label)
+                manifest.discard(label)
+            else:
+                manifest.record(label, outputs, state, end)
+            timings.append(_timing(label, "failed" if error is not None else "generated", seconds))
+        _report_group(name, data, group_units, selected, failed)
+    return timings, failed
+
+
+def _process_sequential(options, groups, selected, manifest):
+    timings = []
+    for name, data, group_units in groups:
+        for label, fn, unit_data, stateless, outputs in group_units:
+            if label not in selected:
+                timings.append(_timing(label, "unchanged"))
+                continue
+            manifest.discard(label)
+            state = None if stateless else _save_state()
+            start = time.perf_counter()
+            with Profiler().entity(label):
+                fn(options, unit_data)
+            manifest.record(label, outputs, state, _end_state(unit_data, stateless))
+            timings.append(_timing(label, "generated", time.perf_counter() - start))
+        _report_group(name, data, group_units, selected)
+    return timings
+
+
+def _begin_study(study_yaml, state=None):
+    """
+    Starts generating the study as a new process would: functions are resolved again (see _restart), random numbers
+    are seeded by the study, then by the seed value in each entity once it uses a function of the functions file
+    (see CbioCSVWriter._seed). Reports all invalid functions.
+    :param state: state of the functions to continue from (see BuildManifest.select)
+    """
+    _restart()
+    names = list(collect_function_names(study_yaml))
+    if names:
+        from ._utilities import FunctionRegistry
+        FunctionRegistry().validate(names)
+    # after loading the functions file: cancer types (pick_color) draw from the sequence seeded by the study
+    _seed_study(study_yaml)
+    if state is not None:
+        _restore_state(state)
+
+
+def _prepare_study(target_folder, study_yaml, source_prefix, chunk_size, force):
+    """
+    Starts the study (see _begin_study), writes its meta file and selects the units to generate
+    :return: (options, groups of units (see _collect_units), BuildManifest, labels of the selected units)
+    """
+    # Resolve all functions before any data is processed, the registry is inherited by worker processes
+    _begin_study(study_yaml)
+
     # Replaces meta {keys} with values from study_yaml object,
     # possibly specify default value for optionals using ':'
     write_meta_file(get_template_file_by_name("study.txt"), f"{target_folder}/meta_study.txt", study_yaml, [
@@ -65,15 +348,144 @@ def process(target_folder, study_yaml, source_prefix=""):
         "target_folder": target_folder,
         "source_prefix": source_prefix,
         "delimiter": study_yaml.get("delimiter", "\t"),
-        "study_id": study_yaml["study_id"]
+        "study_id": study_yaml["study_id"],
+        "chunk_size": chunk_size,
+        "engine": study_yaml.get("engine", "pandas"),
+        **output_options(study_yaml)
     }
-    _process_item("cancer_types", fn=process_cancer_types, options=options, study_yaml=study_yaml)
-    
-    _process_item("resources", fn=process_resources, options=options, study_yaml=study_yaml,
-                  data_selector=_collect_resources)
-    _process_item("time_series", fn=process_time_series, options=options, study_yaml=study_yaml,
-                  data_selector=_collect_time_series)
-    # Process samples and patients as last since they contain usually the most data and take more time
-    _process_item("samples", fn=process_sample, options=options, study_yaml=study_yaml)
-    _process_item("patients", fn=process_patient, options=options, study_yaml=study_yaml)
+    groups = _collect_units(study_yaml, options)
+    manifest = BuildManifest(target_folder, options, force=force)
+    selected = manifest.select([unit for _, _, group_units in groups for unit in group_units],
+                               _uses_definition_file)
+    options["delta"] = manifest.appendable
+    options["delta_states"] = manifest.delta_states
+    if manifest.state is not None:
+        _restore_state(manifest.state)
+    return options, groups, manifest, selected
+
+
+def process(target_folder, study_yaml, source_prefix="", chunk_size=None, jobs=1, force=False, profile=False,
+            cprofile=False, keep_sources=False):
+    """
+    Generates the study, entities whose inputs did not change since the last run are skipped (see BuildManifest)
+    :param force: generate all entities
+    :param profile: measure entities and their rules (see Profiler), the report is saved next to the target folder,
+        implies force - the report covers all entities
+    :param cprofile: with profile, dump cProfile statistics of the slowest entity
+    :param keep_sources: keep parsed source files for the next run in this process (serve mode)
+    :return: [{"entity": label, "status": generated / unchanged / failed, "time": seconds}] in the processing order
+    """
+    # unchanged entities would be missing in the report (and overwrite the last one with an empty one)
+    options, groups, manifest, selected = _prepare_study(target_folder, study_yaml, source_prefix, chunk_size,
+                                                         force or profile)
+
+    profiler = Profiler()
+    if profile:
+        if jobs and jobs > 1:
+            print("WARN: profiled entities are generated one by one, --jobs is ignored.")
+            jobs = 1
+        profiler.start(cprofile=cprofile)
+    try:
+        if jobs and jobs > 1:
+            return _process_parallel(options, study_yaml, groups, selected, manifest, jobs)
+        # Source files are parsed once per run, entities usually share them
+        _clear_source_cache(keep_sources)
+        _expect_source_columns([unit for _, _, group_units in groups for unit in group_units if unit[0] in selected],
+                               options)
+        try:
+            return _process_sequential(options, groups, selected, manifest)
+        finally:
+            _clear_source_cache(keep_sources)
+    finally:
+        manifest.save()
+        if profile:
+            _report_profile(profiler, target_folder)
+
+
+def process_batch(studies, source_prefix="", chunk_size=None, jobs=1, force=False):
+    """
+    Generates studies sharing one pool of worker processes (jobs) and parsed source files: a file used by more studies
+    is parsed once (once per worker process), with the columns all of them read. Results are the same as of processing
+    the studies one by one (see process) in the given order: entities with side effects (not stateless) of all studies
+    run in one task, in the study order - studies share the helper files directory (e.g. anonymization mappings).
+    :param studies: [(target_folder, study_yaml)]
+    :return: [{"study": study_id, "target_folder": ..., "status": generated / failed, "error": message or None,
+               "entities": see process, "time": seconds the entities took}] in the order of the studies
+    """
+    prepared = []
+    summary = []
+    targets = {}
+    for target_folder, study_yaml in studies:
+        study_id = study_yaml.get("study_id") if isinstance(study_yaml, dict) else None
+        summary.append({"study": study_id, "target_folder": target_folder, "status": "generated", "error": None,
+                        "entities": [], "time": 0.0})
+        try:
+            target = os.path.abspath(target_folder)
+            if target in targets:
+                raise ValueError(f"Output folder {target_folder} is used by study {targets[target]} too!")
+            targets[target] = study_id
+            prepared.append((len(summary) - 1, study_yaml,
+                             *_prepare_study(target_folder, study_yaml, source_prefix, chunk_size, force)))
+        except Exception as e:
+            print(f"ERROR: failed to prepare study {study_id}: {e}")
+            summary[-1].update(status="failed", error=str(e))
+
+    segments = [(index, [unit for _, _, group_units in groups for unit in group_units if unit[0] in selected],
+                 options, study_yaml, manifest.state)
+                for index, study_yaml, options, groups, manifest, selected in prepared]
+    expected = [(units, options) for _, units, options, _, _ in segments]
+    if jobs and jobs > 1:
+        # Units that might share state run in one task, in the order of the studies
+        tasks = [[(index, [unit for unit in units if not unit[3]], options, study_yaml, state)
+                  for index, units, options, study_yaml, state in segments if not all(unit[3] for unit in units)]]
+        tasks += [[(index, [unit], options, study_yaml, None)] for index, units, options, study_yaml, _ in segments
+                  for unit in units if unit[3]]
+    else:
+        tasks = [[segment] for segment in segments]
+
+    results = {}
+    reported = 0
+
+    def report(task_results):
+        # studies are reported in their order, once all their units are done
+        nonlocal reported
+        for index, label, output, error, seconds, state, end in task_results:
+            results.setdefault(index, {})[label] = (output, error, seconds, state, end)
+        while reported < len(prepared):
+            index, study_yaml, options, groups, manifest, selected = prepared[reported]
+            if len(results.get(index, {})) < len(selected):
+                break
+            print(f"Study {summary[index]['study']} -> {options['target_folder']}:")
+            timings, failed = _report_results(groups, selected, manifest, results.get(index, {}))
+            manifest.save()
+            summary[index].update(entities=timings, time=sum(item["time"] for item in timings))
+            if failed:
+                summary[index].update(status="failed", error=f"Failed to generate: {', '.join(failed)}!")
+            reported += 1
+
+    report([])
+    tasks = [task for task in tasks if task]
+    if jobs and jobs > 1:
+        from concurrent.futures import as_completed
+        with _pool(jobs) as executor:
+            futures = [executor.submit(_run_segments, task, expected, True) for task in tasks]
+            for future in as_completed(futures):
+                report(future.result())
+    else:
+        try:
+            for task in tasks:
+                report(_run_segments(task, expected, True))
+        finally:
+            _clear_source_cache()
+    return summary
+
 
+def _report_profile(profiler, target_folder):
+    report_file = f"{os.path.abspath(target_folder).rstrip(os.sep)}.profile.json"
+    report = profiler.report(report_file)
+    profiler.stop()
+    print(f"Profile report saved to {report_file}.")
+    for entity in sorted(report["entities"], key=lambda item: item["time"], reverse=True)[:3]:
+        print(f"  {entity['entity']}: {entity['time']:.3f}s, peak {entity['peak_bytes'] / 2 ** 20:.1f} MiB")
+    if "cprofile" in report:
+        print(f"cProfile statistics of {report['cprofile']['entity']} saved to {report['cprofile']['file']}.")
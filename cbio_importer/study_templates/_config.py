@@ -0,0 +1,211 @@
+import os
+import random
+
+from ._singletons import AbsPath
+
+abspath = AbsPath().path
+
+
+def get_template_file_by_name(name: str):
+    return f"{abspath}study_templates/{name}"
+
+
+def flatten_recursive_array(nested):
+    for item in nested:
+        if isinstance(item, list):  # If the item is a list, recurse
+            yield from flatten_recursive_array(item)
+        else:
+            yield item
+
+
+def get_source_csv_header(item: dict):
+    return item["source_id"] if "source_id" in item else (item["source_ids"] if "source_ids" in item else item["id"])
+
+
+def get_defined_source_csv_headers(config: dict):
+    return [get_source_csv_header(item) for item in config["columns"] if not "value" in item]
+
+
+def read_opt(name: str, source: dict, require=True, default=None, assert_type=None):
+    value = None
+    if require:
+        try:
+            value = source[name]
+        except Exception as e:
+            raise ValueError(f"Field {name} is required in configuration {source}!") from e
+    value = source.get(name, None)  # do not use default here, we will test type
+    if assert_type is not None and value is not None and not isinstance(value, assert_type):
+        raise ValueError(f"Field {name} must be an instance of {assert_type}!")
+    if default is not None and value is None:
+        return default
+    return value
+
+
+def get_rules(config: dict, task: str):
+    """
+    Specs of the preprocessing rules of the given task (filter, join, group...) in the entity configuration
+    """
+    rules = read_opt("preprocess", config, require=False, assert_type=list)
+    if rules is None:
+        spec = read_opt(task, config, require=False)
+        if spec is None:
+            return []
+        return spec if isinstance(spec, list) else [spec]
+    return [rule for rule in rules if rule.get("task") == task]
+
+
+def referenced_columns(config: dict):
+    """
+    Column names the entity configuration refers to: output columns, filters, join keys, group keys,
+    aggregated and created columns. Names of columns the rules produce are included.
+    :return: (names, keys): keys are used as join / group keys, by operators and functions and must keep
+        their type, other columns are only written out or matched by value
+    """
+    def names_of(value):
+        if value is None:
+            return []
+        return [value] if isinstance(value, str) else list(flatten_recursive_array(value))
+
+    names = set()
+    keys = set()
+    for item in config.get("columns") or []:
+        if "value" not in item and "id" in item:
+            names.update(names_of(get_source_csv_header(item)))
+    for spec in get_rules(config, "filter"):
+        columns = names_of(spec.get("source_id", spec.get("source_ids")))
+        names.update(columns)
+        if not spec.get("one_of") and not spec.get("regex"):
+            keys.update(columns)
+    joins = get_rules(config, "join")
+    for spec in joins:
+        keys.update(names_of(spec.get("left_on")) + names_of(spec.get("right_on")))
+    for spec in get_rules(config, "group"):
+        keys.update(names_of(spec.get("by")))
+        for item in spec.get("aggregate") or []:
+            keys.update(names_of(item.get("source_id", item.get("id"))))
+    for spec in get_rules(config, "create"):
+        keys.update(names_of(spec.get("source_id", spec.get("source_ids"))))
+    # same named columns of joined tables are referred to with suffixes
+    suffixes = [suffix for spec in joins for suffix in (spec.get("lsuffix"), spec.get("rsuffix"))
+                if isinstance(suffix, str) and suffix]
+    for suffix in suffixes:
+        names.update(name[:-len(suffix)] for name in names | keys if name.endswith(suffix))
+        keys.update(name[:-len(suffix)] for name in set(keys) if name.endswith(suffix))
+    return names | keys, keys
+
+
+def collect_function_names(node):
+    """
+    Yields names of all functions (function: name: ...) used in the (study) configuration
+    """
+    if isinstance(node, dict):
+        function = node.get("function", None)
+        if isinstance(function, dict) and "name" in function:
+            yield function["name"]
+        for value in node.values():
+            yield from collect_function_names(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from collect_function_names(value)
+
+
+def collect_source_files(node):
+    """
+    Yields paths of all source files (file: ...) used in the configuration, including joined files
+    """
+    if isinstance(node, dict):
+        file = node.get("file", None)
+        if isinstance(file, str):
+            yield file
+        for value in node.values():
+            yield from collect_source_files(value)
+    elif isinstance(node, list):
+        for value in node:
+            yield from collect_source_files(value)
+
+
+def require_header(llist, names, caller_depth=1):
+    """
+    :param names: column ID or a list of them, all missing ones are reported at once
+    """
+    missing = [name for name in ([names] if isinstance(names, str) else names) if name not in llist]
+    if missing:
+        # Parse problem name from the caller script name: sample.py --> Sample
+        raise ValueError(f"{get_caller(caller_depth + 1)} columns MUST include {', '.join(missing)} "
+                         f"column ID{'s' if len(missing) > 1 else ''}!")
+
+
+def get_caller(caller_depth=1):
+    import inspect
+    import pathlib
+    frame = inspect.stack()[caller_depth]
+    return pathlib.Path(frame.filename).stem.capitalize()
+
+
+def read_safe_file(inp):
+    if os.path.isfile(inp):
+        with open(inp, 'r') as inp:
+            content = inp.read()
+        return content
+    raise Exception(f"Clinical data file does not exist! {inp}")
+
+
+def _get_key(key):
+    if ":" in key:
+        return key.split(":")[0]
+    return key
+
+
+def _get_value_or_default(key, data):
+    if ":" in key:
+        key = key.split(":")
+        try:
+            return data[key[0]]
+        except KeyError:
+            return key[1]
+    return read_opt(key, data)
+
+
+def write_meta_file(inp, outp, data, fields=None):
+    content = read_safe_file(inp)
+    fields = fields if fields is not None else data.keys()
+    with open(outp, 'w') as output:
+        output.write(content.format(**{
+            _get_key(key): _get_value_or_default(key, data) for key in fields
+        }))
+
+
+def pick_color(value=None):
+    colors = ['aliceblue', 'antiquewhite', 'aqua', 'aquamarine', 'azure', 'beige', 'bisque', 'black', 'blanchedalmond',
+              'blue', 'blueviolet', 'brown', 'burlywood', 'cadetblue', 'chartreuse', 'chocolate', 'coral',
+              'cornflowerblue', 'cornsilk', 'crimson', 'cyan', 'darkblue', 'darkcyan', 'darkgoldenrod', 'darkgray',
+              'darkgreen', 'darkgrey', 'darkkhaki', 'darkmagenta', 'darkolivegreen', 'darkorange', 'darkorchid',
+              'darkred', 'darksalmon', 'darkseagreen', 'darkslateblue', 'darkslategray', 'darkslategrey',
+              'darkturquoise', 'darkviolet', 'deeppink', 'deepskyblue', 'dimgray', 'dimgrey', 'dodgerblue',
+              'firebrick', 'floralwhite', 'forestgreen', 'fuchsia', 'gainsboro', 'ghostwhite', 'gold', 'goldenrod',
+              'gray', 'green', 'greenyellow', 'grey', 'honeydew', 'hotpink', 'indianred', 'indigo', 'ivory', 'khaki',
+              'lavender', 'lavenderblush', 'lawngreen', 'lemonchiffon', 'lightblue', 'lightcoral', 'lightcyan',
+              'lightgoldenrodyellow', 'lightgray', 'lightgreen', 'lightgrey', 'lightpink', 'lightsalmon',
+              'lightseagreen',
+              'lightskyblue', 'lightslategray', 'lightslategrey', 'lightsteelblue', 'lightyellow', 'lime', 'limegreen',
+              'linen', 'magenta', 'maroon', 'mediumaquamarine', 'mediumblue', 'mediumorchid', 'mediumpurple',
+              'mediumseagreen', 'mediumslateblue', 'mediumspringgreen', 'mediumturquoise', 'mediumvioletred',
+              'midnightblue', 'mintcream', 'mistyrose', 'moccasin', 'navajowhite', 'navy', 'oldlace', 'olive',
+              'olivedrab', 'orange', 'orangered', 'orchid', 'palegoldenrod', 'palegreen', 'paleturquoise',
+              'palevioletred', 'papayawhip', 'peachpuff', 'peru', 'pink', 'plum', 'powderblue', 'purple', 'red',
+              'rosybrown', 'royalblue', 'saddlebrown', 'salmon', 'sandybrown', 'seagreen', 'seashell', 'sienna',
+              'silver', 'skyblue', 'slateblue', 'slategray', 'slategrey', 'snow', 'springgreen', 'steelblue', 'tan',
+              'teal', 'thistle', 'tomato', 'turquoise', 'violet', 'wheat', 'white', 'whitesmoke', 'yellow',
+              'yellowgreen']
+    if isinstance(value, str):
+        value = value.lower()
+        if not value in colors:
+            raise ValueError(f"Color {value} not a valid color: use one of: {colors}.")
+        return value
+    if isinstance(value, int):
+        try:
+            return colors[value]
+        except IndexError as e:
+            raise ValueError(f"Color {value} not a valid color index: use between 0 and {len(colors) - 1}.") from e
+    # else random color
+    return colors[random.randrange(len(colors))]
@@ -0,0 +1,157 @@
+import io
+import os
+import json
+import hashlib
+
+import pandas as pd
+
+from ._singletons import TemporaryFilesDirectory
+
+
+# bytes read at once when hashing the processed part of the source
+BLOCK_SIZE = 1 << 20
+
+
+class DeltaState:
+    """
+    Watermark of an append-only source file processed into an output data file (delta: true), stored
+    in the helper files directory: the byte offset of the first unprocessed row, a digest of all bytes before
+    the offset (any change of processed rows is detected) and the column types of the source.
+    Group keys of the output rows are kept in a separate file, one JSON line per data row.
+    """
+    def __init__(self, target: str):
+        folder = TemporaryFilesDirectory(None).path
+        name = hashlib.sha1(os.path.abspath(target).encode("utf-8")).hexdigest()[:16]
+        self.file = os.path.join(folder, f"delta_{name}.json")
+        self.keys_file = os.path.join(folder, f"delta_{name}.keys")
+        self.state = None
+        self.pending = None
+        if os.path.isfile(self.file):
+            try:
+                with open(self.file, 'r', encoding='utf-8') as file:
+                    self.state = json.load(file)
+            except (OSError, ValueError) as e:
+                print(f"WARN: ignoring invalid delta state {self.file}: {e}")
+
+    def new_rows(self, source: str, delimiter: str):
+        """
+        Reads rows appended to the source since the last run
+        :return: pd.DataFrame, None if the source was not only appended to (or the types of new values changed)
+        """
+        state = self.state
+        if state is None or state.get("source") != os.path.realpath(source):
+            print(f"Delta: {source} was not processed yet - reading the whole file.")
+            return None
+        size = os.stat(source).st_size
+        offset = state["offset"]
+        with open(source, 'rb') as file:
+            header = file.readline()
+            file.seek(0)
+            # the processed rows are hashed in the same pass that reads the new ones
+            prefix = _prefix_digest(file, offset) if size >= offset else None
+            if prefix is None or prefix.hexdigest() != state.get("prefix"):
+                print(f"Delta: {source} was not only appended to - reading the whole file.")
+                return None
+            content = file.read(size - offset)
+        # the exporter might be writing the last row right now
+        content = content[:content.rfind(b"\n") + 1]
+        prefix.update(content)
+        try:
+            # only the processed columns are read (see SourceFileCache)
+            names = list(pd.read_csv(io.BytesIO(header), delimiter=delimiter, nrows=0).columns)
+            rows = pd.read_csv(io.BytesIO(content), delimiter=delimiter, header=None, names=names,
+                               usecols=list(state["dtypes"]), dtype=state["dtypes"]) if content.strip() else \
+                pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in state["dtypes"].items()})
+        except (ValueError, TypeError) as e:
+            print(f"Delta: new rows of {source} do not match the processed column types ({e}) - reading the whole file.")
+            return None
+        self.pending = {**state, "offset": offset + len(content), "prefix": prefix.hexdigest()}
+        return rows
+
+    def watermark(self, source: str):
+        """
+        Records the whole source as processed (full read), call before the source is read
+        """
+        offset = os.stat(source).st_size
+        with open(source, 'rb') as file:
+            prefix = _prefix_digest(file, offset)
+        self.pending = {
+            "source": os.path.realpath(source),
+            "offset": offset,
+            "prefix": prefix.hexdigest(),
+            "dtypes": None,
+            "rows": 0
+        }
+
+    def processed(self, dtypes: dict, rows: int):
+        """
+        Column types and number of the source rows read since the watermark
+        """
+        self.pending["dtypes"] = {column: str(dtype) for column, dtype in dtypes.items()}
+        self.pending["rows"] += rows
+
+    def save(self, keys=None):
+        """
+        Stores the pending watermark and group keys of the output data rows (None if not tracked)
+        """
+        if self.pending is None:
+            return
+        self.save_keys(keys)
+        with open(self.file, 'w', encoding='utf-8') as file:
+            json.dump(self.pending, file)
+        self.state, self.pending = self.pending, None
+
+    def save_keys(self, keys=None):
+        """
+        Stores group keys of the output data rows (None if not tracked)
+        """
+        if keys is None:
+            if os.path.isfile(self.keys_file):
+                os.remove(self.keys_file)
+        else:
+            with open(self.keys_file, 'w', encoding='utf-8') as file:
+                file.writelines(key + "\n" for key in keys)
+
+    def load_keys(self):
+        """
+        Group keys of the output data rows in the order of rows, None if not tracked
+        """
+        if not os.path.isfile(self.keys_file):
+            return None
+        with open(self.keys_file, 'r', encoding='utf-8') as file:
+            return file.read().splitlines()
+
+
+def group_keys(frame: pd.DataFrame, by):
+    """
+    Serialized group keys (JSON) of the frame rows
+    :param by: column or columns the rows are grouped by
+    """
+    columns = [by] if isinstance(by, str) else list(by)
+    return [json.dumps(list(key), default=str) for key in zip(*(frame[column].tolist() for column in columns))]
+
+
+def key_order(keys: list):
+    """
+    Positions of the serialized group keys (see group_keys) in the order of the keys, as groups are aggregated
+    :return: list of positions, None if the keys do not compare (e.g. numbers and strings)
+    """
+    values = [json.loads(key) for key in keys]
+    try:
+        return sorted(range(len(values)), key=values.__getitem__)
+    except TypeError:
+        return None
+
+
+def _prefix_digest(file, length: int):
+    """
+    :return: hashlib object of the first length bytes of the file, read from its current position
+    """
+    digest = hashlib.sha1()
+    while length > 0:
+        block = file.read(min(BLOCK_SIZE, length))
+        if not block:
+            break
+        digest.update(block)
+        length -= len(block)
+    return digest
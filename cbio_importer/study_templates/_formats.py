@@ -0,0 +1,187 @@
+import os
+import importlib
+
+import numpy as np
+import pandas as pd
+
+
+# file extension -> source format, other files are delimited text (csv)
+EXTENSIONS = {
+    ".parquet": "parquet",
+    ".pq": "parquet",
+    ".feather": "feather",
+    ".arrow": "arrow",
+    ".ipc": "arrow",
+    ".arrows": "arrow",
+}
+FORMATS = ("csv", "parquet", "feather", "arrow")
+# rows per Parquet batch read to count missing values
+BATCH_SIZE = 65536
+
+
+def source_format(file: str, format: str = None):
+    """
+    Format of a source file: the explicit 'format' option, or detected from the file extension
+    """
+    if format is not None:
+        if format not in FORMATS:
+            raise ValueError(f"Unsupported source format '{format}' of {file}, use one of {FORMATS}!")
+        return format
+    return EXTENSIONS.get(os.path.splitext(file)[1].lower(), "csv")
+
+
+def read_header(file: str, format: str):
+    """
+    Column names of a Parquet, Feather or Arrow IPC file (read from the schema only)
+    """
+    if format == "parquet":
+        return list(_arrow("parquet").read_schema(file, memory_map=True).names)
+    with _arrow().memory_map(file, 'r') as source:
+        return list(_open_ipc(source).schema.names)
+
+
+def read_frame(file: str, format: str, columns: list = None):
+    """
+    Reads a Parquet, Feather or Arrow IPC file (memory-mapped), only the given columns (None for all).
+    Types are converted as pyarrow does (e.g. integers with missing values to float64, dictionaries to category).
+    """
+    return _to_pandas(_read_table(file, format, columns))
+
+
+class TableChunks:
+    """
+    Parquet, Feather or Arrow IPC file streamed in chunks of rows (see CbioCSVWriter chunk_size), used as
+    the text file reader of pd.read_csv. Record batches are read one by one, the whole table is never loaded.
+    All chunks have the column types of the whole table (dtypes).
+    """
+    def __init__(self, file: str, format: str, chunk_size: int, columns: list = None):
+        self.file = file
+        self.format = format
+        self.chunk_size = chunk_size
+        self.columns = columns
+        self.batches = None
+        schema, nulls = _scan(file, format, columns)
+        self.dtypes = schema.empty_table().to_pandas().dtypes.to_dict()
+        pa = _arrow()
+        for field in schema:
+            # whole table conversions of columns with missing values
+            if field.name in nulls and pa.types.is_integer(field.type):
+                self.dtypes[field.name] = pd.Series(dtype="float64").dtype
+            elif field.name in nulls and pa.types.is_boolean(field.type):
+                self.dtypes[field.name] = pd.Series(dtype=object).dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.batches is not None:
+            # closes the file of an unfinished iteration
+            self.batches.close()
+            self.batches = None
+
+    def __iter__(self):
+        self.batches = _iter_batches(self.file, self.format, self.columns, self.chunk_size)
+        pending, rows = [], 0
+        for batch in self.batches:
+            # batches end at row groups (Parquet) or as written (IPC), chunks have chunk_size rows
+            while batch.num_rows > 0:
+                taken = batch.slice(0, self.chunk_size - rows)
+                pending.append(taken)
+                rows += taken.num_rows
+                batch = batch.slice(taken.num_rows)
+                if rows == self.chunk_size:
+                    yield self._chunk(pending)
+                    pending, rows = [], 0
+        if rows > 0:
+            yield self._chunk(pending)
+
+    def _chunk(self, batches):
+        chunk = _to_pandas(_arrow().Table.from_batches(batches))
+        # categories of dictionary columns differ per chunk, they keep their type
+        return chunk.astype({name: dtype for name, dtype in self.dtypes.items()
+                             if not isinstance(dtype, pd.CategoricalDtype) and chunk[name].dtype != dtype})
+
+
+def _to_pandas(table):
+    frame = table.to_pandas()
+    for name in frame.columns:
+        # missing values are NaN as in sources read by pd.read_csv (pyarrow converts nulls to None)
+        if frame[name].dtype == object:
+            frame[name] = frame[name].where(frame[name].notna(), np.nan)
+    return frame
+
+
+def _read_table(file: str, format: str, columns: list = None):
+    if format == "parquet":
+        return _arrow("parquet").read_table(file, columns=columns, memory_map=True)
+    # the table keeps the mapped memory referenced after the file is closed
+    with _arrow().memory_map(file, 'r') as source:
+        table = _open_ipc(source).read_all()
+    return table if columns is None else table.select(columns)
+
+
+def _iter_batches(file: str, format: str, columns: list = None, batch_size: int = BATCH_SIZE):
+    """
+    Record batches of the given columns (None for all), the file is closed once they are read
+    """
+    if format == "parquet":
+        with _arrow("parquet").ParquetFile(file, memory_map=True) as parquet:
+            yield from parquet.iter_batches(batch_size=batch_size, columns=columns)
+        return
+    with _arrow().memory_map(file, 'r') as source:
+        reader = _open_ipc(source)
+        # the IPC file reader reads batches by index, the stream reader in order
+        batches = (reader.get_batch(index) for index in range(reader.num_record_batches)) \
+            if isinstance(reader, _arrow("ipc").RecordBatchFileReader) else reader
+        for batch in batches:
+            yield batch if columns is None else batch.select(columns)
+
+
+def _scan(file: str, format: str, columns: list = None):
+    """
+    Schema of the given columns and names of the integer and boolean ones holding missing values,
+    from Parquet statistics where available, otherwise counted batch by batch
+    """
+    pa = _arrow()
+    if format == "parquet":
+        with _arrow("parquet").ParquetFile(file, memory_map=True) as parquet:
+            schema = parquet.schema_arrow
+            metadata = parquet.metadata
+    else:
+        with pa.memory_map(file, 'r') as source:
+            schema = _open_ipc(source).schema
+    if columns is not None:
+        schema = pa.schema([schema.field(name) for name in columns], metadata=schema.metadata)
+    counted = [field.name for field in schema if pa.types.is_integer(field.type) or pa.types.is_boolean(field.type)]
+    nulls = set()
+    if format == "parquet":
+        paths = {metadata.schema.column(index).path: index for index in range(metadata.num_columns)}
+        for name in list(counted):
+            statistics = [metadata.row_group(group).column(paths[name]).statistics
+                          for group in range(metadata.num_row_groups)] if name in paths else [None]
+            if all(item is not None and item.has_null_count for item in statistics):
+                counted.remove(name)
+                if sum(item.null_count for item in statistics) > 0:
+                    nulls.add(name)
+    if counted:
+        for batch in _iter_batches(file, format, counted):
+            nulls.update(name for name, column in zip(counted, batch.columns) if column.null_count > 0)
+    return schema, nulls
+
+
+def _open_ipc(source):
+    # Feather (v2) is the Arrow IPC file format, the IPC stream format has no footer
+    ipc = _arrow("ipc")
+    try:
+        return ipc.open_file(source)
+    except _arrow().ArrowInvalid:
+        source.seek(0)
+        return ipc.open_stream(source)
+
+
+def _arrow(module: str = None):
+    try:
+        return importlib.import_module("pyarrow" if module is None else f"pyarrow.{module}")
+    except ImportError as e:
+        raise ValueError("Parquet, Feather and Arrow IPC sources require pyarrow: poetry install -E parquet "
+                         "(or pip install pyarrow)") from e
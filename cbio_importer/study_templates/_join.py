@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+
+
+class KeyIndex:
+    """
+    Index of the join keys (right_on) of a joined table, built once per run (see SourceFileCache.key_index):
+    distinct keys in the order of the rows and the number of rows of each of them.
+    """
+    def __init__(self, frame: pd.DataFrame, columns: list):
+        self.columns = columns
+        sizes = frame.groupby(columns, dropna=False, sort=False, observed=True).size()
+        self.distinct = sizes.index
+        self.counts = sizes.to_numpy()
+        # distinct keys of a table without repeated keys are its rows
+        self.unique = len(self.distinct) == len(frame)
+        self.has_na = bool(frame[columns].isna().to_numpy().any())
+
+    def positions(self, left: pd.DataFrame, left_on: list):
+        """
+        Positions of the keys of the left frame rows among the distinct keys, -1 for keys the table does not have
+        """
+        return self.distinct.get_indexer(join_keys(left, left_on))
+
+    def expected_rows(self, positions: np.ndarray, how: str):
+        """
+        Number of rows the join produces
+        :param positions: see positions
+        :return: (rows, many_to_many): many_to_many if keys repeat on both sides
+        """
+        # unknown keys have position -1: the appended 0
+        matches = np.append(self.counts, 0)[positions]
+        many_to_many = not self.unique and bool(
+            (np.bincount(positions[positions >= 0], minlength=len(self.counts)) > 1)[self.counts > 1].any())
+        if how == "inner":
+            return int(matches.sum()), many_to_many
+        if how == "left":
+            return int(np.maximum(matches, 1).sum()), many_to_many
+        unmatched = np.ones(len(self.distinct), dtype=bool)
+        unmatched[positions[positions >= 0]] = False
+        right = int(matches.sum() + self.counts[unmatched].sum())
+        if how == "right":
+            return right, many_to_many
+        return right + int((matches == 0).sum()), many_to_many
+
+
+def join_keys(frame: pd.DataFrame, columns: list):
+    if len(columns) == 1:
+        keys = frame[columns[0]]
+        # merge matches None and NaN keys alike
+        return pd.Index(keys.where(keys.notna(), np.nan) if keys.dtype == object else keys)
+    return pd.MultiIndex.from_frame(frame[columns])
+
+
+def lookup_join(left: pd.DataFrame, right: pd.DataFrame, index: KeyIndex, how: str, left_on: list,
+                positions: np.ndarray):
+    """
+    Joins the right table with unique keys to the left frame by a lookup in its index: the same result
+    as left.merge(right, how, left_on, right_on) would give, without hashing the right keys again.
+    :param positions: of the left keys in the index (see KeyIndex.positions)
+    :return: pd.DataFrame, None if the join is not a lookup (repeated or missing right keys, 'right' / 'outer' join,
+        different key types, or overlapping column names that need suffixes) - use merge
+    """
+    if how not in ("left", "inner") or not index.unique or index.has_na:
+        return None
+    for left_key, right_key in zip(left_on, index.columns):
+        left_type, right_type = left[left_key].dtype, right[right_key].dtype
+        if left_type != right_type or isinstance(left_type, pd.CategoricalDtype):
+            return None
+    # key columns of the same name are kept once, with the left values
+    same = {right_key for left_key, right_key in zip(left_on, index.columns) if left_key == right_key}
+    columns = [name for name in right.columns if name not in same]
+    if any(name in left.columns for name in columns):
+        return None
+
+    missing = positions < 0
+    if how == "inner" and missing.any():
+        left = left.iloc[np.flatnonzero(~missing)]
+        positions = positions[~missing]
+        missing = missing[~missing]
+    # unmatched rows of a left join are missing values (integers become floats as with merge)
+    fill = bool(missing.any())
+    values = {name: _take(right[name], positions, fill) for name in columns}
+    return pd.concat([left.reset_index(drop=True), pd.DataFrame(values, columns=columns)], axis=1)
+
+
+def _take(values: pd.Series, positions: np.ndarray, fill: bool):
+    array = values.array if isinstance(values.dtype, pd.api.extensions.ExtensionDtype) else values.to_numpy()
+    return pd.api.extensions.take(array, positions, allow_fill=fill)
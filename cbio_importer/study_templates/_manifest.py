@@ -0,0 +1,217 @@
+import os
+import json
+import pickle
+import hashlib
+
+from ._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue
+from ._config import collect_source_files
+
+
+MANIFEST_FILE = "build_manifest.json"
+# states of the functions before entities with side effects (see BuildManifest.select) and after delta entities
+STATE_FILE = "build_state.pickle"
+
+
+class BuildManifest:
+    """
+    Records inputs of generated entities (units of work) in the helper files directory:
+    a hash of the entity YAML block, its source and joined files, the functions file (if the entity
+    calls its functions), the seed, the engine, the chunk size and the generator code, together with the files the entity wrote.
+    Entities with unchanged inputs and untouched outputs are not generated again.
+    """
+    def __init__(self, target_folder: str, options: dict, force: bool = False):
+        self.target_folder = os.path.abspath(target_folder)
+        self.options = options
+        self.force = force
+        self.file = None if TemporaryFilesDirectory(None).path is None else \
+            os.path.join(TemporaryFilesDirectory(None).path, MANIFEST_FILE)
+        # source path -> [size, mtime_ns, digest], content is hashed again only if the file changes
+        self.digests = {}
+        # target folder -> label -> {hash, outputs}, one helper directory can serve more output folders
+        self.targets = {}
+        self.entries = {}
+        self.hashes = {}
+        # hashes of the inputs except the main source file of entities in the delta mode (delta: true)
+        self.bases = {}
+        # output data files new source rows can be appended to (options 'delta', see CbioCSVWriter)
+        self.appendable = []
+        # output data file -> state of the functions new rows continue from (options 'delta_states')
+        self.delta_states = {}
+        # label -> state of the functions before the entity (see default_functions.save_state)
+        self.states = {}
+        # label -> state of the functions after the entity, delta entities with side effects (see record)
+        self.ends = {}
+        # state to continue from, if entities with side effects are generated from one in the middle (see select)
+        self.state = None
+        self._load()
+
+    def _load(self):
+        content = self._read(warn=True)
+        self.digests = content.get("files", {})
+        self.targets = content.get("targets", {})
+        self.entries = self.targets.get(self.target_folder, {})
+        states = self._read_states().get(self.target_folder, {})
+        self.states = states.get("start", {})
+        self.ends = states.get("end", {})
+
+    def _read(self, warn=False):
+        if self.file is None or not os.path.isfile(self.file):
+            return {}
+        try:
+            with open(self.file, 'r', encoding='utf-8') as file:
+                return json.load(file)
+        except (OSError, ValueError) as e:
+            if warn:
+                print(f"WARN: ignoring invalid manifest {self.file}: {e}")
+            return {}
+
+    def _state_file(self):
+        return os.path.join(os.path.dirname(self.file), STATE_FILE)
+
+    def _read_states(self):
+        if self.file is None or not os.path.isfile(self._state_file()):
+            return {}
+        try:
+            with open(self._state_file(), 'rb') as file:
+                return pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return {}
+
+    def save(self):
+        if self.file is None:
+            return
+        # manifests of other output folders (e.g. studies of a batch) may have been saved since this one was loaded
+        content = self._read()
+        self.targets = {**content.get("targets", {}), self.target_folder: self.entries}
+        self.digests = {**content.get("files", {}), **self.digests}
+        os.makedirs(os.path.dirname(self.file), exist_ok=True)
+        with open(self.file, 'w', encoding='utf-8') as file:
+            json.dump({"files": self.digests, "targets": self.targets}, file, indent=1, sort_keys=True)
+        states = {**self._read_states(), self.target_folder: {"start": self.states, "end": self.ends}}
+        with open(self._state_file(), 'wb') as file:
+            pickle.dump(states, file)
+
+    def select(self, units, uses_functions=None):
+        """
+        Labels of the units that must be generated. State of units that might share it (not stateless) flows
+        forward: once any of them changes, it is generated again together with all the following ones, continuing
+        from the state recorded before it (see state). Units before it are generated again too if they call
+        functions of the functions file (these may keep state in module variables) or no state was recorded.
+        :param units: [(label, fn, data, stateless, outputs)...]
+        :param uses_functions: unit data -> True if the unit calls functions of the functions file,
+                               None if all units depend on the file
+        :return: set of labels
+        """
+        common = {
+            # the engine and the chunk size can change the generated values (e.g. dtypes, order of function calls)
+            "options": {key: self.options.get(key) for key in ("study_id", "delimiter", "source_prefix", "engine",
+                                                              "chunk_size")},
+            "seed": str(SeedValue(None).value),
+            "code": self._code_digest(),
+        }
+        functions = self._digest(FunctionDefinitionFile(None).path)
+        dirty = set()
+        previous = None
+        for label, _, data, stateless, outputs in units:
+            delta = isinstance(data, dict) and data.get("delta") is True and isinstance(data.get("file"), str)
+            # the main source of a delta entity is hashed separately: it is expected to grow
+            other = {key: value for key, value in data.items() if key != "file"} if delta else data
+            base = {**common, "functions": functions if uses_functions is None or uses_functions(data) else None,
+                    "data": data, "sources": self._digests(collect_source_files(other))}
+            if not stateless:
+                # the state it starts from changes if the unit before it is removed or replaced
+                base["previous"], previous = previous, label
+            if delta:
+                self.bases[label] = self._hash(base)
+                base["main"] = self._digests([data["file"]])
+            self.hashes[label] = self._hash(base)
+            if self.force or not self._is_current(label, outputs):
+                dirty.add(label)
+            entry = self.entries.get(label, {})
+            # new rows of entities with side effects continue from the state the last run ended with
+            if delta and not self.force and entry.get("base") == self.bases[label] and \
+                    self._outputs_current(entry, outputs) and (stateless or label in self.ends):
+                # outputs are [meta, data] files
+                self.appendable.append(outputs[-1])
+                if not stateless:
+                    self.delta_states[outputs[-1]] = self.ends[label]
+        # forget entities removed from the study
+        self.entries = {label: entry for label, entry in self.entries.items() if label in self.hashes}
+        self.states = {label: state for label, state in self.states.items() if label in self.hashes}
+        self.ends = {label: state for label, state in self.ends.items() if label in self.hashes}
+        stateful = [(label, data) for label, _, data, stateless, _ in units if not stateless]
+        first = next((index for index, (label, _) in enumerate(stateful) if label in dirty), None)
+        if first is not None:
+            start = next(index for index, (label, data) in enumerate(stateful) if index == first
+                         or uses_functions is None or uses_functions(data))
+            self.state = self.states.get(stateful[start][0]) if start > 0 else None
+            if self.state is None:
+                start = 0
+            dirty.update(label for label, _ in stateful[start:])
+        return dirty
+
+    def record(self, label, outputs, state=None, end=None):
+        """
+        Stores the unit as generated from the current inputs
+        :param state: state of the functions the unit started from (units with side effects)
+        :param end: state of the functions the unit ended with (delta units with side effects): rows appended
+                    to its source are processed from it (e.g. increment IDs go on), see CbioCSVWriter._continue_state
+        """
+        self.entries[label] = {"hash": self.hashes[label], "base": self.bases.get(label),
+                               "outputs": {name: self._output_stat(name) for name in outputs}}
+        if state is not None:
+            self.states[label] = state
+        if end is not None:
+            self.ends[label] = end
+        else:
+            self.ends.pop(label, None)
+
+    def discard(self, label):
+        self.entries.pop(label, None)
+        self.states.pop(label, None)
+        self.ends.pop(label, None)
+
+    def _is_current(self, label, outputs):
+        entry = self.entries.get(label, None)
+        if entry is None or entry.get("hash") != self.hashes[label]:
+            return False
+        return self._outputs_current(entry, outputs)
+
+    def _outputs_current(self, entry, outputs):
+        recorded = entry.get("outputs", {})
+        return all(name in recorded and recorded[name] == self._output_stat(name) for name in outputs)
+
+    def _output_stat(self, name):
+        try:
+            stat = os.stat(os.path.join(self.target_folder, name))
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def _digests(self, files):
+        return {file: self._digest(f"{self.options['source_prefix']}{file}") for file in files}
+
+    def _digest(self, path):
+        if path is None or not os.path.isfile(path):
+            return None
+        path = os.path.realpath(path)
+        stat = os.stat(path)
+        cached = self.digests.get(path, None)
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+        self.digests[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return self.digests[path][2]
+
+    def _code_digest(self):
+        # Generator code and meta templates: outputs change with the package version
+        folder = os.path.dirname(os.path.abspath(__file__))
+        return self._hash({name: self._digest(os.path.join(folder, name)) for name in sorted(os.listdir(folder))
+                           if name.endswith((".py", ".txt"))})
+
+    @staticmethod
+    def _hash(value):
+        return hashlib.sha1(json.dumps(value, sort_keys=True, default=str).encode("utf-8")).hexdigest()
@@ -0,0 +1,66 @@
+import io
+import gzip
+
+
+COMPRESSIONS = (None, "gzip")
+# bytes buffered before the output file is written to, see open_text
+DEFAULT_BUFFER_SIZE = 1 << 20
+# rows joined into one string per write call
+BLOCK_ROWS = 1 << 16
+
+
+def output_options(study_yaml: dict):
+    """
+    Output options of the study: compression (gzip: data files are written as data_*.txt.gz) and
+    output_buffer_size (bytes)
+    """
+    compression = study_yaml.get("compression")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression '{compression}', use one of {COMPRESSIONS}!")
+    buffer_size = study_yaml.get("output_buffer_size", DEFAULT_BUFFER_SIZE)
+    if not isinstance(buffer_size, int) or isinstance(buffer_size, bool) or buffer_size <= 0:
+        raise ValueError(f"output_buffer_size must be a positive number of bytes, got {buffer_size}!")
+    return {"compression": compression, "output_buffer_size": buffer_size}
+
+
+def data_file_name(name: str, options: dict):
+    """
+    Name of the output data file of an entity: data_<name>.txt, compressed data_<name>.txt.gz
+    """
+    return f"data_{name}.txt.gz" if options.get("compression") == "gzip" else f"data_{name}.txt"
+
+
+def open_text(path: str, mode: str, compression: str = None, buffer_size: int = DEFAULT_BUFFER_SIZE):
+    """
+    Opens an output data file as text ('r', 'w' or 'a'). Compressed files are reproducible: the gzip header
+    has no timestamp. Appending to a gzip file adds a member, readers see one stream.
+    """
+    if compression is None:
+        return open(path, mode, buffering=buffer_size)
+    if mode == "r":
+        return gzip.open(path, "rt")
+    # level 6 as the gzip tool, 9 is much slower for a few percent
+    compressed = gzip.GzipFile(path, mode + "b", compresslevel=6, mtime=0)
+    return io.TextIOWrapper(io.BufferedWriter(compressed, buffer_size))
+
+
+def open_data_file(path: str, options: dict):
+    """
+    Opens an output data file for writing with the output options of the study (see output_options)
+    """
+    return open_text(path, "w", options.get("compression"), options.get("output_buffer_size") or DEFAULT_BUFFER_SIZE)
+
+
+def write_lines(output, rows, separator: str = "\t"):
+    """
+    Writes rows (iterables of strings) as separated lines, joined into blocks of BLOCK_ROWS rows
+    :return: number of rows written
+    """
+    rows = iter(rows)
+    count = 0
+    while True:
+        block = [separator.join(row) for _, row in zip(range(BLOCK_ROWS), rows)]
+        if not block:
+            return count
+        output.write("\n".join(block) + "\n")
+        count += len(block)
@@ -0,0 +1,142 @@
+class Step:
+    """
+    Preprocessing step of a CbioCSVWriter: a task (filter, join, group, create) with its specs. A filter step
+    holds the specs of consecutive filters, evaluated as one mask; other steps hold a single spec.
+    """
+    def __init__(self, task: str, specs: list, indices: list = None):
+        self.task = task
+        self.specs = specs
+        # positions of the rules in the 'preprocess' list, None for the task keys of the configuration
+        self.indices = indices
+        # nothing downstream uses the columns the step adds: the writer skips it if the rows stay the same
+        self.optional = False
+
+    @property
+    def name(self):
+        """
+        Name measured by the profiler (--profile)
+        """
+        if self.indices is None:
+            return self.task
+        return f"preprocess[{','.join(str(index) for index in self.indices)}] {self.task}"
+
+
+def plan_steps(steps: list, output_columns: list, pure, right_columns):
+    """
+    Optimizes the preprocessing steps, the results stay the same:
+     - filters are moved ahead of 'inner' joins that do not add the columns they test, unless they call
+       functions that are not pure: these may depend on the rows they see (e.g. is_unique). Not ahead of 'left'
+       joins: rows without a match turn joined integer columns into floats, filtered out they would not.
+     - consecutive filters are fused into one mask
+     - 'create' steps calling pure functions and 'left' joins are optional if nothing downstream uses
+       the columns they add
+    :param steps: list of Step in the configured order
+    :param output_columns: source column names of the output columns
+    :param pure: function name -> True if the function is pure
+    :param right_columns: join spec -> column names of the joined file, None if unknown
+    :return: list of Step
+    """
+    steps = _fuse_filters(_push_filters(steps, pure, right_columns))
+    _mark_optional(steps, output_columns, pure, right_columns)
+    return steps
+
+
+def _names(value):
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [name for item in value for name in _names(item)]
+    return [value]
+
+
+def _source_columns(spec: dict):
+    return _names(spec.get("source_id", spec.get("source_ids")))
+
+
+def _suffixes(join: dict):
+    return [suffix for suffix in (join.get("lsuffix"), join.get("rsuffix")) if isinstance(suffix, str) and suffix]
+
+
+def _movable(spec: dict, pure):
+    # filters matching values do not keep any state, functions must be pure
+    if spec.get("one_of") or spec.get("regex") or spec.get("operator"):
+        return True
+    function = spec.get("function")
+    return isinstance(function, dict) and pure(function.get("name"))
+
+
+def _crosses(filters: Step, join: Step, right_columns):
+    """
+    True if the filters give the same rows before the inner join: it adds none of the columns they test
+    """
+    spec = join.specs[0]
+    if spec.get("how", "inner") != "inner":
+        return False
+    right = right_columns(spec)
+    if right is None:
+        return False
+    columns = [column for filter_spec in filters.specs for column in _source_columns(filter_spec)]
+    # suffixed names are columns the join renames
+    return not any(column in right or any(column.endswith(suffix) for suffix in _suffixes(spec))
+                   for column in columns)
+
+
+def _push_filters(steps: list, pure, right_columns):
+    planned = []
+    for step in steps:
+        planned.append(step)
+        if step.task != "filter" or not all(_movable(spec, pure) for spec in step.specs):
+            continue
+        # filters are moved across joins only, never ahead of one another
+        position = len(planned) - 1
+        while position > 0 and planned[position - 1].task == "join" \
+                and _crosses(step, planned[position - 1], right_columns):
+            planned[position - 1], planned[position] = planned[position], planned[position - 1]
+            position -= 1
+    return planned
+
+
+def _fuse_filters(steps: list):
+    fused = []
+    for step in steps:
+        previous = fused[-1] if fused else None
+        if step.task == "filter" and previous is not None and previous.task == "filter":
+            indices = None if previous.indices is None else previous.indices + step.indices
+            fused[-1] = Step("filter", previous.specs + step.specs, indices)
+        else:
+            fused.append(step)
+    return fused
+
+
+def _mark_optional(steps: list, output_columns: list, pure, right_columns):
+    # columns used downstream of each step, from the output columns backwards. Columns of joined files
+    # are used too: the same named columns of the frame get suffixes.
+    used = set(output_columns)
+    known = True
+    for step in reversed(steps):
+        if step.task == "filter":
+            used.update(column for spec in step.specs for column in _source_columns(spec))
+            continue
+        spec = step.specs[0]
+        if step.task == "group":
+            used = set(_names(spec.get("by")))
+            used.update(column for item in spec.get("aggregate") or []
+                        for column in _names(item.get("source_id", item.get("id"))))
+            known = True
+        elif step.task == "create":
+            function = spec.get("function")
+            step.optional = known and spec.get("new_column") not in used and isinstance(function, dict) \
+                and pure(function.get("name"))
+            # used even if skipped: the writer decides by the data
+            used.update(_source_columns(spec))
+        elif step.task == "join":
+            right = right_columns(spec)
+            left_on, right_on = _names(spec.get("left_on")), _names(spec.get("right_on"))
+            # key columns of the same name keep the left values
+            added = set(right or ()) - {name for name, other in zip(left_on, right_on) if name == other}
+            step.optional = known and right is not None and spec.get("how", "inner") == "left" \
+                and not added & used \
+                and not any(column.endswith(suffix) for column in used for suffix in _suffixes(spec))
+            used.update(left_on)
+            used.update(right or ())
+            known = known and right is not None
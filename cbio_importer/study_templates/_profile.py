@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import tracemalloc
+import contextlib
+
+from ._singletons import singleton
+
+
+@singleton
+class Profiler:
+    """
+    Measurements of a run (--profile): wall time, rows in / out and peak memory allocated (tracemalloc)
+    for each generated entity and each of its rules (read, preprocess tasks, write). Optionally keeps
+    cProfile statistics of the slowest entity.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.cprofile = False
+        self.entities = []
+        # open entity / rule measurements, innermost last
+        self.spans = []
+        self.slowest = None
+        self.started = None
+
+    def start(self, cprofile: bool = False):
+        self.enabled = True
+        self.cprofile = cprofile
+        self.entities = []
+        self.spans = []
+        self.slowest = None
+        self.started = time.perf_counter()
+        tracemalloc.start()
+
+    def stop(self):
+        self.enabled = False
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def entity(self, label: str):
+        if not self.enabled:
+            yield
+            return
+        span = self._open()
+        span["rules"] = {}
+        profile = None
+        if self.cprofile:
+            # cProfile and pstats are loaded only with --cprofile
+            import cProfile
+            profile = cProfile.Profile()
+        try:
+            if profile is not None:
+                profile.enable()
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            self._close(span)
+            self.entities.append({"entity": label, "time": span["time"], "peak_bytes": span["peak_bytes"],
+                                  "rules": list(span["rules"].values())})
+            if profile is not None and (self.slowest is None or span["time"] > self.slowest[1]):
+                import pstats
+                self.slowest = (label, span["time"], pstats.Stats(profile))
+
+    @contextlib.contextmanager
+    def rule(self, name: str, writer, count_out=None):
+        """
+        Measures a rule of the entity being generated, rows are counted in the writer input
+        :param count_out: function counting output rows of the writer instead
+        """
+        entity = next((span for span in reversed(self.spans) if "rules" in span), None)
+        if not self.enabled or entity is None:
+            yield
+            return
+        rows_in = _rows(writer)
+        span = self._open()
+        try:
+            yield
+        finally:
+            self._close(span)
+            # streamed sources run the rules once per chunk
+            rule = entity["rules"].setdefault(name, {"rule": name, "calls": 0, "time": 0.0, "rows_in": None,
+                                                     "rows_out": None, "peak_bytes": 0})
+            rule["calls"] += 1
+            rule["time"] += span["time"]
+            rule["rows_in"] = _add(rule["rows_in"], rows_in)
+            rule["rows_out"] = _add(rule["rows_out"], (count_out or _rows)(writer))
+            rule["peak_bytes"] = max(rule["peak_bytes"], span["peak_bytes"])
+
+    def report(self, path: str):
+        """
+        Writes the JSON report, cProfile statistics of the slowest entity are dumped next to it (.prof)
+        """
+        _, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        report = {
+            "time": time.perf_counter() - self.started,
+            "peak_bytes": peak,
+            "entities": self.entities,
+        }
+        if self.slowest is not None:
+            label, seconds, stats = self.slowest
+            stats_file = f"{os.path.splitext(path)[0]}.prof"
+            stats.dump_stats(stats_file)
+            report["cprofile"] = {"entity": label, "time": seconds, "file": stats_file}
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        return report
+
+    def _open(self):
+        current = self._observe()
+        span = {"start": time.perf_counter(), "memory": current, "peak": current}
+        self.spans.append(span)
+        return span
+
+    def _close(self, span):
+        self._observe()
+        self.spans.remove(span)
+        span["time"] = time.perf_counter() - span["start"]
+        span["peak_bytes"] = span["peak"] - span["memory"]
+
+    def _observe(self):
+        # The peak is reset for every measurement, open ones keep the maximum observed
+        current, peak = tracemalloc.get_traced_memory()
+        for span in self.spans:
+            span["peak"] = max(span["peak"], peak)
+        tracemalloc.reset_peak()
+        return current
+
+
+def _rows(writer):
+    return len(writer.input) if writer.input is not None else None
+
+
+def _add(total, value):
+    if value is None:
+        return total
+    return value if total is None else total + value
@@ -0,0 +1,298 @@
+import re
+import importlib
+
+import numpy as np
+import pandas as pd
+
+from .default_functions import select_first
+
+ENGINES = ("pandas", "duckdb")
+# functions of group aggregates DuckDB runs natively
+AGGREGATES = {select_first: "first", len: "count"}
+FILTERS = {"one_of": list, "regex": str, "operator": dict, "function": dict}
+OPERATORS = {">": ">", ">=": ">=", "<": "<", "<=": "<=", "==": "=", "!=": "<>"}
+# columns keeping the order of the rows, as pandas orders them
+ORDER = "__cbio_order_{}"
+
+_connection = None
+
+
+class QueryFailed(Exception):
+    """
+    DuckDB could not run the query (e.g. columns of mixed Python objects)
+    """
+
+
+class SqlQuery:
+    """
+    Preprocessing steps of a CbioCSVWriter compiled into one DuckDB query (engine: duckdb), run multi-threaded
+    (larger than memory joins and groups spill to disk). The query reads the frames pandas parsed, so the result
+    has the same rows, order and column types as the pandas steps would give. A step is added only if that holds:
+    filters by value, 'inner' / 'left' joins and groups aggregating by select_first, len or constant values.
+    """
+    def __init__(self, frame: pd.DataFrame):
+        self.tables = {}
+        self.order = []
+        # column names and types of the result, as pandas steps would have them
+        self.schema = frame.iloc[:0]
+        self.sql = f"SELECT * FROM {self._table(frame)}"
+        self.steps = 0
+        # a 'left' join may turn integer columns into floats: pandas decides by the rows, no step can follow
+        self.final = False
+
+    def filter(self, specs: list):
+        """
+        Adds the filters (see CbioCSVWriter._filter_input), all must match by value
+        :return: False if the filters need pandas (functions, types DuckDB compares differently)
+        """
+        if self.final:
+            return False
+        conditions = []
+        for spec in specs:
+            # rules of wrong types fail in pandas
+            if any(spec.get(key) is not None and not isinstance(spec[key], kind) for key, kind in FILTERS.items()):
+                return False
+            column = spec.get("source_id")
+            if spec.get("one_of"):
+                condition = self._one_of(column, spec["one_of"])
+            elif spec.get("regex"):
+                condition = self._regex(column, spec["regex"])
+            elif spec.get("operator"):
+                condition = self._operator(column, spec["operator"])
+            elif spec.get("function"):
+                return False
+            else:
+                continue
+            if condition is None:
+                return False
+            conditions.append(condition)
+        if conditions:
+            self.sql = f"SELECT * FROM ({self.sql}) WHERE {' AND '.join(conditions)}"
+        self.steps += 1
+        return True
+
+    def join(self, right: pd.DataFrame, how: str, left_on: list, right_on: list, suffixes: tuple):
+        """
+        Adds a join (see CbioCSVWriter._join_input): columns are named as pandas merge names them
+        :return: False if the join needs pandas ('right' / 'outer' joins, keys of different types...)
+        """
+        if self.final or how not in ("left", "inner") or not isinstance(left_on, list) \
+                or not isinstance(right_on, list) or not left_on or len(left_on) != len(right_on):
+            return False
+        for left_key, right_key in zip(left_on, right_on):
+            if left_key not in self.schema.columns or right_key not in right.columns:
+                return False
+            dtype = self.schema[left_key].dtype
+            if dtype != right[right_key].dtype or _kind(dtype) not in "iufbO":
+                return False
+        try:
+            joined = self.schema.merge(right.iloc[:0], how=how, left_on=left_on, right_on=right_on, suffixes=suffixes)
+        except (KeyError, ValueError, TypeError):
+            return False
+        # key columns of the same name are kept once, with the left values
+        same = {left_key for left_key, right_key in zip(left_on, right_on) if left_key == right_key}
+        right_columns = [name for name in right.columns if name not in same]
+        names = list(joined.columns)
+        if len(names) != len(self.schema.columns) + len(right_columns) or len(set(names)) != len(names):
+            return False
+
+        table = self._table(right)
+        width = len(self.schema.columns)
+        select = [f"l.{_quote(column)} AS {_quote(name)}" for column, name in zip(self.schema.columns, names)]
+        select += [f"r.{_quote(column)} AS {_quote(name)}" for column, name in zip(right_columns, names[width:])]
+        select += [f"l.{_quote(order)}" for order in self.order[:-1]] + [f"r.{_quote(self.order[-1])}"]
+        # pandas matches missing keys too
+        keys = " AND ".join(f"l.{_quote(left_key)} IS NOT DISTINCT FROM r.{_quote(right_key)}"
+                            for left_key, right_key in zip(left_on, right_on))
+        self.sql = f"SELECT {', '.join(select)} FROM ({self.sql}) AS l " \
+                   f"{'LEFT JOIN' if how == 'left' else 'JOIN'} {table} AS r ON {keys}"
+        self.schema = joined
+        self.final = how == "left" and any(_kind(right[name].dtype) in "iub" for name in right_columns)
+        self.steps += 1
+        return True
+
+    def group(self, spec: dict, resolve):
+        """
+        Adds a group (see CbioCSVWriter._group_input): groups sorted by their keys, missing keys are dropped
+        :param resolve: function name -> function
+        :return: False if the group needs pandas (custom aggregate functions, no aggregates)
+        """
+        by = spec.get("by")
+        keys = [by] if isinstance(by, str) else by
+        aggregates = spec.get("aggregate")
+        if self.final or not isinstance(keys, list) or not keys or not aggregates \
+                or not all(isinstance(item, dict) and "id" in item for item in aggregates):
+            return False
+        for key in keys:
+            if key not in self.schema.columns or _kind(self.schema[key].dtype) not in "iufbO":
+                return False
+
+        columns = {key: self.schema[key].dtype for key in keys}
+        select = [_quote(key) for key in keys]
+        for name, item in {item["id"]: item for item in aggregates}.items():
+            source = item.get("source_id") or name
+            function = item.get("function")
+            if function is not None:
+                kind = AGGREGATES.get(resolve(function.get("name"))) if isinstance(function, dict) else None
+                if kind is None or len(function) > 1 or source not in self.schema.columns \
+                        or isinstance(self.schema[source].dtype, pd.CategoricalDtype):
+                    return False
+                if kind == "first":
+                    order = ", ".join(_quote(order) for order in self.order)
+                    expression, dtype = f"first({_quote(source)} ORDER BY {order})", self.schema[source].dtype
+                else:
+                    expression, dtype = "count(*)", np.dtype("int64")
+            elif item.get("value") is not None:
+                expression, dtype = _literal(item["value"])
+                if expression is None:
+                    return False
+            else:
+                continue
+            if name in columns:
+                return False
+            columns[name] = dtype
+            select.append(f"{expression} AS {_quote(name)}")
+        if len(columns) == len(keys):
+            return False
+
+        order = ORDER.format(f"g{self.steps}")
+        grouped = ", ".join(_quote(key) for key in keys)
+        present = " AND ".join(f"{_quote(key)} IS NOT NULL" for key in keys)
+        self.sql = f"SELECT *, row_number() OVER (ORDER BY {grouped}) AS {_quote(order)} FROM (" \
+                   f"SELECT {', '.join(select)} FROM ({self.sql}) WHERE {present} GROUP BY {grouped})"
+        self.order = [order]
+        self.schema = pd.DataFrame({name: pd.Series(dtype=dtype) for name, dtype in columns.items()})
+        self.steps += 1
+        return True
+
+    def run(self, temporary_directory: str = None):
+        """
+        :param temporary_directory: where DuckDB spills data larger than the memory
+        :return: pd.DataFrame
+        """
+        duckdb = _duckdb()
+        connection = _connect(temporary_directory)
+        columns = ", ".join(_quote(name) for name in self.schema.columns)
+        order = ", ".join(_quote(name) for name in self.order)
+        try:
+            for name, frame in self.tables.items():
+                connection.register(name, frame)
+            result = connection.execute(f"SELECT {columns} FROM ({self.sql}) ORDER BY {order}").df()
+        except duckdb.Error as e:
+            raise QueryFailed(str(e)) from e
+        finally:
+            for name in self.tables:
+                connection.unregister(name)
+        return _pandas_types(result, self.schema)
+
+    def _table(self, frame: pd.DataFrame):
+        name = f"t{len(self.tables)}"
+        order = ORDER.format(len(self.tables))
+        self.tables[name] = frame.assign(**{order: np.arange(len(frame))})
+        self.order.append(order)
+        return name
+
+    def _one_of(self, column, values):
+        kind = self._column_kind(column)
+        if not isinstance(values, list) or kind is None:
+            return None
+        if kind == "O" and all(isinstance(value, str) for value in values):
+            return f"{self._text(column)} IN ({', '.join(_literal(value)[0] for value in values)})"
+        if kind in "iuf" and all(_is_number(value) for value in values):
+            return f"{_quote(column)} IN ({', '.join(_literal(value)[0] for value in values)})"
+        return None
+
+    def _regex(self, column, pattern):
+        kind = self._column_kind(column)
+        if not isinstance(pattern, str) or kind is None:
+            return None
+        try:
+            re.compile(pattern)
+        except re.error:
+            return None
+        # non-string values never match
+        return f"regexp_matches({self._text(column)}, {_literal(pattern)[0]})" if kind == "O" else "FALSE"
+
+    def _operator(self, column, rule):
+        kind = self._column_kind(column)
+        if not isinstance(rule, dict) or kind is None:
+            return None
+        operator, arg = OPERATORS.get(rule.get("command")), rule.get("arg")
+        if operator is None or not (kind in "iuf" and _is_number(arg)
+                                    or kind == "O" and isinstance(arg, str) and operator in ("=", "<>")):
+            return None
+        condition = f"{_quote(column)} {operator} {_literal(arg)[0]}"
+        # missing values differ from any value in pandas
+        return f"({_quote(column)} IS NULL OR {condition})" if operator == "<>" else condition
+
+    def _column_kind(self, column):
+        if not isinstance(column, str) or column not in self.schema.columns:
+            return None
+        kind = _kind(self.schema[column].dtype)
+        return kind if kind in "iufO" else None
+
+    def _text(self, column):
+        if isinstance(self.schema[column].dtype, pd.CategoricalDtype):
+            return f"CAST({_quote(column)} AS VARCHAR)"
+        return _quote(column)
+
+
+def _kind(dtype):
+    # categories of strings are compared as strings
+    if isinstance(dtype, pd.CategoricalDtype):
+        return "O" if dtype.categories.dtype == object else "?"
+    return dtype.kind if isinstance(dtype, np.dtype) else "?"
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+
+def _literal(value):
+    """
+    :return: (SQL literal, pandas dtype of the value), (None, None) for unsupported values
+    """
+    if isinstance(value, bool):
+        return ("TRUE" if value else "FALSE"), np.dtype("bool")
+    if isinstance(value, int):
+        return f"CAST({value} AS BIGINT)", np.dtype("int64")
+    if isinstance(value, float) and np.isfinite(value):
+        return f"CAST({value!r} AS DOUBLE)", np.dtype("float64")
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'", np.dtype(object)
+    return None, None
+
+
+def _quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _pandas_types(result: pd.DataFrame, schema: pd.DataFrame):
+    for name, dtype in schema.dtypes.items():
+        values = result[name]
+        missing = values.isna()
+        if values.dtype != dtype and missing.any() and _kind(dtype) in "iub":
+            # rows of 'left' joins without a match: integers become floats, booleans objects (as with merge)
+            values = values.astype("float64") if _kind(dtype) in "iu" else values.astype(object)
+        elif values.dtype != dtype:
+            values = values.astype(dtype)
+        if values.dtype == object:
+            # missing values are NaN as in frames read by pd.read_csv (DuckDB returns None)
+            values = values.where(~missing, np.nan)
+        result[name] = values
+    return result
+
+
+def _connect(temporary_directory: str = None):
+    global _connection
+    if _connection is None:
+        config = {} if temporary_directory is None else {"temp_directory": f"{temporary_directory}/duckdb"}
+        _connection = _duckdb().connect(config=config)
+    return _connection
+
+
+def _duckdb():
+    try:
+        return importlib.import_module("duckdb")
+    except ImportError as e:
+        raise ValueError("engine: duckdb requires duckdb: poetry install -E duckdb (or pip install duckdb)") from e
@@ -1,50 +1,298 @@
+import io
 import os
 import re
-import sys
+import contextlib
+import operator
+import functools
+import importlib.util
 from importlib import import_module
-import random
 
 import pandas as pd
 import numpy as np
-from ._singletons import FunctionDefinitionFile, AbsPath, SeedValue
+from ._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue, singleton
+from ._config import get_template_file_by_name, flatten_recursive_array, get_source_csv_header, \
+    get_defined_source_csv_headers, read_opt, get_rules, referenced_columns, collect_function_names, \
+    collect_source_files, require_header, get_caller, read_safe_file, write_meta_file, pick_color
+from ._delta import DeltaState, group_keys, key_order
+from ._profile import Profiler
+from ._formats import source_format, read_header, read_frame, TableChunks
+from ._join import KeyIndex, lookup_join
+from ._plan import Step, plan_steps
+from ._sql import ENGINES, SqlQuery, QueryFailed
+from ._output import DEFAULT_BUFFER_SIZE, open_text, write_lines
+from ._validation import ValidationReport
+from . import default_functions
 from .default_functions import *
 
-abspath = AbsPath().path
 pd.set_option('future.no_silent_downcasting', True)
 
-def get_template_file_by_name(name: str):
-    return f"{abspath}study_templates/{name}"
+FILTER_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne
+}
+
+CONVERSIONS = {
+    'int': int,
+    'float': float,
+    'str': str,
+    'bool': bool,
+    'datetime': pd.to_datetime
+}
+
+def regex_mask(values: pd.Series, pattern: re.Pattern):
+    """
+    Boolean mask of values that contain a match of the pattern (re.search), non-string values never match.
+    The pattern is evaluated once per distinct value.
+    """
+    codes, uniques = pd.factorize(values)
+    matches = np.fromiter((isinstance(value, str) and pattern.search(value) is not None for value in uniques),
+                          dtype=bool, count=len(uniques))
+    # missing values have code -1: the appended False
+    return np.append(matches, False)[codes]
+
+
+def _copy_on_write(method):
+    """
+    Runs the writer method in the pandas copy-on-write mode: parsed sources are shared between writers
+    (SourceFileCache), writers must never modify them. Other pandas code of the process keeps its options.
+    """
+    @functools.wraps(method)
+    def scoped(*args, **kwargs):
+        with pd.option_context('mode.copy_on_write', True):
+            return method(*args, **kwargs)
+    return scoped
+
+
+@singleton
+class SourceFileCache:
+    """
+    Parsed source files shared by all writers of a run: each file is parsed once, writers get
+    a copy-on-write view. Entries are keyed by the resolved path, delimiter, format and file size / mtime.
+    Only columns the entities refer to are parsed (see expect), low-cardinality string columns
+    nobody uses as a key or function argument are loaded as 'category'. Joined tables keep an index of their keys.
+    """
+    def __init__(self):
+        self.frames = {}
+        self.headers = {}
+        self.indexes = {}
+        # resolved path -> (column names entities of the run read, names that must keep their type), None for all
+        self.expected = {}
+        self.hits = 0
+        self.misses = 0
+
+    def expect(self, file: str, columns=None, keys=None):
+        """
+        Declares columns of the file an entity of the run reads, the file is parsed once with columns of all entities
+        :param columns: column names, None for all columns
+        :param keys: names of the columns used as keys or function arguments (see referenced_columns), None for all
+        """
+        path = os.path.realpath(file)
+        names, plain = self.expected.get(path, (set(), set()))
+        self.expected[path] = (None if names is None or columns is None else names | set(columns),
+                               None if plain is None or keys is None else plain | set(keys))
 
+    def header(self, file: str, delimiter: str, format: str = "csv"):
+        """
+        Column names of the file, duplicates renamed as pandas reads them (e.g. 'a.1')
+        """
+        key = self._key(file, delimiter, format)
+        if key not in self.headers:
+            self.headers[key] = list(pd.read_csv(file, delimiter=delimiter, nrows=0).columns) if format == "csv" \
+                else read_header(file, format)
+        return self.headers[key]
 
-def flatten_recursive_array(nested):
-    for item in nested:
-        if isinstance(item, list):  # If the item is a list, recurse
-            yield from flatten_recursive_array(item)
+    def read(self, file: str, delimiter: str, columns=None, compact=(), format: str = "csv"):
+        """
+        :param columns: names of the columns to read (missing ones are ignored), None for all columns
+        :param compact: names of the columns that can be read as 'category', others keep their type
+        :param format: csv, or parquet, feather, arrow (see _formats)
+        :return: pd.DataFrame, columns in the order of the file
+        """
+        key = self._key(file, delimiter, format)
+        header = self.header(file, delimiter, format)
+        wanted = header if columns is None else [name for name in header if name in columns]
+        entry = self.frames.get(key)
+        if entry is None or any(name not in entry[0] for name in wanted):
+            self.misses += 1
+            print(f"Source cache miss: parsing {file}")
+            names, plain = self.expected.get(key[0], (set(), set()))
+            loaded = set(header) if names is None else names | set(wanted)
+            plain = set(header) if plain is None else plain | (set(wanted) - set(compact))
+            if entry is not None:
+                loaded |= set(entry[0].columns)
+                plain |= entry[1]
+            frame = self._parse(file, delimiter, format, [name for name in header if name in loaded], len(header), plain)
+            entry = self.frames[key] = (frame, plain)
         else:
-            yield item
+            self.hits += 1
+            print(f"Source cache hit: reusing {file}")
+        frame = entry[0][wanted] if len(wanted) < len(entry[0].columns) else entry[0].copy(deep=False)
+        for name in wanted:
+            if name not in compact and isinstance(frame[name].dtype, pd.CategoricalDtype):
+                frame[name] = frame[name].astype(object)
+        return frame
+
+    def key_index(self, file: str, delimiter: str, columns: list, frame: pd.DataFrame, format: str = "csv"):
+        """
+        Index of the join keys of a file read from the cache, built once per run (see _join.KeyIndex)
+        :param frame: the file as read from the cache (any of its columns)
+        """
+        key = (self._key(file, delimiter, format), tuple(columns))
+        if key not in self.indexes:
+            self.indexes[key] = KeyIndex(frame, list(columns))
+        return self.indexes[key]
+
+    @staticmethod
+    def _key(file: str, delimiter: str, format: str):
+        stat = os.stat(file)
+        return os.path.realpath(file), delimiter, format, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _unchanged(key: tuple):
+        try:
+            stat = os.stat(key[0])
+        except OSError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) == key[3:]
+
+    @staticmethod
+    def _parse(file: str, delimiter: str, format: str, columns: list, total: int, plain: set):
+        columns = columns if len(columns) < total else None
+        frame = pd.read_csv(file, delimiter=delimiter, usecols=columns) if format == "csv" else \
+            read_frame(file, format, columns)
+        categories = saved = 0
+        for name in frame.columns:
+            values = frame[name]
+            if name in plain or values.dtype != object or values.nunique() > len(values) // 2:
+                continue
+            compact = values.astype("category")
+            size = values.memory_usage(deep=True, index=False) - compact.memory_usage(deep=True, index=False)
+            if size > 0:
+                frame[name] = compact
+                categories += 1
+                saved += size
+        if len(frame.columns) < total or categories:
+            print(f"Source columns: {file}: {len(frame.columns)} of {total} read, {categories} as category "
+                  f"({saved / 2 ** 20:.1f} MiB saved).")
+        return frame
+
+    def clear(self, keep_unchanged: bool = False):
+        """
+        :param keep_unchanged: keep files that did not change since they were parsed for the next run (serve mode)
+        """
+        if self.hits or self.misses:
+            print(f"Source cache: {self.hits} hits, {self.misses} misses.")
+        if keep_unchanged:
+            self.frames = {key: entry for key, entry in self.frames.items() if self._unchanged(key)}
+            self.headers = {key: header for key, header in self.headers.items() if self._unchanged(key)}
+            self.indexes = {key: index for key, index in self.indexes.items() if self._unchanged(key[0])}
+        else:
+            self.frames = {}
+            self.headers = {}
+            self.indexes = {}
+        self.expected = {}
+        self.hits = 0
+        self.misses = 0
+
+
+def has_string_columns(dtypes):
+    # A string (object) column makes the common dtype of the rows object, whatever types other columns have
+    return any(dtype == object or isinstance(dtype, pd.CategoricalDtype) for dtype in dtypes)
+
+
+@singleton
+class FunctionRegistry:
+    """
+    Functions referenced by studies: the functions definition file is loaded once per process
+    (worker processes inherit it) and every function name is resolved only once.
+    """
+    def __init__(self):
+        self.module = None
+        self.functions = {}
 
+    def get(self, fnpath: str):
+        """
+        Retrieves function either from a module path, or a global function name (e.g. max)
+        """
+        if fnpath in self.functions:
+            return self.functions[fnpath]
+        fn = self._resolve(fnpath)
+        self.functions[fnpath] = fn
+        return fn
 
-def get_source_csv_header(item: dict):
-    return item["source_id"] if "source_id" in item else (item["source_ids"] if "source_ids" in item else item["id"])
+    def validate(self, names):
+        """
+        Resolves all given function names, reports every invalid one at once
+        """
+        errors = []
+        for name in dict.fromkeys(names):
+            try:
+                self.get(name)
+            except ValueError as e:
+                errors.append(f"{name}: {e.__cause__ if e.__cause__ is not None else e}")
+        if errors:
+            raise ValueError(f"Invalid functions in the study definition ({FunctionDefinitionFile(None).path}):\n  "
+                             + "\n  ".join(errors))
+
+    def from_definition_file(self, fnpath: str):
+        """
+        True if the function is looked up in the functions definition file: not a module path or a default function
+        """
+        return len(fnpath.rsplit(".", maxsplit=1)) == 1 and not callable(globals().get(fnpath))
 
+    def seed(self):
+        """
+        Seeds random numbers by the seed value (set_seed of the functions definition file), writers call it
+        once they use the first function of the file (see CbioCSVWriter._seed)
+        """
+        if self.module is not None:
+            seed_fn = getattr(self.module, "set_seed")
+            seed_fn(SeedValue(None).value)
 
-def get_defined_source_csv_headers(config: dict):
-    return [get_source_csv_header(item) for item in config["columns"] if not "value" in item]
+    def clear(self):
+        self.module = None
+        self.functions = {}
 
+    def restart(self):
+        """
+        Resolves functions again in the next run of the process (serve mode), as a new process would: the definition
+        file is executed again (module variables start over) and seeded once used
+        """
+        self.clear()
 
-def read_opt(name: str, source: pd.DataFrame, require=True, default=None, assert_type=None):
-    value = None
-    if require:
+    def _resolve(self, fnpath):
         try:
-            value = source[name]
+            path = fnpath.rsplit(".", maxsplit=1)
+            if len(path) > 1:
+                m = import_module(path[0])
+                return getattr(m, path[1])
+            else:
+                fn = globals().get(path[0])
+                if callable(fn):
+                    return fn
+
+            if self.module is None:
+                definition_path = FunctionDefinitionFile(None).path
+                if definition_path is None:
+                    return None
+                self._load_module(definition_path)
+            return getattr(self.module, path[0]) if len(path) > 0 else None
         except Exception as e:
-            raise ValueError(f"Field {name} is required in configuration {source}!") from e
-    value = source.get(name, None)  # do not use default here, we will test type
-    if assert_type is not None and value is not None and not isinstance(value, assert_type):
-        raise ValueError(f"Field {name} must be an instance of {assert_type}!")
-    if default is not None and value is None:
-        return default
-    return value
+            raise ValueError(f"Invalid function provided or syntax error in your file: {fnpath.rsplit('.', maxsplit=1)} ({FunctionDefinitionFile(None).path})") from e
+
+    def _load_module(self, definition_path):
+        print(f"Importing functions definition file: {definition_path}")
+        spec = importlib.util.spec_from_file_location("cbio.functions", definition_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        # Only now update module with new content: default functions share their state (e.g. anonymization
+        # mappings) with the library, there is a single instance of the module
+        module.__dict__.update({k: v for k, v in default_functions.__dict__.items() if not k.startswith("__")})
+        self.module = module
 
 
 # Proxy stub class for csv reader if we have array of rows already in memory
@@ -77,6 +325,37 @@ class CsvReaderStub:
             return self.data[self.current_idx]
 
 
+class GroupedAgg:
+    """
+    Group aggregate evaluated for all groups at once: fn(values, codes, groups, **args) (see grouped_of)
+    """
+    def __init__(self, column: str, fn, args: dict):
+        self.column = column
+        self.fn = fn
+        self.args = args
+
+    def named(self):
+        """
+        The aggregate evaluated group by group
+        """
+        return pd.NamedAgg(column=self.column,
+                           aggfunc=lambda x: self.fn(x, np.zeros(len(x), dtype=np.intp), 1, **self.args)[0])
+
+
+def _constant_grouped(values: pd.Series, codes: np.ndarray, groups: int, value):
+    # constant 'value' aggregates
+    return [value] * groups
+
+
+class GroupKeysCollected(Exception):
+    """
+    Stops preprocessing at the 'group' task when only group keys of the rows are needed (delta mode)
+    """
+    def __init__(self, keys):
+        super().__init__("Group keys collected")
+        self.keys = keys
+
+
 class CbioCSVWriter:
     def __init__(self):
         self.input_delimiter = '\t'
@@ -84,7 +363,34 @@ class CbioCSVWriter:
         self.config = None
         self.guard_columns = []
         self.required_value_map = {}
-        self.fn_module = None
+        self.input_file = None
+        self.input_format = "csv"
+        self.input_chunks = None
+        self.chunk_size = None
+        # preprocessing engine (engine: pandas / duckdb), see SqlQuery
+        self.engine = "pandas"
+        # Delta mode (delta: true), see _read_delta
+        self.output_file = None
+        self.compression = None
+        self.output_buffer_size = DEFAULT_BUFFER_SIZE
+        self.delta_targets = ()
+        # output data file -> state of the functions the last run ended with, see _continue_state
+        self.delta_states = {}
+        self.delta = None
+        self.appending = False
+        self.group_by = None
+        self.delta_keys = None
+        self.collect_group_keys = False
+        self.written_keys = None
+        self.rows_written = 0
+        # column checks violated by the input rows, see _validate
+        self.violations = None
+        # joins reported as many-to-many (once for all chunks)
+        self.reported_joins = set()
+        # preprocessing steps (see _plan), planned once for all chunks
+        self.plan = None
+        # random numbers were seeded by the first function of the functions definition file used, see _seed
+        self.seeded = False
 
     def with_required_columns(self, *columns):
         self.guard_columns.extend(columns)
@@ -101,6 +407,12 @@ class CbioCSVWriter:
         """
         self.input_delimiter = options["delimiter"]
         self.input_prefix = options['source_prefix']
+        self.chunk_size = options.get("chunk_size")
+        self.engine = options.get("engine") or "pandas"
+        self.compression = options.get("compression")
+        self.output_buffer_size = options.get("output_buffer_size") or DEFAULT_BUFFER_SIZE
+        self.delta_targets = options.get("delta") or ()
+        self.delta_states = options.get("delta_states") or {}
         if isinstance(inputs, list):
             columns = inputs.pop(0)
             self.input = pd.DataFrame(inputs, columns=columns)
@@ -110,15 +422,28 @@ class CbioCSVWriter:
             inputs = f"{self.input_prefix}{inputs}"
             if not os.path.isfile(inputs):
                 raise ValueError(f"Input file {self.input_prefix}{inputs} does not exist!")
+            # Files are read once the configuration is known (see prepare_headers)
+            self.input_file = inputs
+            return self
         self.input = pd.read_csv(inputs, delimiter=self.input_delimiter)
         return self
 
+    def with_output_file(self, path: str):
+        """Output data file, opened by open_output (gzip compressed with the compression: gzip option).
+        Rows read from sources in the delta mode (delta: true) are appended to it.
+
+        Returns: self for builder pattern
+        """
+        self.output_file = path
+        return self
+
     def with_allowed_values_set(self, key: str, values: list):
         self.required_value_map[key.upper()] = values
         return self
 
+    @_copy_on_write
     def prepare_headers(self, config: dict):
-        if not isinstance(self.input, pd.DataFrame):
+        if not isinstance(self.input, pd.DataFrame) and self.input_file is None:
             raise SyntaxError("with_input must be called first!")
         self.config = config
         # Source column IDs are [id1, id2, [id3, id4]] one-level optionally nested array, in case some query requests multiple values
@@ -128,48 +453,420 @@ class CbioCSVWriter:
         cols = config["columns"]
         self.cols_map = {cols[i]["id"].upper(): cols[i] for i in range(len(cols))}
         self.required_colmns = [item["id"].upper() for item in config["columns"]]
+        # before reading any data
+        require_header(self.required_colmns, self.guard_columns, 2)
+
+        if self.input_file is not None:
+            self._run_rule("read", self._read_input)
+        # Streamed input is preprocessed chunk by chunk in write_data
+        if self.input_chunks is None and not self._nothing_to_append():
+            self._preprocess_input()
+        return self.required_colmns
+
+    def open_output(self):
+        """
+        Opens the output data file (see with_output_file): truncated, or for appending in the delta mode.
+        Chunks are written once validated (see _write_rows): a failure leaves no partial output behind
+        """
+        if not self.appending:
+            return self._discard_on_failure('w')
+        if self.delta_keys is None:
+            return self._discard_on_failure('a')
+        return self._replace_groups()
+
+    def _open_text(self, path: str, mode: str):
+        return open_text(path, mode, self.compression, self.output_buffer_size)
+
+    @contextlib.contextmanager
+    def _discard_on_failure(self, mode: str):
+        # The written file is removed, rows appended in the delta mode are cut off
+        size = os.path.getsize(self.output_file) if mode == 'a' and os.path.isfile(self.output_file) else None
+        try:
+            with self._open_text(self.output_file, mode) as output:
+                yield output
+        except BaseException:
+            if size is not None:
+                with open(self.output_file, 'r+b') as file:
+                    file.truncate(size)
+            elif os.path.exists(self.output_file):
+                os.remove(self.output_file)
+            raise
+
+    @contextlib.contextmanager
+    def _replace_groups(self):
+        # Rows of groups that are aggregated again are replaced, the file is rewritten once all rows are written:
+        # rows in the order of their group keys, as if the whole table was aggregated
+        keys = self.delta.load_keys()
+        with self._open_text(self.output_file, 'r') as file:
+            lines = file.readlines()
+        header = len(lines) - len(keys)
+        kept = [index for index, key in enumerate(keys) if key not in self.delta_keys]
+        self.written_keys = [keys[index] for index in kept]
+        added = io.StringIO()
+        yield added
+        rows = [lines[header + index] for index in kept] + added.getvalue().splitlines(keepends=True)
+        order = key_order(self.written_keys) if self.written_keys is not None else None
+        if order is None and self.written_keys is not None:
+            print(f"WARN: group keys of {self.output_file} do not compare, groups aggregated again are appended.")
+        temporary = f"{self.output_file}.tmp"
+        try:
+            with self._open_text(temporary, 'w') as output:
+                output.writelines(lines[:header])
+                output.writelines(rows if order is None else (rows[index] for index in order))
+            os.replace(temporary, self.output_file)
+            if order is not None:
+                self.delta.save_keys([self.written_keys[index] for index in order])
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+
+    def _read_input(self):
+        self.input_format = self._source_format(self.input_file)
+        if self._read_delta():
+            return
+        chunk_size = self._option("chunk_size", require=False, assert_type=int, default=self.chunk_size)
+        reason = self._requires_full_table() if chunk_size else None
+        if reason is not None:
+            print(f"WARN: {self.input_file} cannot be streamed in chunks of {chunk_size} rows: "
+                  f"{reason}. Reading the file at once...")
+            chunk_size = None
+        if self.delta is not None:
+            self.delta.watermark(self.input_file)
+        if chunk_size:
+            self.input_chunks = self._open_chunks(chunk_size)
+        else:
+            self.input = self._read_source(self.input_file, self.input_delimiter, format=self.input_format)
+            if self.delta is not None:
+                self.delta.processed(self.input.dtypes, len(self.input))
+
+    def _read_delta(self):
+        """
+        Delta mode (delta: true): reads only rows appended to the source since the last run, they are appended
+        to the output. With a 'group' task, only groups with new rows are aggregated again.
+        The build manifest allows it (options 'delta') if nothing but the source changed since the last run.
+        :return: False if the whole source must be read
+        """
+        if not self._option("delta", require=False, assert_type=bool) or self.output_file is None \
+                or TemporaryFilesDirectory(None).path is None:
+            return False
+        if self.input_format != "csv":
+            print(f"Delta: {self.input_file} is not a delimited text file - reading the whole file.")
+            return False
+        self.delta = DeltaState(self.output_file)
+        group_rules = self._rules("group")
+        if len(group_rules) == 1:
+            self.group_by = self._option("by", source=group_rules[0])
+        if os.path.basename(self.output_file) not in self.delta_targets:
+            return False
+        unsupported = None
+        if len(group_rules) > 1:
+            unsupported = "more 'group' tasks"
+        elif any(join.get("how") in ("right", "outer") for join in self._rules("join")):
+            unsupported = "'right' or 'outer' join"
+        elif self.group_by is not None and self.delta.load_keys() is None:
+            unsupported = "group keys of the output rows are unknown"
+        if unsupported is not None:
+            print(f"Delta: {unsupported} - reading the whole {self.input_file}.")
+            return False
+
+        rows = self.delta.new_rows(self.input_file, self.input_delimiter)
+        if rows is None:
+            return False
+        print(f"Delta: {len(rows)} new rows in {self.input_file}.")
+        self.delta.processed(rows.dtypes, len(rows))
+        self.appending = True
+        self.input = rows
+        if self.group_by is None or len(rows) == 0:
+            self._continue_state()
+            return True
+
+        self.delta_keys = self._affected_group_keys()
+        table = self._read_source(self.input_file, self.input_delimiter, format=self.input_format)
+        if {column: str(dtype) for column, dtype in table.dtypes.items()} != self.delta.pending["dtypes"]:
+            print(f"Delta: column types of {self.input_file} changed - reading the whole file.")
+            self.appending = False
+            self.delta_keys = None
+            self.delta.watermark(self.input_file)
+            self.delta.processed(table.dtypes, len(table))
+        else:
+            self._continue_state()
+        print(f"Delta: aggregating {len(self.delta_keys or ())} groups again.")
+        self.input = table
+        return True
 
-        # New, preprocess logics
-        if not self._preprocess():
-            # If not defined, fall back to old
-            self._filter_input()
-            # todo: consider flexible order by definition order
-            if self._option("join_last", require=False):
-                self._group_input()
-                self._create_columns()
-                self._join_input()
+    def _continue_state(self):
+        """
+        Delta mode: functions continue from the state the last run of the entity ended with (see BuildManifest.record),
+        new rows do not get increment IDs or random numbers of the processed ones and is_unique sees the processed
+        rows. Groups aggregated again preprocess the whole source: is_unique contexts start as in the last run.
+        """
+        state = self.delta_states.get(os.path.basename(self.output_file))
+        if state is None:
+            return
+        if self.delta_keys is not None:
+            state = {**state, "unique_sets": default_functions.save_state()["unique_sets"]}
+        default_functions.restore_state(state)
+        # random numbers go on instead of being seeded again (see _seed)
+        self.seeded = True
+
+    def _affected_group_keys(self):
+        # New rows are preprocessed up to the 'group' task, which reports their group keys,
+        # functions called on the way leave no state behind
+        state = default_functions.save_state()
+        seeded = self.seeded
+        self.collect_group_keys = True
+        try:
+            self._preprocess_input()
+        except GroupKeysCollected as e:
+            return set(e.keys)
+        finally:
+            self.collect_group_keys = False
+            default_functions.restore_state(state)
+            self.seeded = seeded
+        return set()
+
+    def _nothing_to_append(self):
+        return self.appending and self.delta_keys is None and len(self.input) == 0
+
+    def _source_format(self, file: str, spec: dict = None):
+        return source_format(file, self._option("format", source=spec, require=False, assert_type=str))
+
+    def _read_source(self, file: str, delimiter: str, left: pd.DataFrame = None, format: str = "csv"):
+        """
+        Reads a source from the SourceFileCache: only columns the configuration refers to (unless 'compact: false'),
+        those only written out or matched by value can be read as 'category'. All columns are read if none of
+        the read ones (nor of the frame joined to) is a string column: rows must have the common dtype of the
+        whole table (see _write_rows).
+        :param left: frame the source is joined to, its column names are read too (suffixes of same named columns)
+        :param format: see _formats.source_format
+        """
+        cache = SourceFileCache()
+        columns = self._read_columns(left)
+        if columns is None:
+            return cache.read(file, delimiter, format=format)
+        # column types of the delta mode must not depend on the values read
+        compact = () if self.delta is not None else columns - referenced_columns(self.config)[1]
+        frame = cache.read(file, delimiter, columns, compact, format)
+        if len(frame.columns) < len(cache.header(file, delimiter, format)) and not has_string_columns(frame.dtypes) \
+                and (left is None or not has_string_columns(left.dtypes)):
+            frame = cache.read(file, delimiter, None, compact, format)
+        return frame
+
+    def _read_columns(self, left: pd.DataFrame = None):
+        if not self._option("compact", require=False, assert_type=bool, default=True):
+            return None
+        columns = referenced_columns(self.config)[0]
+        return columns if left is None else columns | set(left.columns)
+
+    def _open_chunks(self, chunk_size):
+        """
+        Source reader yielding chunks of rows, of the columns the configuration refers to (see _read_source)
+        """
+        columns = self._read_columns()
+        if columns is not None:
+            header = SourceFileCache().header(self.input_file, self.input_delimiter, self.input_format)
+            columns = [name for name in header if name in columns]
+            columns = columns if len(columns) < len(header) else None
+        if self.input_format != "csv":
+            chunks = TableChunks(self.input_file, self.input_format, chunk_size, columns)
+            if columns is not None and not has_string_columns(chunks.dtypes.values()):
+                chunks = TableChunks(self.input_file, self.input_format, chunk_size)
+            return chunks
+        dtypes = self._stream_dtypes(chunk_size, columns)
+        if columns is not None and not has_string_columns(dtypes.values() if dtypes else ()):
+            columns = None
+            dtypes = self._stream_dtypes(chunk_size)
+        return pd.read_csv(self.input_file, delimiter=self.input_delimiter, chunksize=chunk_size, dtype=dtypes,
+                           usecols=columns)
+
+    def _stream_dtypes(self, chunk_size, columns=None):
+        # Column types are inferred per chunk, unify them as if the file was read at once,
+        # so that all chunks format values the same way (e.g. 1.0 once a column has missing values)
+        with pd.read_csv(self.input_file, delimiter=self.input_delimiter, chunksize=chunk_size,
+                         usecols=columns) as chunks:
+            heads = [chunk.iloc[:0] for chunk in chunks]
+        return pd.concat(heads).dtypes.to_dict() if heads else None
+
+    def _requires_full_table(self):
+        """
+        :return: why chunks of rows would not give the rows of the whole table, None if the source can be streamed
+        """
+        if len(self._rules("group")) > 0:
+            return "'group' needs the whole table"
+        for join in self._rules("join"):
+            how = join.get("how", "inner")
+            if how in ("right", "outer"):
+                return f"'{how}' join adds rows of {join.get('file')} without a match once for the whole table"
+            if how == "left" and self._has_nullable_columns(join):
+                return f"rows without a match of the 'left' join turn integer / boolean columns of " \
+                       f"{join.get('file')} into floats / objects in the whole table"
+        return None
+
+    def _has_nullable_columns(self, join: dict):
+        # integer and boolean columns change their type once a row has no match, the row may be in another chunk
+        try:
+            file = self._option("file", source=join, assert_type=str)
+            path = f"{self.input_prefix}{file}"
+            delimiter = self._option("delimiter", source=join, default=self.input_delimiter, require=False)
+            other_input = self._read_source(path, delimiter, format=self._source_format(path, join))
+        except (KeyError, ValueError, OSError):
+            # reported by the join
+            return False
+        return any(pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype)
+                   for dtype in other_input.dtypes)
+
+    def _rules(self, task: str):
+        """
+        Specs of the preprocessing rules of the given task (filter, join, group...) in the configuration
+        """
+        return get_rules(self.config, task)
+
+    def _preprocess_input(self):
+        if self.plan is None:
+            self.plan = plan_steps(self._preprocess_steps(), list(flatten_recursive_array(self.source_columns_in)),
+                                   lambda name: is_pure(self._read_func(name)), self._joined_columns)
+        steps = self.plan
+        if self._engine() == "duckdb":
+            steps = self._run_sql(steps)
+        for step in steps:
+            if step.task == "filter":
+                self._run_rule(step.name, self._filter_input, step.specs)
+            elif step.task == "join":
+                self._run_rule(step.name, self._join_input, step.specs, step.optional)
+            elif step.task == "group":
+                self._run_rule(step.name, self._group_input, step.specs[0])
             else:
-                self._join_input()
-                self._group_input()
-                self._create_columns()
-        return self.required_colmns
+                self._run_rule(step.name, self._create_columns, step.specs, step.optional)
+
+    def _engine(self):
+        engine = self._option("engine", require=False, assert_type=str, default=self.engine)
+        if engine not in ENGINES:
+            raise ValueError(f"Unsupported engine '{engine}', use one of {ENGINES}!")
+        return engine
+
+    def _run_sql(self, steps: list):
+        """
+        Runs the leading preprocessing steps DuckDB can run in one query (engine: duckdb), see SqlQuery
+        :return: steps left to run in pandas
+        """
+        query = SqlQuery(self.input)
+        count = 0
+        while count < len(steps) and self._compile_step(query, steps[count]):
+            count += 1
+        if query.steps == 0:
+            return steps[count:]
+        try:
+            with Profiler().rule(f"duckdb {', '.join(step.name for step in steps[:count])}", self):
+                self.input = query.run(TemporaryFilesDirectory(None).path)
+        except QueryFailed as e:
+            print(f"WARN: DuckDB could not preprocess {self.input_file}: {e} - using pandas.")
+            return steps
+        return steps[count:]
+
+    def _compile_step(self, query: SqlQuery, step: Step):
+        """
+        Adds the step to the query
+        :return: False if the step runs in pandas (and so do the following ones)
+        """
+        if step.task == "filter":
+            return query.filter(step.specs)
+        if step.task == "group":
+            # the delta mode selects groups in pandas
+            return not self.collect_group_keys and self.delta_keys is None \
+                and query.group(step.specs[0], self._read_func)
+        if step.task != "join":
+            return False
+        join = step.specs[0]
+        if self._option("max_rows", source=join, require=False) is not None:
+            return False
+        try:
+            file = self._option("file", source=join, assert_type=str)
+            delim = self._option("delimiter", source=join, default=self.input_delimiter, require=False)
+            path = f"{self.input_prefix}{file}"
+            format = self._source_format(path, join)
+            other_input = self._read_source(path, delim, left=query.schema, format=format)
+            how = self._option("how", source=join, require=False, assert_type=str, default="inner")
+            left_on = self._option("left_on", source=join)
+            right_on = self._option("right_on", source=join)
+        except (KeyError, ValueError, OSError):
+            # reported by the pandas join
+            return False
+        left_keys = [left_on] if isinstance(left_on, str) else left_on
+        right_keys = [right_on] if isinstance(right_on, str) else right_on
+        if step.optional and how == "left" and isinstance(right_keys, list) \
+                and all(key in other_input.columns for key in right_keys) \
+                and all(key in query.schema.columns for key in left_keys) \
+                and SourceFileCache().key_index(path, delim, right_keys, other_input, format).unique \
+                and self._keeps_rows(query.schema, other_input, left_keys, right_keys):
+            return True
+        return query.join(other_input, how, left_keys, right_keys, (
+            self._option("lsuffix", source=join, require=False),
+            self._option("rsuffix", source=join, require=False)
+        ))
+
+    def _preprocess_steps(self):
+        """
+        Preprocessing steps in the configured order: the 'preprocess' list, or else the filter, join, group
+        and create keys (join last with 'join_last')
+        """
+        rules = self._option("preprocess", require=False, assert_type=list)
+        if rules is not None:
+            steps = []
+            for index, rule in enumerate(rules):
+                kind = self._option("task", source=rule, assert_type=str)
+                if not kind:
+                    raise SyntaxError("Preprocessing: kind is required value!")
+                if kind not in ("create", "join", "filter", "group"):
+                    raise SyntaxError(f"Preprocessing: unsupported value '{kind}'!")
+                steps.append(Step(kind, [rule], [index]))
+            return steps
+
+        # todo: consider flexible order by definition order
+        if self._option("join_last", require=False):
+            tasks = ["filter", "group", "create", "join"]
+        else:
+            tasks = ["filter", "join", "group", "create"]
+        steps = []
+        for task in tasks:
+            spec = self._option(task, require=False, assert_type=dict if task == "group" else list)
+            if spec is None or (task != "group" and not spec):
+                continue
+            if task == "filter":
+                steps.append(Step(task, spec))
+            elif task == "group":
+                steps.append(Step(task, [spec]))
+            else:
+                steps.extend(Step(task, [item]) for item in spec)
+        return steps
+
+    def _joined_columns(self, join: dict):
+        """
+        Column names of the file of a join spec, None if it cannot be read
+        """
+        file = join.get("file")
+        if not isinstance(file, str):
+            return None
+        path = f"{self.input_prefix}{file}"
+        delimiter = join.get("delimiter", self.input_delimiter)
+        try:
+            return SourceFileCache().header(path, delimiter, self._source_format(path, join))
+        except (OSError, ValueError):
+            return None
+
+    def _run_rule(self, name: str, step, *args):
+        # measured by the profiler (--profile)
+        with Profiler().rule(name, self):
+            step(*args)
 
     def _option(self, name: str, source: dict=None, require: bool=True, default: any=None, assert_type: any=None):
         return read_opt(name, source=self.config if source is None else source, require=require,
                         default=default, assert_type=assert_type)
         
-    def _preprocess(self):
-        rules = self._option("preprocess", require=False, assert_type=list)
-        if rules is None:
-            return False
-        for rule in rules:
-            kind = self._option("task", source=rule, assert_type=str)
-            if not kind:
-                raise SyntaxError("Preprocessing: kind is required value!")
-            if kind == "create":
-                self._create_columns([rule])
-            elif kind == "join":
-                self._join_input([rule])
-            elif kind == "filter":
-                self._filter_input([rule])
-            elif kind == "group":
-                # did not support list of elements to perform
-                self._group_input(rule)
-            else:
-                raise SyntaxError(f"Preprocessing: unsupported value '{kind}'!")
-        return True
-        
-    def _create_columns(self, spec: dict = None):
+    def _create_columns(self, spec: dict = None, optional: bool = False):
+        """
+        :param optional: nothing uses the created columns (see _plan), creation is skipped if the rows keep
+            their dtype (a string column other than the created one)
+        """
         create = spec if spec else self._option("create", require=False, assert_type=list)
         if create:
             for new_col in create:
@@ -178,17 +875,24 @@ class CbioCSVWriter:
                 columns = new_col.get("source_id", new_col.get("source_ids"))  # fetch id or ids 
 
                 if function is not None and column_name is not None:
-                    fn = self._read_func(function["name"])
+                    fn = self._use_func(function["name"])
                     if fn is not None:
                         args = {**function}
                         del args["name"]
                     else:
                         print(f"WARN: invalid function {function['name']} does not exist!")
                         continue
+                    if optional and has_string_columns(self.input.dtypes[self.input.columns != column_name]):
+                        continue
                             
                     try:
                         if type(columns) == list or type(columns) == str:
-                            self.input[column_name] = self.input.apply(lambda row: fn(row[columns], **args), axis=1)
+                            batch_fn = get_batch_function(fn)
+                            if batch_fn is not None:
+                                result = batch_fn(self._row_values(columns), **args)
+                                self.input[column_name] = batch_result(result, self.input.index)
+                            else:
+                                self.input[column_name] = self.input.apply(lambda row: fn(row[columns], **args), axis=1)
                         else:
                             print(f"WARN: 'source_id' or 'source_ids' valid values are required! Ignoring creation of {new_col}...")
                     except KeyError as e:
@@ -196,60 +900,100 @@ class CbioCSVWriter:
                 else:
                     print(f"WARN: 'function', 'new_column' keys for creation are reguired! Ignoring creation of {new_col}...")
 
-    def _join_input(self, spec = None):
+    def _join_input(self, spec = None, optional: bool = False):
+        """
+        :param optional: nothing uses the joined columns (see _plan), a 'left' join is skipped if it keeps
+            the rows as they are: unique keys of the joined file, no same named columns and a string column
+            (the rows keep their dtype)
+        """
         joins = spec if spec else self._option("join", require=False, assert_type=list)
         if joins:
             for join in joins:
                 try:
                     file = self._option("file", source=join, assert_type=str)
                     delim = self._option("delimiter", source=join, default=self.input_delimiter, require=False)
-                    other_input = pd.read_csv(f"{self.input_prefix}{file}", delimiter=delim)
-                    self.input = self.input.merge(
-                        other_input,
-                        how=self._option("how", source=join, require=False, assert_type=str, default="inner"),
-                        left_on=self._option("left_on", source=join),
-                        right_on=self._option("right_on", source=join),
-                        suffixes=(
-                            self._option("lsuffix", source=join, require=False),
-                            self._option("rsuffix", source=join, require=False)
+                    path = f"{self.input_prefix}{file}"
+                    format = self._source_format(path, join)
+                    other_input = self._read_source(path, delim, left=self.input, format=format)
+                    how = self._option("how", source=join, require=False, assert_type=str, default="inner")
+                    left_on = self._option("left_on", source=join)
+                    right_on = self._option("right_on", source=join)
+                    left_keys = [left_on] if isinstance(left_on, str) else left_on
+                    right_keys = [right_on] if isinstance(right_on, str) else right_on
+                    joined = None
+                    if how in ("left", "right", "inner", "outer") and isinstance(left_keys, list) \
+                            and isinstance(right_keys, list) and len(left_keys) == len(right_keys):
+                        index = SourceFileCache().key_index(path, delim, right_keys, other_input, format)
+                        positions = index.positions(self.input, left_keys)
+                        self._check_join_rows(join, file, index.expected_rows(positions, how))
+                        if optional and how == "left" and index.unique \
+                                and self._keeps_rows(self.input, other_input, left_keys, right_keys):
+                            continue
+                        joined = lookup_join(self.input, other_input, index, how, left_keys, positions)
+                    if joined is None:
+                        joined = self.input.merge(
+                            other_input,
+                            how=how,
+                            left_on=left_on,
+                            right_on=right_on,
+                            suffixes=(
+                                self._option("lsuffix", source=join, require=False),
+                                self._option("rsuffix", source=join, require=False)
+                            )
                         )
-                    )
+                    self.input = joined
                 except KeyError as e:
                     raise ValueError(f"Join: spec {join}: error {e}! Available keys:\n left {list(self.input.keys())} \n right {list(other_input.keys())}") from e
                 except FileNotFoundError as e:
                     raise ValueError(f"Join: spec {join}: {e}!") from e
 
+    @staticmethod
+    def _keeps_rows(left: pd.DataFrame, other_input: pd.DataFrame, left_keys: list, right_keys: list):
+        # skipped joins must not hide merge errors (keys of different types) nor the suffixes of same named columns
+        same = {key for key, other in zip(left_keys, right_keys) if key == other}
+        return has_string_columns(left.dtypes) \
+            and all(left[key].dtype == other_input[other].dtype for key, other in zip(left_keys, right_keys)) \
+            and not any(name in left.columns for name in other_input.columns if name not in same)
+
+    def _check_join_rows(self, join: dict, file: str, expected):
+        """
+        Reports joins with keys repeated on both sides (many-to-many) before they are performed,
+        fails if the join would produce more rows than its 'max_rows'
+        """
+        rows, many_to_many = expected
+        if many_to_many and file not in self.reported_joins:
+            self.reported_joins.add(file)
+            print(f"WARN: join of {file}: keys repeat on both sides (many-to-many), "
+                  f"{len(self.input)} rows become {rows} rows.")
+        max_rows = self._option("max_rows", source=join, require=False, assert_type=int)
+        if max_rows is not None and rows > max_rows:
+            raise ValueError(f"Join: spec {join}: the join would produce {rows} rows, more than max_rows {max_rows}!")
+
     def _filter_input(self, spec = None):
         filters = spec if spec else self._option("filter", require=False, assert_type=list)
         if filters:
+            # Filters are combined into a single mask, the input is sliced only once
+            mask = np.ones(len(self.input), dtype=bool)
             for filter_spec in filters:
                 try:
                     rule = self._option("one_of", source=filter_spec, require=False, assert_type=list)
                     if rule:
                         column = self._option("source_id", source=filter_spec, assert_type=str)
-                        self.input = self.input.loc[self.input[column].isin(rule)]
+                        mask &= self.input[column].isin(rule).to_numpy()
                         continue
                     rule = self._option("regex", source=filter_spec, require=False, assert_type=str)
                     if rule:
                         column = self._option("source_id", source=filter_spec, assert_type=str)
-                        self.input = self.input.loc[
-                            self.input[column].apply(lambda x: bool(re.search(rule, x) if isinstance(x, str) else None))]
+                        mask &= regex_mask(self.input[column], re.compile(rule))
                         continue
                     rule = self._option("operator", source=filter_spec, require=False, assert_type=dict)
                     if rule:
                         column = self._option("source_id", source=filter_spec, assert_type=str)
                         command = self._option("command", source=rule, assert_type=str)
                         arg = self._option("arg", source=rule)
-                        command = self._option(command, source={
-                            ">": lambda y: y > arg,
-                            ">=": lambda y: y >= arg,
-                            "<": lambda y: y < arg,
-                            "<=": lambda y: y <= arg,
-                            "==": lambda y: y == arg,
-                            "!=": lambda y: y != arg
-                        })
+                        command = self._option(command, source=FILTER_OPERATORS)
                         # todo add support for arbitrary function
-                        self.input = self.input.loc[self.input[column].apply(command)]
+                        mask &= command(self.input[column], arg).to_numpy(dtype=bool)
                         continue
                     rule = self._option("function", source=filter_spec, require=False, assert_type=dict)
                     if (rule):
@@ -259,20 +1003,33 @@ class CbioCSVWriter:
                         if cols is None:
                             raise Exception("Filter: source_id or source_ids ust be defined as a filter argument!")
                         
-                        fn = self._read_func(rule.get("name"))
+                        fn = self._use_func(rule.get("name"))
                         if fn is None:
                             raise Exception("Filter: function.name must be a valid function name!")
                         else:
                             args = {**rule}
                             del args["name"]
-                            if type(cols) == str:
+                            # Functions might keep state (e.g. is_unique): call them only for rows that passed so far
+                            positions = np.flatnonzero(mask)
+                            if len(positions) == 0:
+                                continue
+                            selected = self.input[cols].iloc[positions]
+                            batch_fn = get_batch_function(fn)
+                            if batch_fn is not None:
+                                if type(cols) != str:
+                                    selected = self._row_values(cols).iloc[positions]
+                                result = batch_result(batch_fn(selected, **args), selected.index)
+                            elif type(cols) == str:
                                 # String needs no axis - one col
-                                self.input = self.input.loc[self.input[cols].apply(lambda row: fn(row, **args))]
+                                result = selected.apply(lambda row: fn(row, **args))
                             else:
-                                self.input = self.input.loc[self.input[cols].apply(lambda row: fn(row, **args), axis=1)]
+                                result = selected.apply(lambda row: fn(row, **args), axis=1)
+                            mask[positions] = np.asarray(result, dtype=bool)
                         continue
                 except KeyError as e:
                     raise ValueError(f"Filter: spec {filter_spec}: error {e}!") from e
+            if not mask.all():
+                self.input = self.input.loc[mask]
 
     def _group_input(self, spec = None):
         group_rules = spec if spec else self._option("group", require=False, assert_type=dict)
@@ -291,24 +1048,68 @@ class CbioCSVWriter:
 
                     function = sel.get("function", None)
                     if function is not None:
-                        fn = self._read_func(function["name"])
+                        fn = self._use_func(function["name"])
                         if fn is None:
                             rules[key] = pd.NamedAgg(column=out_key, aggfunc="min")
                         else:
                             args = {**function}
                             del args["name"]
-                            rules[key] = pd.NamedAgg(column=out_key, aggfunc=lambda x: fn(x, **args))
+                            grouped_fn = get_grouped_function(fn)
+                            if grouped_fn is not None:
+                                rules[key] = GroupedAgg(out_key, grouped_fn, args)
+                            else:
+                                # fn and args are bound now, the lambda is called after the loop
+                                rules[key] = pd.NamedAgg(column=out_key, aggfunc=lambda x, fn=fn, args=args: fn(x, **args))
                         continue
 
                     value = self._option("value", source=sel, require=False)
-                    if value is not None:
-                        rules[key] = pd.NamedAgg(column=out_key, aggfunc=lambda x: value)
+                    if isinstance(value, (str, int, float, bool)):
+                        rules[key] = GroupedAgg(out_key, _constant_grouped, {"value": value})
+                    elif value is not None:
+                        rules[key] = pd.NamedAgg(column=out_key, aggfunc=lambda x, value=value: value)
             groups = self._option("by", source=group_rules)
+            if self.collect_group_keys:
+                raise GroupKeysCollected(group_keys(self.input, groups))
+            if self.delta_keys is not None:
+                # Delta mode: only groups with new rows are aggregated again
+                self.input = self.input.loc[pd.Series(group_keys(self.input, groups)).isin(self.delta_keys).to_numpy()]
             if has_rules:
-                self.input = self.input.groupby(groups, as_index=False).agg(**rules)
+                self.input = self._aggregate(groups, rules)
             else:
                 self.input = self.input[groups].drop_duplicates().reset_index(drop=True)
 
+    def _aggregate(self, groups, rules: dict):
+        """
+        Aggregates the groups (sorted by their keys, rows with missing keys are dropped): GroupedAgg rules for all
+        groups at once, pd.NamedAgg rules group by group
+        """
+        keys = [groups] if isinstance(groups, str) else groups
+        grouped = {key: rule for key, rule in rules.items() if isinstance(rule, GroupedAgg)}
+        codes = self.input.groupby(groups, observed=False).ngroup()
+        present = codes.notna().to_numpy()
+        codes = codes.to_numpy()[present].astype(np.intp)
+        count = int(codes.max()) + 1 if len(codes) else 0
+        # categorical keys have groups of unused categories too, without groups pandas decides the column types
+        if count == 0 or any(isinstance(self.input[key].dtype, pd.CategoricalDtype) for key in keys):
+            grouped = {}
+            rules = {key: rule.named() if isinstance(rule, GroupedAgg) else rule for key, rule in rules.items()}
+        named = {key: rule for key, rule in rules.items() if key not in grouped}
+        if named:
+            result = self.input.groupby(groups, as_index=False, observed=False).agg(**named)
+            if not grouped:
+                return result
+        else:
+            _, first = np.unique(codes, return_index=True)
+            result = self.input.loc[present, keys].iloc[first].reset_index(drop=True)
+        columns = {key: result[key] for key in keys}
+        for key, rule in rules.items():
+            if key in grouped:
+                values = self.input.loc[present, rule.column].reset_index(drop=True)
+                columns[key] = pd.Series(rule.fn(values, codes, count, **rule.args), index=range(count))
+            else:
+                columns[key] = result[key]
+        return pd.DataFrame(columns)
+
     def _write_type(self, value):
         value = value.upper()
         if value not in ["STRING", "NUMBER", "BOOLEAN"]:
@@ -318,40 +1119,49 @@ class CbioCSVWriter:
     def _require_init(self):
         if not self.config:
             raise SyntaxError("prepare_headers must be called first!")
-        if not isinstance(self.input, pd.DataFrame):
+        if not isinstance(self.input, pd.DataFrame) and self.input_chunks is None:
             raise SyntaxError("with_input must be called first!")
 
     def write_comment_ids(self, output):
         self._require_init()
-        print("#", end='', file=output)
         try:
-            print(*[item["name"] for item in self.config["columns"]], sep='\t', file=output)
+            self._write_line(output, [item["name"] for item in self.config["columns"]], "#")
         except KeyError as e:
             raise ValueError(f"Could not find 'name' property for {get_caller(2)} entries: missing key? check your study YAML!")
 
     def write_comment_descriptions(self, output):
         self._require_init()
-        print("#", end='', file=output)
-        print(*[item.get("description", item["name"]) for item in self.config["columns"]], sep='\t', file=output)
+        self._write_line(output, [item.get("description", item["name"]) for item in self.config["columns"]], "#")
 
     def write_comment_data_types(self, output):
         self._require_init()
-        print("#", end='', file=output)
-        print(*[self._write_type(item.get("data_type", "STRING")) for item in self.config["columns"]], sep='\t', file=output)
+        self._write_line(output, [self._write_type(item.get("data_type", "STRING")) for item in self.config["columns"]], "#")
 
     def write_comment_priority(self, output):
         self._require_init()
-        print("#", end='', file=output)
-        print(*[item.get("priority", "1") for item in self.config["columns"]], sep='\t', file=output)
+        self._write_line(output, [item.get("priority", "1") for item in self.config["columns"]], "#")
 
     def write_header(self, output):
         self._require_init()
-        print(*self.required_colmns, sep='\t', file=output)
+        self._write_line(output, self.required_colmns)
 
-    def _test_value(self, key, value):
-        test = self.required_value_map.get(key, None)
-        if test is not None and value not in test:
-            raise ValueError(f"Value {value} is not allowed for column {key}!")
+    @staticmethod
+    def _write_line(output, values, prefix=""):
+        output.write(prefix + "\t".join(str(value) for value in values) + "\n")
+
+    def _validate_allowed_values(self, plan):
+        """
+        Reports source values (or the constant value) of the column not in its allowed values set
+        (see with_allowed_values_set)
+        """
+        test = self.required_value_map[plan.out_key]
+        if isinstance(plan.inputs, pd.DataFrame):
+            mask, values = [value not in test for value in plan.rows()], None
+        else:
+            values = plan.inputs
+            mask = ~pd.Series(values, dtype=object).isin(test).to_numpy()
+        self.violations.add(plan.out_key, f"values not allowed (allowed: {', '.join(str(value) for value in test)})",
+                            mask, self.input.index, values)
 
     def _get_constant(self, item):
         value = item["value"]
@@ -366,90 +1176,117 @@ class CbioCSVWriter:
         """
         Retrieves function either from a module path, or a global function name (e.g. max)
         """
-        try:
-            path = fnpath.rsplit(".", maxsplit=1)
-            if len(path) > 1:
-                m = import_module(path[0])
-                return getattr(m, path[1])
-            else:
-                fn = globals().get(path[0])
-                if callable(fn):
-                    return fn
-        
-            if self.fn_module is None:
-                definition_path = FunctionDefinitionFile(None).path
-                if definition_path is None:
-                    return None
-                import importlib
-                print(f"Importing functions definition file: {definition_path}")
-                spec = importlib.util.spec_from_file_location("cbio.functions", definition_path)
-                self.fn_module = importlib.util.module_from_spec(spec)
-                
-                # Update functions file with default functions definitions
-                default_functions = None
-                original_sys_path = sys.path.copy()
-                try:
-                    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__))) 
-                    default_functions = importlib.import_module("default_functions")
-                finally:
-                    sys.path = original_sys_path
-
-                spec.loader.exec_module(self.fn_module)
-                # Only now update module with new content
-                self.fn_module.__dict__.update(default_functions.__dict__)
-                
-                seed_fn = getattr(self.fn_module, "set_seed")
-                seed_fn(SeedValue(None).value)
-                
-            return getattr(self.fn_module, path[0]) if len(path) > 0 else None
-        except Exception as e:
-            raise ValueError(f"Invalid function provided or syntax error in your file: {fnpath.rsplit('.', maxsplit=1)} ({FunctionDefinitionFile(None).path})") from e
-        
-    def _get_value(self, spec, value, na_value=""):
+        return FunctionRegistry().get(fnpath)
+
+    def _use_func(self, fnpath):
+        """
+        Retrieves a function a preprocessing rule calls right away: the first function of the functions
+        definition file the writer uses seeds random numbers (see _seed)
+        """
+        fn = self._read_func(fnpath)
+        if fn is not None and FunctionRegistry().from_definition_file(fnpath):
+            self._seed()
+        return fn
+
+    def _seed(self):
+        """
+        Seeds random numbers once per writer, when it uses the first function of the functions definition file:
+        random numbers drawn before (e.g. random_simple_id in the preceding columns of the first row) continue
+        the sequence seeded by the study
+        """
+        if not self.seeded:
+            self.seeded = True
+            FunctionRegistry().seed()
+
+    def _compile_column(self, item):
         """
-        Executes function retrieved by a function spec block:
+        Compiles a column definition into a ColumnPlan: the function spec block, conversion and
+        source lookup are resolved once instead of once per cell:
         function:
             name: name
             ... custom args ...
         """
+        out_key = item["id"].upper()
+        spec = self.cols_map[out_key]
         function = self._option("function", source=spec, require=False, assert_type=dict)
         fn = self._read_func(function["name"]) if function is not None else None
-
+        args = {}
+        seeds = False
         if fn is not None:
             args = {**function}
             del args["name"]
-            value = fn(value, **args)
-
-        if pd.isna(value):
-            return na_value
-        
+            seeds = FunctionRegistry().from_definition_file(function["name"])
         conversion = self._option("convert", source=spec, require=False, assert_type=str)
-        if conversion:
-            try:
-                value = self._convert_value(value, conversion)
-            except Exception as e:
-                print("WARNING: failed to convert value", value, "to type", conversion, "using '", na_value ,"' value.")
-                return na_value
-        value = self._convert_value(value, 'str')
-        return value
+
+        # Pure functions are memoized unless disabled, 'memoize: true' opts in any other function (or conversion)
+        memoize = self._option("memoize", source=spec, require=False, assert_type=bool)
+        pure = fn is not None and is_pure(fn)
+        stateless = pure or (fn is not None and memoize is True)
+        memoize = pure if memoize is None else memoize
+
+        if "value" in item:
+            return ColumnPlan(out_key, fn=fn, args=args, conversion=conversion, constant=self._get_constant(item),
+                              stateless=stateless, memoize=memoize, seeds=seeds, convert_value=self._convert_value)
+        required = item.get('required')
+        source = get_source_csv_header(item)
+        return ColumnPlan(out_key, source=source, fn=fn, args=args, conversion=conversion,
+                          required=out_key in self.guard_columns and (required is None or required),
+                          stateless=stateless, memoize=memoize and not isinstance(source, list), seeds=seeds,
+                          convert_value=self._convert_value)
+
+    def _column_values(self, source, row_dtype):
+        """
+        Reads source column values as iterrows() would see them: cells are coerced to the common
+        row dtype, multi-column sources are kept as a pd.DataFrame (functions receive its rows).
+        """
+        if isinstance(source, list):
+            return pd.DataFrame(self.input[source].to_numpy(dtype=row_dtype), index=self.input.index, columns=source)
+        return self.input[source].to_numpy(dtype=row_dtype)
+
+    def _row_values(self, columns):
+        """
+        Source values as row-wise evaluation sees them: coerced to the common dtype of the input rows
+        """
+        return self.input[columns].astype(self.input.iloc[:0].values.dtype)
 
     def _convert_value(self, value, to_type):
-        type_map = {
-            'int': int,
-            'float': float,
-            'str': str,
-            'bool': bool,
-            'datetime': pd.to_datetime
-        }
-        if to_type in type_map:
+        if to_type in CONVERSIONS:
             try:
-                return type_map[to_type](value)
+                return CONVERSIONS[to_type](value)
             except ValueError:
                 raise ValueError(f"Could not convert '{value}' to {to_type}!")
         raise ValueError(f"Unsupported type: {to_type}")
 
+    @_copy_on_write
     def write_data(self, output):
-        self._require_init()
+        with Profiler().rule("write", self, count_out=lambda writer: writer.rows_written):
+            self._require_init()
+            self.memoized_values = self.memoized_hits = 0
+            self.rows_written = 0
+            self.violations = ValidationReport()
+            if self.delta is not None and self.group_by is not None and self.written_keys is None:
+                # group keys of the output rows, groups with new rows are replaced in the delta mode
+                self.written_keys = self.delta.load_keys() if self.appending else []
+            if self.input_chunks is None:
+                if not self._nothing_to_append():
+                    self._write_rows(output)
+            else:
+                with self.input_chunks as chunks:
+                    for chunk in chunks:
+                        if self.delta is not None:
+                            self.delta.processed(chunk.dtypes, len(chunk))
+                        self.input = chunk
+                        self._preprocess_input()
+                        self._write_rows(output)
+            if self.violations:
+                raise ValueError(self.violations.message(self.input_file or "input data"))
+            if self.delta is not None:
+                self.delta.save(self.written_keys)
+            if self.memoized_values > 0:
+                print(f"Column cache: {self.memoized_hits} hits of {self.memoized_values} values "
+                      f"({self.memoized_hits / self.memoized_values:.1%}).")
+
+    def _write_rows(self, output):
         header = list(self.input.columns)
 
         header_diff = set(flatten_recursive_array(self.source_columns_in)) - set(header)
@@ -460,111 +1297,176 @@ class CbioCSVWriter:
         Existing columns: {header}"
 
         self.input = self.input.replace({None: np.nan})
-        for col in self.guard_columns:
-            require_header(self.required_colmns, col, 2)
-
-        for index, row in self.input.iterrows():
-            values = []
-            for item in self.config["columns"]:
-                output_value = None
-                out_key = item["id"].upper()
-
-                if "value" in item:
-                    value = self._get_constant(item)
-                    self._test_value(out_key, value)
-                    output_value = self._get_value(self.cols_map[out_key], value)
-                else:
-                    source_header = get_source_csv_header(item)
-                    value = row[source_header]
-                    self._test_value(out_key, value)
-                    output_value = self._get_value(self.cols_map[out_key], value)
-                    if out_key in self.guard_columns:
-                        required = item.get('required')
-                        if (required is None or required) and (output_value is None or output_value == ""):
-                            raise ValueError(f"Value for {out_key} cannot be empty - it is a required property (one of {self.guard_columns})! To bypass this, use 'required: false' in the column definition. Data row {row}.")
-                
-                values.append(output_value)
-
-            print(*values, sep='\t', file=output)
-
-
-def require_header(llist, name, caller_depth=1):
-    if not name in llist:
-        # Parse problem name from the caller script name: sample.py --> Sample
-        raise ValueError(f"{get_caller(caller_depth + 1)} columns MUST include {name} column ID!")
 
+        size = len(self.input)
+        # dtype of a row yielded by iterrows(), values are coerced to it (e.g. ints to floats in numeric tables)
+        row_dtype = self.input.iloc[:0].values.dtype
+        plans = [self._compile_column(item) for item in self.config["columns"]]
+        for plan in plans:
+            if plan.source is None:
+                plan.inputs = [plan.constant] * size
+            else:
+                plan.inputs = self._column_values(plan.source, row_dtype)
+            if plan.out_key in self.required_value_map:
+                self._validate_allowed_values(plan)
+        # Columns without a function are checked before any function is called (e.g. anonymize stores new IDs),
+        # once any check failed, no functions are called and no rows are written - the following chunks are
+        # only validated
+        columns = [self._render_column(plan, size) if plan.fn is None else None for plan in plans]
+        if self.violations:
+            return
+
+        # Functions might share state (e.g. anonymize id counters), if more of them are used
+        # they must be called in the original, row-by-row order
+        fn_plans = [plan for plan in plans if plan.fn is not None]
+        ordered_plans = [plan for plan in fn_plans if not plan.stateless]
+        # The first column calling a function of the functions definition file seeds random numbers (see _seed)
+        # in the first row, once the functions of the preceding columns were called
+        seed_at = None
+        if not self.seeded and size > 0:
+            seed_at = next((position for position, plan in enumerate(plans) if plan.seeds), None)
+        early = [plan for position, plan in enumerate(plans) if plan in ordered_plans and position < seed_at] \
+            if seed_at is not None else []
+        if seed_at is not None and not early:
+            self._seed()
+        if len(ordered_plans) > 1 or early:
+            results = [[] for _ in ordered_plans]
+            for row in zip(*[plan.rows() for plan in ordered_plans]):
+                for plan, value, result in zip(ordered_plans, row, results):
+                    if early and plan not in early:
+                        self._seed()
+                        early = []
+                    result.append(plan.fn(value, **plan.args))
+                if early:
+                    self._seed()
+                    early = []
+            for plan, result in zip(ordered_plans, results):
+                plan.inputs = result
+            fn_plans = [plan for plan in fn_plans if plan.stateless]
+        for plan in fn_plans:
+            if not plan.memoize:
+                plan.inputs = plan.apply(plan.inputs, self.input.index)
+
+        for position, plan in enumerate(plans):
+            if plan.fn is not None:
+                columns[position] = self._render_column(plan, size)
+        if self.violations:
+            return
+
+        if self.written_keys is not None:
+            by = [self.group_by] if isinstance(self.group_by, str) else self.group_by
+            self.written_keys = self.written_keys + group_keys(self.input, by) \
+                if all(column in self.input for column in by) else None
+
+        # Write-ahead: anonymized IDs must be stored before any output refers to them
+        flush_anonymization_data()
+
+        rows = zip(*columns) if columns else [()] * size
+        self.rows_written += write_lines(output, rows)
+
+    def _render_column(self, plan, size):
+        """
+        Output strings of the column (functions applied), empty values of required columns are reported
+        """
+        if plan.memoize:
+            values, distinct = plan.render_distinct()
+            self.memoized_values += size
+            self.memoized_hits += size - distinct
+        else:
+            values = plan.render(plan.inputs)
+        if plan.required:
+            self.violations.add(plan.out_key, f"empty values (a required property, one of {self.guard_columns}: "
+                                f"use 'required: false' in the column definition to bypass)", np.asarray(values, dtype=object) == "", self.input.index)
+        return values
+
+
+class ColumnPlan:
+    """
+    Output column compiled by CbioCSVWriter: resolved function and arguments, conversion and NA policy.
+    Evaluated over whole columns (value lists) instead of cell by cell.
+    """
+    def __init__(self, out_key: str, source=None, fn=None, args: dict = None, conversion: str = None,
+                 constant=None, required: bool = False, stateless: bool = False, memoize: bool = False,
+                 seeds: bool = False, na_value: str = "", convert_value=None):
+        self.out_key = out_key
+        self.source = source
+        self.fn = fn
+        self.batch = get_batch_function(fn) if fn is not None else None
+        self.stateless = stateless
+        self.memoize = memoize
+        # fn is a function of the functions definition file, see CbioCSVWriter._seed
+        self.seeds = seeds
+        self.args = args or {}
+        self.conversion = conversion
+        self.constant = constant
+        self.required = required
+        self.na_value = na_value
+        self.convert_value = convert_value
+        self.inputs = None
+
+    def rows(self):
+        """
+        Input values one by one, rows (pd.Series) of multi-column sources
+        """
+        if isinstance(self.inputs, pd.DataFrame):
+            return (row for _, row in self.inputs.iterrows())
+        return self.inputs
+
+    def apply(self, values, index):
+        fn, args = self.fn, self.args
+        if fn is None:
+            return values
+        if self.batch is not None:
+            if not isinstance(values, pd.DataFrame):
+                values = pd.Series(values, index=index, dtype=None if isinstance(values, np.ndarray) else object)
+            return batch_result(self.batch(values, **args), index, dtype=object).to_numpy()
+        if isinstance(values, pd.DataFrame):
+            return [fn(row, **args) for _, row in values.iterrows()]
+        return [fn(value, **args) for value in values]
+
+    def render(self, values):
+        """
+        Converts (function-applied) values to output strings, NA values are replaced by na_value
+        """
+        if not isinstance(values, np.ndarray):
+            values = pd.Series(values, dtype=object)
+        na_mask = pd.isna(values)
+        na_mask = na_mask.to_numpy() if isinstance(na_mask, pd.Series) else na_mask
+        na_value = self.na_value
 
-def get_caller(caller_depth=1):
-    import inspect
-    import pathlib
-    frame = inspect.stack()[caller_depth]
-    return pathlib.Path(frame.filename).stem.capitalize()
+        if not self.conversion:
+            if not na_mask.any():
+                return [str(value) for value in values]
+            return [na_value if is_na else str(value) for value, is_na in zip(values, na_mask)]
 
+        conversion, convert_value = self.conversion, self.convert_value
 
-def read_safe_file(inp):
-    if os.path.isfile(inp):
-        with open(inp, 'r') as inp:
-            content = inp.read()
-        return content
-    raise Exception(f"Clinical data file does not exist! {inp}")
+        def convert(value):
+            try:
+                value = convert_value(value, conversion)
+            except Exception as e:
+                print("WARNING: failed to convert value", value, "to type", conversion, "using '", na_value, "' value.")
+                return na_value
+            return str(value)
+        return [na_value if is_na else convert(value) for value, is_na in zip(values, na_mask)]
 
+    def render_distinct(self):
+        """
+        Applies the function and renders the values once per distinct input value, results are mapped back to rows
+        :return: output strings, number of distinct values
+        """
+        codes, uniques = pd.factorize(np.asarray(self.inputs, dtype=None if isinstance(self.inputs, np.ndarray)
+                                                 else object), use_na_sentinel=False)
+        rendered = self.render(self.apply(uniques, pd.RangeIndex(len(uniques))))
+        return np.asarray(rendered, dtype=object)[codes], len(uniques)
 
-def _get_key(key):
-    if ":" in key:
-        return key.split(":")[0]
-    return key
 
+def batch_result(result, index, dtype=None):
+    """
+    Series of batch function results for the given rows, dtype is inferred as for row-wise results if not given
+    """
+    values = result.tolist() if isinstance(result, (pd.Series, np.ndarray)) else list(result)
+    if len(values) != len(index):
+        raise ValueError(f"Batch function returned {len(values)} values for {len(index)} rows!")
+    return pd.Series(values, index=index, dtype=dtype)
 
-def _get_value_or_default(key, data):
-    if ":" in key:
-        key = key.split(":")
-        try:
-            return data[key[0]]
-        except KeyError:
-            return key[1]
-    return read_opt(key, data)
-
-
-def write_meta_file(inp, outp, data, fields=None):
-    content = read_safe_file(inp)
-    fields = fields if fields is not None else data.keys()
-    with open(outp, 'w') as output:
-        output.write(content.format(**{
-            _get_key(key): _get_value_or_default(key, data) for key in fields
-        }))
-
-
-def pick_color(value=None):
-    colors = ['aliceblue', 'antiquewhite', 'aqua', 'aquamarine', 'azure', 'beige', 'bisque', 'black', 'blanchedalmond',
-              'blue', 'blueviolet', 'brown', 'burlywood', 'cadetblue', 'chartreuse', 'chocolate', 'coral',
-              'cornflowerblue', 'cornsilk', 'crimson', 'cyan', 'darkblue', 'darkcyan', 'darkgoldenrod', 'darkgray',
-              'darkgreen', 'darkgrey', 'darkkhaki', 'darkmagenta', 'darkolivegreen', 'darkorange', 'darkorchid',
-              'darkred', 'darksalmon', 'darkseagreen', 'darkslateblue', 'darkslategray', 'darkslategrey',
-              'darkturquoise', 'darkviolet', 'deeppink', 'deepskyblue', 'dimgray', 'dimgrey', 'dodgerblue',
-              'firebrick', 'floralwhite', 'forestgreen', 'fuchsia', 'gainsboro', 'ghostwhite', 'gold', 'goldenrod',
-              'gray', 'green', 'greenyellow', 'grey', 'honeydew', 'hotpink', 'indianred', 'indigo', 'ivory', 'khaki',
-              'lavender', 'lavenderblush', 'lawngreen', 'lemonchiffon', 'lightblue', 'lightcoral', 'lightcyan',
-              'lightgoldenrodyellow', 'lightgray', 'lightgreen', 'lightgrey', 'lightpink', 'lightsalmon',
-              'lightseagreen',
-              'lightskyblue', 'lightslategray', 'lightslategrey', 'lightsteelblue', 'lightyellow', 'lime', 'limegreen',
-              'linen', 'magenta', 'maroon', 'mediumaquamarine', 'mediumblue', 'mediumorchid', 'mediumpurple',
-              'mediumseagreen', 'mediumslateblue', 'mediumspringgreen', 'mediumturquoise', 'mediumvioletred',
-              'midnightblue', 'mintcream', 'mistyrose', 'moccasin', 'navajowhite', 'navy', 'oldlace', 'olive',
-              'olivedrab', 'orange', 'orangered', 'orchid', 'palegoldenrod', 'palegreen', 'paleturquoise',
-              'palevioletred', 'papayawhip', 'peachpuff', 'peru', 'pink', 'plum', 'powderblue', 'purple', 'red',
-              'rosybrown', 'royalblue', 'saddlebrown', 'salmon', 'sandybrown', 'seagreen', 'seashell', 'sienna',
-              'silver', 'skyblue', 'slateblue', 'slategray', 'slategrey', 'snow', 'springgreen', 'steelblue', 'tan',
-              'teal', 'thistle', 'tomato', 'turquoise', 'violet', 'wheat', 'white', 'whitesmoke', 'yellow',
-              'yellowgreen']
-    if isinstance(value, str):
-        value = value.lower()
-        if not value in colors:
-            raise ValueError(f"Color {value} not a valid color: use one of: {colors}.")
-        return value
-    if isinstance(value, int):
-        try:
-            return colors[value]
-        except IndexError as e:
-            raise ValueError(f"Color {value} not a valid color index: use between 0 and {len(colors) - 1}.") from e
-    # else random color
-    return colors[random.randrange(len(colors))]
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+
+# row indexes and distinct values listed for each violated check
+SAMPLES = 5
+
+
+class ValidationReport:
+    """
+    Rows violating column checks (allowed values, required values), grouped by column and check. Checks are
+    evaluated over whole columns as boolean masks, all violations of all rows (chunks) are reported at once.
+    """
+    def __init__(self):
+        # (column, check) -> rows count, sample row indexes, counts of violating values
+        self.violations = {}
+
+    def __bool__(self):
+        return len(self.violations) > 0
+
+    def add(self, column: str, check: str, mask, index: pd.Index, values=None):
+        """
+        :param check: description of the check, e.g. "values not allowed (allowed: A, B)"
+        :param mask: boolean mask of the violating rows
+        :param index: row indexes of the input data
+        :param values: column values, distinct violating values are reported if given
+        """
+        mask = np.asarray(mask, dtype=bool)
+        if not mask.any():
+            return
+        violation = self.violations.setdefault((column, check), {"rows": 0, "samples": [], "values": {}})
+        positions = np.flatnonzero(mask)
+        violation["rows"] += len(positions)
+        missing = SAMPLES - len(violation["samples"])
+        if missing > 0:
+            violation["samples"] += index[positions[:missing]].tolist()
+        if values is not None:
+            counts = pd.Series(np.asarray(values, dtype=object)[positions]).value_counts(dropna=False, sort=False)
+            for value, count in counts.items():
+                violation["values"][value] = violation["values"].get(value, 0) + int(count)
+
+    def message(self, name: str):
+        lines = []
+        for (column, check), violation in self.violations.items():
+            line = f"{column}: {violation['rows']} rows with {check}"
+            values = sorted(violation["values"].items(), key=lambda item: -item[1])
+            if values:
+                listed = ", ".join(f"'{value}' ({count})" for value, count in values[:SAMPLES])
+                line += f" - values {listed}{', ...' if len(values) > SAMPLES else ''}"
+            samples = ", ".join(str(row) for row in violation["samples"])
+            line += f" - rows {samples}{', ...' if violation['rows'] > len(violation['samples']) else ''}"
+            lines.append(line)
+        return f"Invalid data in {name}:\n  " + "\n  ".join(lines)
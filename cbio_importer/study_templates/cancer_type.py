@@ -1,4 +1,5 @@
-from ._utilities import write_meta_file, get_template_file_by_name, read_opt, pick_color, CbioCSVWriter
+from ._config import write_meta_file, get_template_file_by_name, read_opt, pick_color
+from ._output import data_file_name, open_data_file, write_lines
 
 
 def process(options, data):
@@ -6,10 +7,12 @@ def process(options, data):
         print("No cancer types defined - skipping.")
         return
     
-    write_meta_file(get_template_file_by_name("cancer_type.txt"), f"{options['target_folder']}/meta_cancer_type.txt", {})
+    filename = data_file_name("cancer_type", options)
+    write_meta_file(get_template_file_by_name("cancer_type.txt"), f"{options['target_folder']}/meta_cancer_type.txt",
+                    {"filename": filename})
 
     # First create all resource definitions
-    with open(f"{options['target_folder']}/data_cancer_type.txt", 'w') as output:
+    with open_data_file(f"{options['target_folder']}/{filename}", options) as output:
         # prepare data for resource definition, note that the headers ARE NOT written into the output
         res_data = [["TYPE", "NAME", "COLOR", "PARENT"]]
         for cancer_id in data:
@@ -25,6 +28,12 @@ def process(options, data):
                 read_opt("parent", cancer_data, assert_type=str, require=False, default="tissue"),  # root parent=tissue
             ])
 
+        if all(isinstance(value, str) for row in res_data for value in row):
+            # Plain strings are written as they are, without loading pandas (the writer gives the same lines)
+            write_lines(output, res_data[1:])
+            return
+
+        from ._utilities import CbioCSVWriter
         writer = (
             CbioCSVWriter()
             .with_input(res_data, options=options)
@@ -1,7 +1,10 @@
 import pathlib
+import string as formatting
+import numpy as np
 import pandas as pd
 import os
 import csv
+import atexit
 # Keep imported!
 import uuid
 import random
@@ -10,11 +13,92 @@ from string import digits
 # Do not use relative imports here, since it is being dynamically imported!
 from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
 
+"""
+Function Protocol
+"""
+
+
+def pure(fn):
+    """
+    Mark a function as pure: the result depends on the arguments only and calling it has no side effects.
+    Pure column functions are evaluated once per distinct value (disable by 'memoize: false' on the column)
+    and in any order, entities that use only pure functions can be generated in parallel (--jobs).
+    :param fn: function to mark
+    :return: fn
+    """
+    fn.pure = True
+    return fn
+
+
+def is_pure(fn):
+    """
+    True if the function was marked by the pure decorator
+    """
+    return getattr(fn, "pure", False)
+
+
+def batched(fn):
+    """
+    Mark a function as batch-capable: the library calls it once with all values instead of once per value.
+    The first argument is a pd.Series (source_id) or a pd.DataFrame (source_ids), the function returns
+    one result per row, in the same order. Supported by columns, 'create' and function filters.
+    :param fn: function to mark
+    :return: fn
+    """
+    fn.batched = True
+    return fn
+
+
+def batch_of(fn):
+    """
+    Register the decorated function as the batch variant (see batched) of the per-value function fn,
+    the library uses the variant whenever it can evaluate whole columns.
+    :param fn: per-value function
+    :return: decorator
+    """
+    def register(batch_fn):
+        fn.batch_version = batched(batch_fn)
+        return batch_fn
+    return register
+
+
+def get_batch_function(fn):
+    """
+    Batch variant of the function, None if the function can be evaluated per value only
+    """
+    if getattr(fn, "batched", False):
+        return fn
+    return getattr(fn, "batch_version", None)
+
+
+def grouped_of(fn):
+    """
+    Register the decorated function as the grouped variant of the group aggregate function fn: the library
+    calls it once with the values of all groups instead of once per group. The first arguments are the values
+    (pd.Series, in the order of the rows) and the group of each value (np.ndarray of group numbers 0..groups - 1),
+    then the number of groups. It returns one result per group, in the order of the group numbers.
+    :param fn: per-group function
+    :return: decorator
+    """
+    def register(grouped_fn):
+        fn.grouped_version = grouped_fn
+        return grouped_fn
+    return register
+
+
+def get_grouped_function(fn):
+    """
+    Grouped variant of the group aggregate function (see grouped_of), None if it is evaluated group by group
+    """
+    return getattr(fn, "grouped_version", None)
+
+
 """
 Single Value Transformers
 """
 
 
+@pure
 def template_string(value: str, string: str = "{value}", template_dict: dict = {}):
     """
     Format string argument. The input value is passed as 'value' to the formatter.
@@ -29,6 +113,26 @@ def template_string(value: str, string: str = "{value}", template_dict: dict = {
     return string.format(**template_dict)
 
 
+@batch_of(template_string)
+def template_string_batch(values: pd.Series, string: str = "{value}", template_dict: dict = {}):
+    """
+    Batch variant of template_string: plain {value} templates are built by vectorized string concatenation
+    """
+    result = pd.Series(None, index=values.index, dtype=object)
+    present = ~values.isna().to_numpy()
+    parts = _split_template(string, template_dict)
+    if parts is None:
+        result[present] = [string.format(**{**template_dict, "value": value}) for value in values[present]]
+        return result
+    text = values[present].astype(str)
+    formatted = parts[0]
+    for part in parts[1:]:
+        formatted = formatted + text + part
+    result[present] = formatted
+    return result
+
+
+@pure
 def os_status_alive_deceased(value: str, compare: str = "alive"):
     """
     Remap custom 'alive' / 'deceased' marks to cbioportal syntax
@@ -41,11 +145,23 @@ def os_status_alive_deceased(value: str, compare: str = "alive"):
     return "0:LIVING" if value.lower() == compare else "1:DECEASED"
 
 
+@batch_of(os_status_alive_deceased)
+def os_status_alive_deceased_batch(values: pd.Series, compare: str = "alive"):
+    """
+    Batch variant of os_status_alive_deceased, evaluated once per distinct value
+    """
+    codes, uniques = pd.factorize(values)
+    # missing values have code -1: the appended None
+    statuses = np.array([os_status_alive_deceased(value, compare) for value in uniques] + [None], dtype=object)
+    return statuses[codes]
+
+
 """
 Multi-value Transformers
 """
 
 
+@pure
 def select_first(values: pd.Series):
     """
     Select first of the value list
@@ -55,6 +171,16 @@ def select_first(values: pd.Series):
     return values.iloc[0] if len(values) > 0 else None
 
 
+@grouped_of(select_first)
+def select_first_grouped(values: pd.Series, codes: np.ndarray, groups: int):
+    """
+    Grouped variant of select_first: the value of the first row of each group
+    """
+    _, first = np.unique(codes, return_index=True)
+    return values.iloc[first].reset_index(drop=True)
+
+
+@pure
 def concat_paths(values: pd.Series, delimiter: str = ",", prefix_remove: str=""):
     """
     Concatenate path values to a string, useful for WSI service concatenated list of IDs / paths
@@ -66,6 +192,50 @@ def concat_paths(values: pd.Series, delimiter: str = ",", prefix_remove: str="")
     return delimiter.join([pathlib.Path(p).relative_to(prefix_remove).as_posix() for p in values])
 
 
+@grouped_of(concat_paths)
+def concat_paths_grouped(values: pd.Series, codes: np.ndarray, groups: int, delimiter: str = ",",
+                         prefix_remove: str = ""):
+    """
+    Grouped variant of concat_paths: each distinct path is made relative once, then joined per group
+    """
+    paths, uniques = pd.factorize(values)
+    if (paths < 0).any():
+        # missing values fail as they do in concat_paths
+        return [concat_paths(values, delimiter, prefix_remove)]
+    relative = np.array(_relative_paths(uniques, prefix_remove), dtype=object)
+    return [delimiter.join(group) for group in _split_groups(relative[paths], codes, groups)]
+
+
+def _relative_paths(paths, prefix_remove: str):
+    """
+    pathlib.Path(p).relative_to(prefix_remove).as_posix() of each path: POSIX paths already in their normal
+    form are cut as strings, others go through pathlib (which also raises for paths outside the prefix)
+    """
+    prefix = pathlib.PurePosixPath(prefix_remove).as_posix() if os.name == "posix" else None
+    relative = []
+    for path in paths:
+        if prefix is not None and isinstance(path, str) and _is_normal_path(path):
+            if prefix == ".":
+                if not path.startswith("/"):
+                    relative.append(path)
+                    continue
+            elif path == prefix:
+                relative.append(".")
+                continue
+            elif path.startswith(prefix.rstrip("/") + "/") and prefix != "//":
+                relative.append(path[len(prefix.rstrip("/")) + 1:])
+                continue
+        relative.append(pathlib.Path(path).relative_to(prefix_remove).as_posix())
+    return relative
+
+
+def _is_normal_path(path: str):
+    # pathlib keeps such strings as they are
+    return path not in ("", ".") and "//" not in path and "/./" not in path and not path.startswith("./") \
+        and not path.endswith("/.") and (path == "/" or not path.endswith("/"))
+
+
+@pure
 def template_string_list(values: pd.Series, string: str = "{value}", template_dict: dict = {}):
     """
     Format string argument. The input value is passed as 'value' to the formatter.
@@ -77,6 +247,16 @@ def template_string_list(values: pd.Series, string: str = "{value}", template_di
     return template_string(values.tolist(), string=string, template_dict=template_dict)
 
 
+@grouped_of(template_string_list)
+def template_string_list_grouped(values: pd.Series, codes: np.ndarray, groups: int, string: str = "{value}",
+                                 template_dict: dict = {}):
+    """
+    Grouped variant of template_string_list: the values of the groups are split without a pd.Series per group
+    """
+    return [template_string(group, string=string, template_dict=template_dict)
+            for group in _split_groups(values.to_numpy(dtype=object), codes, groups)]
+
+
 
 """
 Single-value Predicates
@@ -103,6 +283,14 @@ def is_unique(value: str, context: str):
 
 
 anonymization_mappings = {}
+# original -> pseudonym and pseudonym -> original per mapper file, first occurrence wins
+anonymization_index = {}
+anonymization_reverse_index = {}
+# rows not yet appended to the mapper file (journal), see flush_anonymization_data
+anonymization_pending = {}
+anonymization_flush_size = 10000
+# mapper file -> its (size, mtime) when read, while the mapping holds exactly the rows of the file
+anonymization_loaded = {}
 def anonymize(value, mapper_filename: str = "anonym_mappings.csv", generator: str = "increment", *args, **kwargs):
     """
     Anonymize given value. Store mappings in a temporary file 'mapper_filename'. If a provided value exists in the mappings,
@@ -125,15 +313,33 @@ def anonymize(value, mapper_filename: str = "anonym_mappings.csv", generator: st
     :return: unique ID
     """
     mapping = _get_anonymization_mapping(mapper_filename)
-    for row in mapping:
-        if len(row) == 2 and row[1] == value:
-            return row[0]
+    try:
+        # NaN never equals a stored value
+        new_id = anonymization_index[mapper_filename].get(value) if value == value else None
+        if new_id is not None:
+            return new_id
+    except TypeError:
+        # unhashable values
+        for row in mapping:
+            if len(row) == 2 and row[1] == value:
+                return row[0]
 
     dealer = _get_function_by_name(generator)
     new_id = dealer(value, *args, **kwargs)
     persist_append_anonymization_data_item(mapper_filename, new_id, value)
     return new_id
 
+def deanonymize(value, mapper_filename: str = "anonym_mappings.csv"):
+    """
+    Retrieve the original value of an ID issued by anonymize.
+    :param value: argument passed by the library - the anonymized value
+    :param mapper_filename: filename the mappings are stored in
+    :return: the original value, None if the ID is unknown
+    """
+    _get_anonymization_mapping(mapper_filename)
+    return anonymization_reverse_index[mapper_filename].get(value)
+
+
 def anonymize_list(values: pd.Series, mapper_filename: str = "anonym_mappings.csv", generator: str = "increment", *args, **kwargs):
     return anonymize(values.str.cat(sep='~'), mapper_filename=mapper_filename, generator=generator, *args, **kwargs)
 
@@ -142,22 +348,100 @@ def gen_simple_patient_id(value, mapper_filename: str = "patient_mappings.csv",
     return anonymize(value, mapper_filename=mapper_filename, generator=generator, prefix="P")
 
 
+@batch_of(gen_simple_patient_id)
+def gen_simple_patient_id_batch(values: pd.Series, mapper_filename: str = "patient_mappings.csv",
+                                generator: str = "increment"):
+    return _anonymize_batch(values, mapper_filename=mapper_filename, generator=generator, prefix="P")
+
+
 def gen_simple_sample_id(value, mapper_filename: str = "sample_mappings.csv", generator: str = "increment"):
     return anonymize(value, mapper_filename=mapper_filename, generator=generator, prefix="S")
 
 
+@batch_of(gen_simple_sample_id)
+def gen_simple_sample_id_batch(values: pd.Series, mapper_filename: str = "sample_mappings.csv",
+                               generator: str = "increment"):
+    return _anonymize_batch(values, mapper_filename=mapper_filename, generator=generator, prefix="S")
+
+
 # More granular control over contents of the file, use with caution
 def persist_append_anonymization_data_item(mapper_filename, *row):
+    """
+    Add a mapping row. The mapper file is an append-only journal: rows are appended in batches of
+    anonymization_flush_size, and always before an output that uses them is written (flush_anonymization_data).
+    """
     global anonymization_mappings
-    data_folder = TemporaryFilesDirectory(None).path
     mapping = _get_anonymization_mapping(mapper_filename)
     if type(mapping) != list:
         raise Exception(f"Anonymization mappings - storage of non-existent data - probably a bug ({mapper_filename})!")
     mapping.append(row)
-    
-    file = f"{data_folder}/{mapper_filename}"
-    with open(file, 'a', encoding='utf-8') as file:
-        print(*row, sep="\t", file=file)
+    _index_anonymization_row(mapper_filename, row)
+    anonymization_loaded.pop(mapper_filename, None)
+
+    pending = anonymization_pending.setdefault(mapper_filename, [])
+    pending.append(row)
+    if len(pending) >= anonymization_flush_size:
+        flush_anonymization_data(mapper_filename)
+
+
+def flush_anonymization_data(mapper_filename=None):
+    """
+    Append pending mapping rows to the mapper files. Called automatically by the library.
+    :param mapper_filename: flush only this file, all files if None
+    :return: None
+    """
+    data_folder = TemporaryFilesDirectory(None).path
+    names = list(anonymization_pending.keys()) if mapper_filename is None else [mapper_filename]
+    for name in names:
+        pending = anonymization_pending.pop(name, None)
+        if not pending:
+            continue
+        with open(f"{data_folder}/{name}", 'a', encoding='utf-8') as file:
+            file.writelines("\t".join(str(item) for item in row) + "\n" for row in pending)
+
+
+atexit.register(flush_anonymization_data)
+
+
+def reset_state():
+    """
+    Starts the next run in the same process (serve mode) as a new process would: is_unique contexts and
+    increment IDs start again. Anonymization mappings are kept while their mapper files still hold exactly
+    the rows read from them, others are read again. Called automatically by the library.
+    :return: None
+    """
+    global unique_sets, id_dealer
+    flush_anonymization_data()
+    unique_sets = {}
+    id_dealer = 0
+    for name in list(anonymization_mappings):
+        if name not in anonymization_loaded or anonymization_loaded[name] != _mapper_file_stat(name):
+            anonymization_mappings.pop(name)
+            anonymization_index.pop(name, None)
+            anonymization_reverse_index.pop(name, None)
+            anonymization_loaded.pop(name, None)
+
+
+def save_state():
+    """
+    State the functions pass from one entity to the next: the random numbers sequence, is_unique contexts
+    and increment IDs (anonymization mappings are stored in their mapper files). Called automatically by the library.
+    :return: state to pass to restore_state
+    """
+    return {"random": random.getstate(), "unique_sets": {context: set(values) for context, values in unique_sets.items()},
+            "id_dealer": id_dealer}
+
+
+def restore_state(state: dict):
+    """
+    Continues from a state saved by save_state, as if the entities before it were generated again.
+    Called automatically by the library.
+    :return: None
+    """
+    global unique_sets, id_dealer
+    random.setstate(state["random"])
+    unique_sets = {context: set(values) for context, values in state["unique_sets"].items()}
+    id_dealer = state["id_dealer"]
 
 
 def set_seed(value: str):
@@ -192,6 +476,49 @@ def _get_function_by_name(full_name):
         raise ValueError(f"{full_name} is not callable.")
 
 
+def _split_groups(values: np.ndarray, codes: np.ndarray, groups: int):
+    """
+    Values of each group as a list, in the order of the rows (see grouped_of)
+    """
+    order = np.argsort(codes, kind="stable")
+    ends = np.cumsum(np.bincount(codes, minlength=groups))
+    ordered = values[order].tolist()
+    return [ordered[start:end] for start, end in zip(np.concatenate(([0], ends[:-1])), ends)]
+
+
+def _split_template(string, template_dict):
+    """
+    Literal parts of a format string around its plain {value} fields, other fields are substituted
+    from template_dict. None if the value is formatted in any other way (e.g. {value[0]}, {value:>5}).
+    """
+    parts, literal = [], ""
+    for text, field, spec, conversion in formatting.Formatter().parse(string):
+        literal += text
+        if field is None:
+            continue
+        if spec or conversion:
+            return None
+        if field == "value":
+            parts.append(literal)
+            literal = ""
+        elif field.split(".")[0].split("[")[0] == "value":
+            return None
+        else:
+            literal += ("{" + field + "}").format(**template_dict)
+    parts.append(literal)
+    return parts
+
+
+def _anonymize_batch(values: pd.Series, **kwargs):
+    # Distinct values in the order of their first occurrence issue the same IDs as row by row calls,
+    # missing values get a new ID on every occurrence - keep their order with row by row calls
+    if values.isna().any():
+        return [anonymize(value, **kwargs) for value in values]
+    codes, uniques = pd.factorize(values)
+    ids = np.array([anonymize(value, **kwargs) for value in uniques], dtype=object)
+    return ids[codes]
+
+
 id_dealer = 0
 def increment(_, prefix: str = "", zfill: int = 5):
     global id_dealer
@@ -218,22 +545,51 @@ def _load_anonymization_data(mapper_filename, missing_ok=True):
     data_folder = TemporaryFilesDirectory(None).path
     
     file = f"{data_folder}/{mapper_filename}"
+    anonymization_loaded[mapper_filename] = _mapper_file_stat(mapper_filename)
     if not os.path.isfile(file):
         if not missing_ok:
             raise Exception(f"Anonymization mappings not found (reading {mapper_filename})!")
         result = []
         anonymization_mappings[mapper_filename] = result
+        _index_anonymization_data(mapper_filename, result)
         return result
     
     with open(file, mode='r', encoding='utf-8') as csvfile:
         reader = csv.reader(csvfile, delimiter="\t")
         result = list(reader)
         anonymization_mappings[mapper_filename] = result
+        _index_anonymization_data(mapper_filename, result)
         return result
 
     raise Exception(f"Anonymization mappings - unknown error (reading {mapper_filename})!")
 
 
+def _mapper_file_stat(mapper_filename):
+    try:
+        stat = os.stat(f"{TemporaryFilesDirectory(None).path}/{mapper_filename}")
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _index_anonymization_data(mapper_filename, rows):
+    anonymization_index[mapper_filename] = {}
+    anonymization_reverse_index[mapper_filename] = {}
+    for row in rows:
+        _index_anonymization_row(mapper_filename, row)
+
+
+def _index_anonymization_row(mapper_filename, row):
+    if len(row) != 2:
+        return
+    anonymization_reverse_index[mapper_filename].setdefault(row[0], row[1])
+    try:
+        if row[1] == row[1]:
+            anonymization_index[mapper_filename].setdefault(row[1], row[0])
+    except TypeError:
+        pass  # unhashable values are looked up in the mapping rows
+
+
 def _persist_anonymization_data(mapper_filename):
     global anonymization_mappings
     data_folder = TemporaryFilesDirectory(None).path
@@ -241,6 +597,8 @@ def _persist_anonymization_data(mapper_filename):
     if type(mapping) != list:
         raise Exception(f"Anonymization mappings - storage of non-existent data - probably a bug ({mapper_filename})!")
 
+    anonymization_pending.pop(mapper_filename, None)
+    anonymization_loaded.pop(mapper_filename, None)
     file = f"{data_folder}/{mapper_filename}"
     with open(file, 'w', encoding='utf-8') as file:
         for row in mapping:
@@ -1,4 +1,5 @@
-from ._utilities import write_meta_file, get_template_file_by_name, CbioCSVWriter
+from ._config import write_meta_file, get_template_file_by_name
+from ._output import data_file_name
 
 
 def process(options, data):
@@ -7,23 +8,27 @@ def process(options, data):
         print("No patients defined - skipping.")
         return
     
+    filename = data_file_name("clinical_patient", options)
     write_meta_file(get_template_file_by_name("patient.txt"), f"{options['target_folder']}/meta_clinical_patient.txt",
-                    options, ["study_id"])
+                    {**options, "filename": filename}, ["study_id", "filename"])
     
     # Now parse the data
-    with open(f"{options['target_folder']}/data_clinical_patient.txt", 'w') as output:
-        writer = (
-            CbioCSVWriter()
-            .with_required_columns("PATIENT_ID")
-            .with_input(data["file"], options)
-        )
-        writer.prepare_headers(data)
+    from ._utilities import CbioCSVWriter
+    writer = (
+        CbioCSVWriter()
+        .with_required_columns("PATIENT_ID")
+        .with_input(data["file"], options)
+        .with_output_file(f"{options['target_folder']}/{filename}")
+    )
+    writer.prepare_headers(data)
 
-        # First write compulsory headers:
-        writer.write_comment_ids(output)
-        writer.write_comment_descriptions(output)
-        writer.write_comment_data_types(output)
-        writer.write_comment_priority(output)
-        writer.write_header(output)
+    with writer.open_output() as output:
+        # First write compulsory headers, unless new rows are appended (delta mode):
+        if not writer.appending:
+            writer.write_comment_ids(output)
+            writer.write_comment_descriptions(output)
+            writer.write_comment_data_types(output)
+            writer.write_comment_priority(output)
+            writer.write_header(output)
         # Then, write the data
         writer.write_data(output)
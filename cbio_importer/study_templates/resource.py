@@ -1,17 +1,28 @@
-from ._utilities import write_meta_file, get_template_file_by_name, CbioCSVWriter
+from ._config import write_meta_file, get_template_file_by_name
+from ._output import data_file_name, open_data_file
 
 
 def process(options, data):
+    if not process_definition(options, data):
+        return
+
+    for item in data:
+        process_item(options, item)
+
+
+def process_definition(options, data):
     if not data or not len(data):
         print("No resources defined - skipping.")
-        return
+        return False
     
+    filename = data_file_name("resource_definition", options)
     # First create resource definition
     write_meta_file(get_template_file_by_name("resource.txt"), f"{options['target_folder']}/meta_resource_definition.txt",
-                    options, ["study_id"])
+                    {**options, "filename": filename}, ["study_id", "filename"])
 
     # First create all resource definitions
-    with open(f"{options['target_folder']}/data_resource_definition.txt", 'w') as output:
+    from ._utilities import CbioCSVWriter
+    with open_data_file(f"{options['target_folder']}/{filename}", options) as output:
         # prepare data for resource definition
         res_data = [["RESOURCE_ID", "DISPLAY_NAME", "RESOURCE_TYPE", "DESCRIPTION", "OPEN_BY_DEFAULT", "PRIORITY"]]
         for item in data:
@@ -63,29 +74,33 @@ def process(options, data):
         })
         writer.write_header(output)
         writer.write_data(output)
+    return True
 
-    for item in data:
-        res = item["resource"]
-        key = res["__key"]
-        rtype = res["resource_type"]
-        # First create resource item definition
-        write_meta_file(get_template_file_by_name("resource_item.txt"), f"{options['target_folder']}/meta_resource_item_{key}.txt",
-                {"study_id": options["study_id"], "filename": f"data_resource_item_{key}.txt", "type": res["resource_type"]})
-        
-        required_columns = {
-            "SAMPLE": ["PATIENT_ID", "SAMPLE_ID", "RESOURCE_ID", "URL"],
-            "PATIENT": ["PATIENT_ID", "RESOURCE_ID", "URL"],
-            "STUDY": ["RESOURCE_ID", "URL"]
-        }
-        
-        # Then provide all resource items
-        with open(f"{options['target_folder']}/data_resource_item_{key}.txt", 'w') as output:
-            writer = (
-                CbioCSVWriter()
-                .with_required_columns(*required_columns[rtype])
-                .with_input(item["file"], options)
-            )
-            writer.prepare_headers(item)
-            writer.write_header(output)
-            writer.write_data(output)
+
+def process_item(options, item):
+    res = item["resource"]
+    key = res["__key"]
+    rtype = res["resource_type"]
+    filename = data_file_name(f"resource_item_{key}", options)
+    # First create resource item definition
+    write_meta_file(get_template_file_by_name("resource_item.txt"), f"{options['target_folder']}/meta_resource_item_{key}.txt",
+            {"study_id": options["study_id"], "filename": filename, "type": res["resource_type"]})
+
+    required_columns = {
+        "SAMPLE": ["PATIENT_ID", "SAMPLE_ID", "RESOURCE_ID", "URL"],
+        "PATIENT": ["PATIENT_ID", "RESOURCE_ID", "URL"],
+        "STUDY": ["RESOURCE_ID", "URL"]
+    }
+
+    # Then provide all resource items
+    from ._utilities import CbioCSVWriter
+    with open_data_file(f"{options['target_folder']}/{filename}", options) as output:
+        writer = (
+            CbioCSVWriter()
+            .with_required_columns(*required_columns[rtype])
+            .with_input(item["file"], options)
+        )
+        writer.prepare_headers(item)
+        writer.write_header(output)
+        writer.write_data(output)
 
@@ -1,23 +1,31 @@
-from ._utilities import write_meta_file, get_template_file_by_name, CbioCSVWriter
+from ._config import write_meta_file, get_template_file_by_name
+from ._output import data_file_name
 
 
 def process(options, data):
 
     for item in data:
-        series = item["series"]
-        key = series["__key"]
-        # First create resource item definition
-        write_meta_file(get_template_file_by_name("time_series.txt"), f"{options['target_folder']}/meta_timeline_{key}.txt",
-            {"study_id": options["study_id"], "filename": f"data_timeline_{key}.txt"})
+        process_item(options, item)
 
-        # Then provide all resource items
-        with open(f"{options['target_folder']}/data_timeline_{key}.txt", 'w') as output:
-            writer = (
-                CbioCSVWriter()
-                .with_required_columns("PATIENT_ID", "START_DATE", "STOP_DATE", "EVENT_TYPE")
-                .with_input(item["file"], options)
-            )
-            writer.prepare_headers(item)
-            writer.write_header(output)
-            writer.write_data(output)
 
+def process_item(options, item):
+    series = item["series"]
+    key = series["__key"]
+    filename = data_file_name(f"timeline_{key}", options)
+    # First create resource item definition
+    write_meta_file(get_template_file_by_name("time_series.txt"), f"{options['target_folder']}/meta_timeline_{key}.txt",
+        {"study_id": options["study_id"], "filename": filename})
+
+    # Then provide all resource items
+    from ._utilities import CbioCSVWriter
+    writer = (
+        CbioCSVWriter()
+        .with_required_columns("PATIENT_ID", "START_DATE", "STOP_DATE", "EVENT_TYPE")
+        .with_input(item["file"], options)
+        .with_output_file(f"{options['target_folder']}/{filename}")
+    )
+    writer.prepare_headers(item)
+    with writer.open_output() as output:
+        if not writer.appending:
+            writer.write_header(output)
+        writer.write_data(output)
@@ -0,0 +1,156 @@
+import io
+import os
+import copy
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cbio_importer.study_templates import process
+from cbio_importer.study_templates._singletons import FunctionDefinitionFile, TemporaryFilesDirectory, SeedValue
+from cbio_importer.study_templates._utilities import CbioCSVWriter, FunctionRegistry
+
+OPTIONS = {"delimiter": "\t", "source_prefix": ""}
+
+
+def write_sources(folder, **sources):
+    """
+    Writes tab separated source files: name -> header line, data lines (values separated by spaces, '-' for
+    a missing value)
+    """
+    for name, (header, *rows) in sources.items():
+        lines = [header] + list(rows)
+        (folder / name).write_text("".join("\t".join("" if value == "-" else value for value in line.split()) + "\n"
+                                           for line in lines))
+
+
+def column(column_id, source_id, data_type="STRING", **options):
+    """
+    Output column definition named by its id
+    """
+    return {"id": column_id, "source_id": source_id, "name": column_id, "description": column_id,
+            "data_type": data_type, **options}
+
+
+def samples_study(preprocess, columns, required=True, **options):
+    """
+    Study of samples.csv (see sources) with patient and sample ids, the given preprocessing steps and columns
+    :param required: False if rows may miss the ids (e.g. rows of 'outer' joins)
+    """
+    ids = [column("PATIENT_ID", "patient"), column("SAMPLE_ID", "sample")]
+    if not required:
+        ids = [{**item, "required": False} for item in ids]
+    return {
+        "study_id": "test_study",
+        "cancer_type": "brca",
+        "study_name": "Test",
+        "study_description": "Test study",
+        "samples": {
+            "file": "samples.csv",
+            "preprocess": preprocess,
+            "columns": ids + columns,
+            **options,
+        },
+    }
+
+
+def values(output, position, file="data_clinical_samples.txt"):
+    """
+    Values of the column at the position in the data rows of the generated file (see generate)
+    """
+    # data rows follow the 4 metadata lines and the header
+    return [line.split("\t")[position] for line in output[file][5:]]
+
+
+def write_table(rows, columns, required=(), allowed=()):
+    """
+    Writes the data rows of a table (header row first) by CbioCSVWriter
+    :param required: ids of the columns that must not be empty
+    :param allowed: [(column id, allowed values)]
+    :return: output lines
+    """
+    writer = CbioCSVWriter().with_required_columns(*required).with_input(copy.deepcopy(rows), options=OPTIONS)
+    for key, values in allowed:
+        writer.with_allowed_values_set(key, values)
+    writer.prepare_headers({"columns": columns})
+    output = io.StringIO()
+    writer.write_data(output)
+    return output.getvalue().splitlines()
+
+
+def row_by_row(rows, columns):
+    """
+    Data lines of the table as the writer wrote them before columns were evaluated at once: iterrows(), one function
+    call per cell in the order of the rows and columns - the reference of write_table
+    """
+    frame = pd.DataFrame(copy.deepcopy(rows[1:]), columns=rows[0]).replace({None: np.nan})
+    lines = []
+    for _, row in frame.iterrows():
+        values = []
+        for item in columns:
+            value = item["value"] if "value" in item else row[item.get("source_ids", item.get("source_id"))]
+            function = item.get("function")
+            if function is not None:
+                args = {key: argument for key, argument in function.items() if key != "name"}
+                value = FunctionRegistry().get(function["name"])(value, **args)
+            values.append("" if pd.isna(value) else str(value))
+        lines.append("\t".join(values))
+    return lines
+
+
+@pytest.fixture
+def sources(tmp_path):
+    """
+    samples.csv: P5 and P6 have no patient, missing kinds and scores. patients.csv, sites.csv: joined files
+    """
+    write_sources(
+        tmp_path,
+        **{
+            "samples.csv": ["patient sample kind site score", "P5 S0 c x 4.0", "P1 S1 a x 1.5", "P1 S2 b y 2.5",
+                            "P2 S3 a z -", "P3 S4 c x 0.5", "P4 S5 b y -", "P4 S6 b y 3.0", "P2 S7 - y 2.5",
+                            "P6 S8 - - -"],
+            "patients.csv": ["pid age stage smoker", "P1 50 I True", "P2 61 II False", "P3 47 I True",
+                             "P4 39 - False", "P7 70 III True"],
+            "sites.csv": ["site_id region", "x north", "y south"],
+        })
+
+
+@pytest.fixture
+def generate(tmp_path, monkeypatch):
+    """
+    Generates a study (all entities) from sources in tmp_path
+    :return: function (study definition, output folder name, process options) -> data file name -> lines
+    """
+    helper_files = tmp_path / "helper_files"
+    helper_files.mkdir()
+    monkeypatch.setattr(TemporaryFilesDirectory(None), "path", str(helper_files))
+    monkeypatch.setattr(FunctionDefinitionFile(None), "path", None)
+    monkeypatch.setattr(SeedValue(None), "value", 42)
+
+    def run(study: dict, name: str, **options):
+        target = tmp_path / name
+        target.mkdir(exist_ok=True)
+        process(target_folder=str(target), study_yaml=study, source_prefix=f"{tmp_path}/",
+                **{"force": True, **options})
+        return {file: (target / file).read_text().splitlines() for file in sorted(os.listdir(target))
+                if file.startswith("data_")}
+    return run
+
+
+@pytest.fixture
+def compare(generate, monkeypatch):
+    """
+    Generates the study in variants, each one into its own output folder
+    :return: function (study, variant name -> {"changes": study keys to set, "patches": {(object, attribute): value}
+        patched while generating, "options": process options}) -> outputs (see generate) in the order of the variants
+    """
+    def run(study: dict, **variants):
+        outputs = []
+        for name, variant in variants.items():
+            with monkeypatch.context() as patch:
+                for (owner, attribute), value in variant.get("patches", {}).items():
+                    patch.setattr(owner, attribute, value)
+                outputs.append(generate({**copy.deepcopy(study), **variant.get("changes", {})}, name,
+                                        **variant.get("options", {})))
+        return outputs
+    return run
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cbio_importer.study_templates import _utilities
+from cbio_importer.study_templates._utilities import GroupedAgg
+from cbio_importer.study_templates.default_functions import select_first, concat_paths, get_grouped_function
+
+from .conftest import column, samples_study, values
+
+VALUES = pd.Series(["/data/a.svs", "/data/b/c.svs", "/data/a.svs", "/data/d.svs", "/data/e/f.svs", "/data/g.svs"])
+CODES = np.array([2, 0, 2, 1, 0, 2])
+
+
+def count(values):
+    return len(values)
+
+
+class _NamedAgg(GroupedAgg):
+    """
+    GroupedAgg replaced by its pd.NamedAgg, evaluated group by group
+    """
+    def __new__(cls, *args):
+        return GroupedAgg(*args).named()
+
+
+def _group_by_group():
+    """
+    Aggregates as pandas calls the functions: group by group, without grouped variants
+    """
+    return {"patches": {(_utilities, "get_grouped_function"): lambda fn: None, (_utilities, "GroupedAgg"): _NamedAgg}}
+
+
+@pytest.mark.parametrize("fn, args", [
+    (select_first, {}),
+    (concat_paths, {"delimiter": ";", "prefix_remove": "/data"}),
+])
+def test_grouped_variant_gives_group_results(fn, args):
+    expected = [fn(VALUES[CODES == group], **args) for group in range(3)]
+
+    assert list(get_grouped_function(fn)(VALUES, CODES, 3, **args)) == expected
+
+
+@pytest.mark.parametrize("by", [["kind"], ["kind", "site"]])
+def test_grouped_aggregates_give_group_by_group_output(sources, compare, by):
+    study = samples_study([{"task": "group", "by": by, "aggregate": [
+        {"id": "patient", "function": {"name": "select_first"}},
+        {"id": "sample", "function": {"name": "concat_paths", "delimiter": ";"}},
+        {"id": "score", "function": {"name": f"{__name__}.count"}},
+        {"id": "label", "source_id": "sample", "value": "L"}]}],
+        [column("KIND", "kind"), column("SCORE", "score"), column("LABEL", "label")])
+
+    grouped, group_by_group = compare(study, grouped={}, group_by_group=_group_by_group())
+
+    assert grouped == group_by_group
+    if by == ["kind"]:
+        # rows without a kind are dropped
+        assert values(grouped, 1) == ["S1;S3", "S2;S5;S6", "S0;S4"]
+        assert values(grouped, 3) == ["2", "3", "2"]
@@ -0,0 +1,81 @@
+import pytest
+
+from cbio_importer.study_templates import default_functions
+from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
+from cbio_importer.study_templates.default_functions import anonymize, flush_anonymization_data
+
+from .conftest import row_by_row, write_table
+
+VALUES = ["a", "b", "a", 1, 1.0, True, float("nan"), float("nan"), ["x"], ["x"], "b"]
+
+
+@pytest.fixture
+def restart(tmp_path, monkeypatch):
+    """
+    :return: function forgetting all mappings (files too) and increment IDs, as a new process with a new
+        helper files directory
+    """
+    monkeypatch.setattr(TemporaryFilesDirectory(None), "path", str(tmp_path))
+
+    def run(remove_files=True):
+        for name in ("anonymization_mappings", "anonymization_index", "anonymization_reverse_index",
+                     "anonymization_pending", "anonymization_loaded"):
+            monkeypatch.setattr(default_functions, name, {})
+        monkeypatch.setattr(default_functions, "id_dealer", 0)
+        for file in tmp_path.glob("*.csv") if remove_files else ():
+            file.unlink()
+    run()
+    return run
+
+
+def _linear(values):
+    """
+    IDs the scan of all mapping rows gave for the values: a stored value equal to the value, a new increment ID
+    otherwise (missing values never equal)
+    """
+    mapping = []
+    ids = []
+    for value in values:
+        found = next((new_id for new_id, stored in mapping if stored == value), None)
+        if found is None:
+            found = str(len(mapping) + 1).zfill(5)
+            mapping.append((found, value))
+        ids.append(found)
+    return ids, mapping
+
+
+def test_index_gives_ids_of_the_scan(restart):
+    ids, _ = _linear(VALUES)
+
+    assert [anonymize(value, mapper_filename="m.csv") for value in VALUES] == ids
+
+
+def test_mappings_are_stored_in_batches(restart, tmp_path, monkeypatch):
+    monkeypatch.setattr(default_functions, "anonymization_flush_size", 4)
+    ids = [anonymize(value, mapper_filename="m.csv") for value in VALUES]
+    file = tmp_path / "m.csv"
+
+    # 6 new IDs (1, 1.0 and True are equal): one batch is stored, the rest once flushed
+    assert len(file.read_text().splitlines()) == 4
+    flush_anonymization_data()
+    _, mapping = _linear(VALUES)
+    assert file.read_text().splitlines() == [f"{new_id}\t{value}" for new_id, value in mapping]
+
+    # stored values are read back as strings
+    restart(remove_files=False)
+    assert [anonymize(value, mapper_filename="m.csv") for value in ["a", "b", "1", "['x']"]] == \
+        [ids[0], ids[1], ids[3], ids[8]]
+    flush_anonymization_data()
+    assert len(file.read_text().splitlines()) == 6
+
+
+@pytest.mark.parametrize("name", ["anonymize", "gen_simple_patient_id"])
+def test_writer_stores_ids_before_writing(restart, tmp_path, name):
+    rows = [["id"], ["a"], ["b"], [None], ["a"], [None], ["c"]]
+    columns = [{"id": "ID", "source_id": "id", "function": {"name": name, "mapper_filename": "m.csv"}}]
+    expected = row_by_row(rows, columns)
+    restart()
+
+    assert write_table(rows, columns) == expected
+    # no flush: rows refer only to stored IDs
+    assert len((tmp_path / "m.csv").read_text().splitlines()) == 5
@@ -0,0 +1,15 @@
+import pandas as pd
+
+from .conftest import column, samples_study, values
+
+
+def test_copy_on_write_is_scoped_to_writers(sources, generate):
+    study = samples_study([{"task": "create", "new_column": "label", "source_id": "kind",
+                            "function": {"name": "template_string", "string": "k-{value}"}}],
+                          [column("LABEL", "label")])
+
+    with pd.option_context('mode.copy_on_write', False):
+        output = generate(study, "out")
+        assert pd.get_option('mode.copy_on_write') is False
+
+    assert values(output, 2) == ["k-c", "k-a", "k-b", "k-a", "k-c", "k-b", "k-b", "", ""]
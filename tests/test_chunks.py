@@ -0,0 +1,44 @@
+import pytest
+
+from .conftest import column, samples_study, values
+
+
+def _chunked(compare, study):
+    """
+    :return: (output of the source read at once, output of the source streamed in chunks of 2 rows)
+    """
+    return compare(study, full={}, chunked={"options": {"chunk_size": 2}})
+
+
+def _join(file, left_on, right_on, how):
+    return {"task": "join", "file": file, "left_on": left_on, "right_on": right_on, "how": how}
+
+
+@pytest.mark.parametrize("how", ["inner", "left"])
+def test_join_of_string_columns_is_streamed(sources, compare, capsys, how):
+    full, chunked = _chunked(compare, samples_study([_join("sites.csv", "site", "site_id", how)],
+                                                    [column("REGION", "region")]))
+
+    assert full == chunked
+    assert "cannot be streamed" not in capsys.readouterr().out
+
+
+def test_left_join_of_integer_columns_reads_whole_table(sources, compare, capsys):
+    # chunks of matched patients only would keep the ages integers
+    full, chunked = _chunked(compare, samples_study([_join("patients.csv", "patient", "pid", "left")],
+                                                    [column("AGE", "age", "NUMBER"), column("SMOKER", "smoker")]))
+
+    assert full == chunked
+    assert values(chunked, 2) == ["", "50.0", "50.0", "61.0", "47.0", "39.0", "39.0", "61.0", ""]
+    assert "cannot be streamed in chunks of 2 rows: rows without a match" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("how", ["right", "outer"])
+def test_right_and_outer_joins_read_whole_table(sources, compare, capsys, how):
+    # patients without samples are added once
+    full, chunked = _chunked(compare, samples_study([_join("patients.csv", "patient", "pid", how)],
+                                                    [column("AGE", "age", "NUMBER")], required=False))
+
+    assert full == chunked
+    assert values(chunked, 1).count("") == 1
+    assert f"'{how}' join adds rows" in capsys.readouterr().out
@@ -0,0 +1,101 @@
+import pytest
+
+from cbio_importer.study_templates import default_functions
+from cbio_importer.study_templates.default_functions import pure, batch_of
+
+from .conftest import row_by_row, write_table
+
+# ints and floats with missing values: rows of iterrows() are floats
+NUMBERS = [["count", "score"], [1, 0.5], [2, None], [3, 2.0], [2, 1.5]]
+# a string column keeps the types of the values
+MIXED = [["id", "count", "flag"], ["a", 1, True], ["b", None, False], ["c", 3, None], ["a", 1, True]]
+
+calls = []
+batches = []
+
+
+def describe(value):
+    return f"{type(value).__name__}:{value}"
+
+
+def pair(row):
+    return f"{row.iloc[0]}/{row.iloc[1]}"
+
+
+@pure
+def counted(value, prefix=""):
+    calls.append(value)
+    return f"{prefix}{value}"
+
+
+def scaled(value, factor=1):
+    return value * factor
+
+
+@batch_of(scaled)
+def scaled_batch(values, factor=1):
+    batches.append(len(values))
+    return values * factor
+
+
+def _function(name, **args):
+    return {"function": {"name": f"{__name__}.{name}", **args}}
+
+
+@pytest.fixture(autouse=True)
+def restart(monkeypatch):
+    monkeypatch.setattr(default_functions, "id_dealer", 0)
+    calls.clear()
+    batches.clear()
+
+
+def _same(rows, columns, monkeypatch):
+    expected = row_by_row(rows, columns)
+    monkeypatch.setattr(default_functions, "id_dealer", 0)
+    assert write_table(rows, columns) == expected
+    return expected
+
+
+@pytest.mark.parametrize("rows", [NUMBERS, MIXED], ids=["numbers", "mixed"])
+def test_values_are_coerced_to_the_row_dtype(rows, monkeypatch):
+    columns = [{"id": name.upper(), "source_id": name} for name in rows[0]]
+    columns += [{"id": f"TYPE_{name.upper()}", "source_id": name, **_function("describe")} for name in rows[0]]
+    columns += [{"id": "LABEL", "source_id": "count",
+                 "function": {"name": "template_string", "string": "n-{value}"}}, {"id": "KIND", "value": "k"}]
+
+    lines = _same(rows, columns, monkeypatch)
+
+    assert lines[0].split("\t")[:2] == (["1.0", "0.5"] if rows is NUMBERS else ["a", "1.0"])
+
+
+def test_multi_column_sources_get_rows(monkeypatch):
+    columns = [{"id": "PAIR", "source_ids": ["count", "score"], **_function("pair")}]
+
+    assert _same(NUMBERS, columns, monkeypatch) == ["1.0/0.5", "2.0/nan", "3.0/2.0", "2.0/1.5"]
+
+
+def test_stateful_functions_are_called_row_by_row(monkeypatch):
+    columns = [{"id": "FIRST", "source_id": "id", "function": {"name": "increment"}},
+               {"id": "SECOND", "source_id": "id", "function": {"name": "increment", "prefix": "S"}}]
+
+    assert _same(MIXED, columns, monkeypatch)[:2] == ["00001\tS00002", "00003\tS00004"]
+
+
+def test_pure_functions_are_called_once_per_value(monkeypatch):
+    columns = [{"id": "LABEL", "source_id": "id", **_function("counted", prefix="p-")}]
+
+    _same(MIXED, columns, monkeypatch)
+    calls.clear()
+    write_table(MIXED, columns)
+
+    assert calls == ["a", "b", "c"]
+
+
+def test_batch_variants_give_per_value_results(monkeypatch):
+    columns = [{"id": "SCALED", "source_id": "score", **_function("scaled", factor=2)},
+               {"id": "COUNT", "source_id": "count"}]
+
+    assert _same(NUMBERS, columns, monkeypatch) == ["1.0\t1.0", "\t2.0", "4.0\t3.0", "3.0\t2.0"]
+    # one call for the whole column
+    assert batches == [4]
+
@@ -0,0 +1,103 @@
+import pandas as pd
+import pytest
+
+from cbio_importer.study_templates._delta import DeltaState
+from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
+
+from .conftest import column, samples_study, values
+
+# rows of about 240 KiB: an edit of the first rows is far before the end of the processed part
+ROWS = 20000
+
+
+@pytest.fixture
+def source(tmp_path, monkeypatch):
+    monkeypatch.setattr(TemporaryFilesDirectory(None), "path", str(tmp_path))
+    path = tmp_path / "source.csv"
+    path.write_text("id\tvalue\n" + "".join(f"r{index:06d}\t{index}\n" for index in range(ROWS)))
+    return path
+
+
+def _process(state: DeltaState, path):
+    state.watermark(str(path))
+    frame = pd.read_csv(path, delimiter="\t")
+    state.processed(frame.dtypes, len(frame))
+    state.save()
+
+
+def _append(path, *rows):
+    with open(path, "a") as file:
+        file.writelines(f"{row}\t{index}\n" for index, row in enumerate(rows))
+
+
+def test_appended_rows_only(source, tmp_path):
+    target = str(tmp_path / "data_clinical_samples.txt")
+    _process(DeltaState(target), source)
+
+    _append(source, "new1")
+    state = DeltaState(target)
+    rows = state.new_rows(str(source), "\t")
+    assert rows["id"].tolist() == ["new1"]
+    state.processed(rows.dtypes, len(rows))
+    state.save()
+
+    _append(source, "new2", "new3")
+    assert DeltaState(target).new_rows(str(source), "\t")["id"].tolist() == ["new2", "new3"]
+
+
+def test_edited_processed_row_reads_whole_file(source, tmp_path):
+    target = str(tmp_path / "data_clinical_samples.txt")
+    _process(DeltaState(target), source)
+
+    # same length edit of the second data row, then a new row
+    content = source.read_bytes()
+    source.write_bytes(content.replace(b"r000001\t1\n", b"x000001\t1\n", 1))
+    _append(source, "new1")
+    assert DeltaState(target).new_rows(str(source), "\t") is None
+
+
+def test_truncated_file_reads_whole_file(source, tmp_path):
+    target = str(tmp_path / "data_clinical_samples.txt")
+    _process(DeltaState(target), source)
+
+    source.write_text("id\tvalue\nr000000\t0\n")
+    assert DeltaState(target).new_rows(str(source), "\t") is None
+
+
+def _append_samples(folder, *rows):
+    with open(folder / "samples.csv", "a") as file:
+        file.writelines("\t".join(row.split()) + "\n" for row in rows)
+
+
+def test_appended_rows_continue_function_state(sources, generate, tmp_path, capsys):
+    study = samples_study([], [column("NUMBER", "sample", function={"name": "increment", "prefix": "N"}),
+                               column("ALIAS", "sample", function={"name": "anonymize", "mapper_filename": "s.csv",
+                                                                      "generator": "random_simple_id"})],
+                          delta=True)
+    generate(study, "out", force=False)
+    _append_samples(tmp_path, "P1 S9 a x 1.0", "P2 S10 b y 2.0")
+    appended = generate(study, "out", force=False)
+    assert "Delta: 2 new rows" in capsys.readouterr().out
+
+    # increment IDs go on, anonymized IDs of new values do not collide with the processed ones
+    assert values(appended, 2)[-3:] == ["N00009", "N00010", "N00011"]
+    assert len(set(values(appended, 3))) == 11
+    assert appended == generate(study, "full")
+
+
+def test_groups_aggregated_again_keep_key_order(sources, generate, tmp_path, capsys):
+    study = samples_study([{"task": "group", "by": ["kind"], "aggregate": [
+        {"id": "patient", "function": {"name": "select_first"}},
+        {"id": "sample", "function": {"name": "concat_paths"}}]}], [column("KIND", "kind")], delta=True)
+    generate(study, "out", force=False)
+    _append_samples(tmp_path, "P5 S9 a x 1.0")
+    appended = generate(study, "out", force=False)
+    assert "Delta: aggregating 1 groups again." in capsys.readouterr().out
+
+    assert values(appended, 2) == ["a", "b", "c"]
+    assert values(appended, 1)[0] == "S1,S3,S9"
+    assert appended == generate(study, "full")
+
+    # the stored keys follow the rewritten rows
+    _append_samples(tmp_path, "P6 S10 b y 1.0")
+    assert generate(study, "out", force=False) == generate(study, "full")
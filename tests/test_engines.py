@@ -0,0 +1,75 @@
+import pytest
+
+from cbio_importer.study_templates._sql import SqlQuery
+
+from .conftest import column, samples_study, values
+
+pytest.importorskip("duckdb")
+
+
+@pytest.fixture
+def engines(compare, monkeypatch):
+    """
+    Generates the study with the pandas and the duckdb engine
+    :return: function (study) -> (pandas output, duckdb output), fails unless DuckDB ran the steps
+    """
+    queries = []
+    run_query = SqlQuery.run
+
+    def counted(query, *args, **kwargs):
+        queries.append(query.sql)
+        return run_query(query, *args, **kwargs)
+
+    monkeypatch.setattr(SqlQuery, "run", counted)
+
+    def run(study):
+        outputs = compare(study, pandas={"changes": {"engine": "pandas"}}, duckdb={"changes": {"engine": "duckdb"}})
+        assert queries, "DuckDB did not run the preprocessing steps"
+        return outputs
+    return run
+
+
+@pytest.mark.parametrize("spec", [
+    {"source_id": "kind", "one_of": ["a", "b"]},
+    {"source_id": "kind", "regex": "^a"},
+    {"source_id": "score", "operator": {"arg": 2, "command": "<"}},
+    {"source_id": "score", "operator": {"arg": 2.5, "command": "!="}},
+    {"source_id": "score", "operator": {"arg": 2.5, "command": "=="}},
+])
+def test_filters_with_missing_values(sources, engines, spec):
+    pandas, duckdb = engines(samples_study([{"task": "filter", **spec}],
+                                    [column("KIND", "kind"), column("SCORE", "score", "NUMBER")]))
+
+    assert pandas == duckdb
+
+
+def test_left_join_of_unmatched_rows(sources, engines):
+    # P5 and P6 have no patient: ages turn into floats, smoker flags into objects
+    pandas, duckdb = engines(samples_study(
+        [{"task": "join", "file": "patients.csv", "left_on": "patient", "right_on": "pid", "how": "left"}],
+        [column("AGE", "age", "NUMBER"), column("SMOKER", "smoker")]))
+
+    assert pandas == duckdb
+    assert values(pandas, 2) == ["", "50.0", "50.0", "61.0", "47.0", "39.0", "39.0", "61.0", ""]
+
+
+def test_left_join_of_matched_rows(sources, engines):
+    pandas, duckdb = engines(samples_study(
+        [{"task": "filter", "source_id": "patient", "one_of": ["P1", "P2"]},
+         {"task": "join", "file": "patients.csv", "left_on": "patient", "right_on": "pid", "how": "left"}],
+        [column("AGE", "age", "NUMBER"), column("SMOKER", "smoker")]))
+
+    assert pandas == duckdb
+    assert values(pandas, 2) == ["50", "50", "61", "61"]
+
+
+@pytest.mark.parametrize("patient", [{"function": {"name": "select_first"}}, {"value": "P0"}])
+def test_group_order_with_missing_keys(sources, engines, patient):
+    pandas, duckdb = engines(samples_study(
+        [{"task": "group", "by": ["kind"], "aggregate": [{"id": "patient", **patient},
+                                                         {"id": "sample", "function": {"name": "select_first"}}]}],
+        [column("KIND", "kind")]))
+
+    assert pandas == duckdb
+    # groups are sorted by their keys, rows without a key are dropped
+    assert values(pandas, 1) == ["S1", "S2", "S0"]
@@ -0,0 +1,52 @@
+import pandas as pd
+import pytest
+
+from cbio_importer.study_templates._formats import TableChunks, read_frame
+
+pa = pytest.importorskip("pyarrow")
+pq = pytest.importorskip("pyarrow.parquet")
+feather = pytest.importorskip("pyarrow.feather")
+
+
+@pytest.fixture
+def table():
+    # nulls only in the last row group / batch: whole table types must apply to all chunks
+    return pa.table({
+        "id": [f"r{index}" for index in range(7)],
+        "count": [1, 2, 3, 4, 5, 6, None],
+        "flag": [True, False, True, True, False, True, None],
+        "kind": pa.array(list("xyxzyxx")).dictionary_encode(),
+    })
+
+
+def _write(table, path, format):
+    if format == "parquet":
+        pq.write_table(table, path, row_group_size=2)
+    elif format == "parquet-no-statistics":
+        pq.write_table(table, path, row_group_size=2, write_statistics=False)
+    elif format == "feather":
+        feather.write_feather(table, path, chunksize=2)
+    else:
+        with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_stream(sink, table.schema) as writer:
+            for batch in table.to_batches(max_chunksize=2):
+                writer.write_batch(batch)
+    return format.split("-")[0]
+
+
+@pytest.mark.parametrize("format", ["parquet", "parquet-no-statistics", "feather", "arrow"])
+@pytest.mark.parametrize("columns", [None, ["kind", "count", "id"]])
+def test_chunks_match_whole_table(table, tmp_path, format, columns):
+    path = tmp_path / "source"
+    format = _write(table, path, format)
+    whole = read_frame(str(path), format, columns)
+
+    with TableChunks(str(path), format, 3, columns) as chunks:
+        parts = list(chunks)
+
+    assert [len(part) for part in parts] == [3, 3, 1]
+    for part in parts:
+        assert list(part.columns) == list(whole.columns)
+        assert all(part[name].dtype == whole[name].dtype for name in part.columns if name != "kind")
+    joined = pd.concat(parts, ignore_index=True)
+    for name in whole.columns:
+        assert joined[name].astype(object).equals(whole[name].astype(object))
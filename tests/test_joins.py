@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cbio_importer.study_templates import _utilities
+from cbio_importer.study_templates._join import KeyIndex, lookup_join
+
+from .conftest import column, samples_study, values
+
+LEFT = pd.DataFrame({"patient": ["P1", "P2", None, "P9", "P1", np.nan], "visit": [1, 2, 1, 3, 2, 1],
+                     "score": [0.5, 1.5, 2.5, 3.5, 4.5, 5.5]})
+RIGHT = pd.DataFrame({"pid": ["P1", "P2", "P3"], "visit_id": [1, 2, 3], "age": [50, 61, 47],
+                      "stage": pd.array(["I", None, "III"], dtype="string")})
+
+
+def _merge(left, right, how, left_on, right_on):
+    return left.merge(right, how=how, left_on=left_on, right_on=right_on)
+
+
+def _lookup(left, right, how, left_on, right_on):
+    index = KeyIndex(right, right_on)
+    return lookup_join(left, right, index, how, left_on, index.positions(left, left_on))
+
+
+@pytest.mark.parametrize("how", ["inner", "left"])
+@pytest.mark.parametrize("left_on, right_on", [(["patient"], ["pid"]), (["patient", "visit"], ["pid", "visit_id"])])
+def test_lookup_gives_merge_result(how, left_on, right_on):
+    # unmatched rows of a left join turn ages into floats, as with merge
+    pd.testing.assert_frame_equal(_lookup(LEFT, RIGHT, how, left_on, right_on),
+                                  _merge(LEFT, RIGHT, how, left_on, right_on))
+
+
+@pytest.mark.parametrize("right, how, left_on", [
+    (pd.concat([RIGHT, RIGHT.iloc[:1]]), "left", ["patient"]),
+    (pd.concat([RIGHT, pd.DataFrame({"pid": [None]})]), "left", ["patient"]),
+    (RIGHT, "right", ["patient"]),
+    (RIGHT, "outer", ["patient"]),
+    (RIGHT.assign(pid=RIGHT["pid"].astype("category")), "inner", ["patient"]),
+    (RIGHT.rename(columns={"age": "score"}), "left", ["patient"]),
+])
+def test_lookup_leaves_other_joins_to_merge(right, how, left_on):
+    assert _lookup(LEFT, right, how, left_on, ["pid"]) is None
+
+
+@pytest.mark.parametrize("how", ["inner", "left", "right", "outer"])
+def test_expected_rows_of_repeated_keys(how):
+    left = pd.DataFrame({"key": ["a", "a", "b", None, "c"]})
+    right = pd.DataFrame({"key": ["a", "a", "b", None, "d"], "value": [1, 2, 3, 4, 5]})
+    index = KeyIndex(right, ["key"])
+
+    rows, many_to_many = index.expected_rows(index.positions(left, ["key"]), how)
+
+    assert rows == len(left.merge(right, how=how, on="key"))
+    assert many_to_many
+
+
+def test_indexed_join_gives_merge_output(sources, compare):
+    study = samples_study([{"task": "join", "file": "patients.csv", "left_on": "patient", "right_on": "pid",
+                            "how": "left"}], [column("AGE", "age", "NUMBER"), column("STAGE", "stage")])
+
+    indexed, merged = compare(study, indexed={}, merged={"patches": {(_utilities, "lookup_join"): lambda *args: None}})
+
+    assert indexed == merged
+    assert values(indexed, 3) == ["", "I", "I", "II", "I", "", "", "II", ""]
+
+
+def test_many_to_many_join_is_reported(sources, generate, tmp_path, capsys):
+    (tmp_path / "visits.csv").write_text("pid\tvisit\nP1\t1\nP1\t2\nP2\t1\n")
+    join = {"task": "join", "file": "visits.csv", "left_on": "patient", "right_on": "pid", "how": "inner"}
+
+    output = generate(samples_study([join], [column("VISIT", "visit")]), "out")
+
+    assert values(output, 1) == ["S1", "S1", "S2", "S2", "S3", "S7"]
+    assert "WARN: join of visits.csv: keys repeat on both sides (many-to-many), 9 rows become 6 rows." \
+        in capsys.readouterr().out
+    with pytest.raises(ValueError, match="the join would produce 6 rows, more than max_rows 5"):
+        generate(samples_study([{**join, "max_rows": 5}], [column("VISIT", "visit")]), "limited")
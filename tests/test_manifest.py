@@ -0,0 +1,19 @@
+import pytest
+
+from .conftest import column, samples_study
+
+
+@pytest.mark.parametrize("changes, options", [
+    ({"engine": "duckdb"}, {}),
+    ({}, {"chunk_size": 2}),
+])
+def test_engine_and_chunk_size_generate_again(sources, generate, capsys, changes, options):
+    if changes.get("engine") == "duckdb":
+        pytest.importorskip("duckdb")
+    study = samples_study([], [column("KIND", "kind")])
+    generate(study, "out", force=False)
+    generate(study, "out", force=False)
+    assert "Samples unchanged - skipping." in capsys.readouterr().out
+
+    generate({**study, **changes}, "out", force=False, **options)
+    assert "Samples generated." in capsys.readouterr().out
@@ -0,0 +1,111 @@
+import pytest
+
+from cbio_importer.study_templates import _utilities
+from cbio_importer.study_templates._plan import Step, plan_steps
+
+from .conftest import column, samples_study, values
+
+PURE = {"template_string"}
+
+
+def _pure(name):
+    return name in PURE
+
+
+def _planned(compare, study):
+    """
+    :return: (output of planned steps, output of the steps in the configured order)
+    """
+    return compare(study, planned={}, unplanned={"patches": {(_utilities, "plan_steps"): lambda steps, *args: steps}})
+
+
+def _join(file, left_on, right_on, how="inner"):
+    return {"task": "join", "file": file, "left_on": left_on, "right_on": right_on, "how": how}
+
+
+def test_filter_moves_ahead_of_inner_join():
+    join = Step("join", [_join("patients.csv", "patient", "pid")], [0])
+    kind = Step("filter", [{"source_id": "kind", "one_of": ["a"]}], [1])
+    stage = Step("filter", [{"source_id": "stage", "one_of": ["I"]}], [2])
+
+    steps = plan_steps([join, kind, stage], ["patient"], _pure, lambda spec: ["pid", "age", "stage"])
+
+    # the filter of a joined column stays after the join
+    assert [step.name for step in steps] == ["preprocess[1] filter", "preprocess[0] join", "preprocess[2] filter"]
+
+
+def test_filters_before_inner_join_keep_results(sources, compare):
+    planned, unplanned = _planned(compare, samples_study(
+        [_join("patients.csv", "patient", "pid"),
+         {"task": "filter", "source_id": "kind", "one_of": ["a", "b"]},
+         {"task": "filter", "source_id": "age", "operator": {"arg": 60, "command": "<"}}],
+        [column("AGE", "age", "NUMBER")]))
+
+    assert planned == unplanned
+    assert values(planned, 1) == ["S1", "S2", "S5", "S6"]
+
+
+def test_impure_filter_stays_after_join():
+    join = Step("join", [_join("patients.csv", "patient", "pid")], [0])
+    unique = Step("filter", [{"source_id": "patient", "function": {"name": "is_unique", "context": "p"}}], [1])
+
+    steps = plan_steps([join, unique], ["patient"], _pure, lambda spec: ["pid", "age", "stage"])
+
+    assert [step.task for step in steps] == ["join", "filter"]
+
+
+def test_impure_filter_keeps_results(sources, compare):
+    # is_unique sees only the joined rows: kind c of S0 is not seen
+    planned, unplanned = _planned(compare, samples_study(
+        [_join("patients.csv", "patient", "pid"),
+         {"task": "filter", "source_id": "kind", "function": {"name": "is_unique", "context": "kinds"}}],
+        []))
+
+    assert planned == unplanned
+    assert values(planned, 1) == ["S1", "S2", "S4", "S7"]
+
+
+def test_unused_create_and_left_join_are_optional():
+    create = Step("create", [{"new_column": "label", "source_id": "kind",
+                              "function": {"name": "template_string", "string": "k-{value}"}}], [0])
+    join = Step("join", [_join("sites.csv", "site", "site_id", how="left")], [1])
+    used = Step("create", [{"new_column": "tag", "source_id": "kind",
+                            "function": {"name": "template_string", "string": "t-{value}"}}], [2])
+    impure = Step("create", [{"new_column": "number", "source_id": "kind", "function": {"name": "increment"}}], [3])
+
+    plan_steps([create, join, used, impure], ["patient", "tag"], _pure, lambda spec: ["site_id", "region"])
+
+    assert (create.optional, join.optional, used.optional, impure.optional) == (True, True, False, False)
+
+
+def test_optional_steps_keep_results(sources, compare):
+    planned, unplanned = _planned(compare, samples_study(
+        [{"task": "create", "new_column": "label", "source_id": "kind",
+          "function": {"name": "template_string", "string": "k-{value}"}},
+         _join("sites.csv", "site", "site_id", how="left"),
+         {"task": "create", "new_column": "tag", "source_id": "kind",
+          "function": {"name": "template_string", "string": "t-{value}"}}],
+        [column("TAG", "tag")]))
+
+    assert planned == unplanned
+    assert values(planned, 2) == ["t-c", "t-a", "t-b", "t-a", "t-c", "t-b", "t-b", "", ""]
+
+
+def test_filter_stays_after_left_join():
+    join = Step("join", [_join("patients.csv", "patient", "pid", how="left")], [0])
+    kind = Step("filter", [{"source_id": "kind", "one_of": ["a"]}], [1])
+
+    steps = plan_steps([join, kind], ["patient", "age"], _pure, lambda spec: ["pid", "age", "stage"])
+
+    assert [step.task for step in steps] == ["join", "filter"]
+
+
+def test_left_join_keeps_float_values(sources, compare):
+    # P5 and P6 have no match: ages are floats, also in the rows of matched patients left after the filter
+    planned, unplanned = _planned(compare, samples_study(
+        [_join("patients.csv", "patient", "pid", how="left"),
+         {"task": "filter", "source_id": "kind", "one_of": ["a"]}],
+        [column("AGE", "age", "NUMBER")]))
+
+    assert planned == unplanned
+    assert values(planned, 2) == ["50.0", "61.0"]
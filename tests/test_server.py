@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+import http.client
+from http.server import HTTPServer
+
+import pytest
+
+from cbio_importer._server import StudyHandler, TOKEN_HEADER, _generate
+
+TOKEN = "secret"
+
+
+@pytest.fixture
+def server():
+    runs = []
+    server = HTTPServer(("127.0.0.1", 0), StudyHandler)
+    server.runs = 0
+    server.started = time.time()
+    server.token = TOKEN
+    server.generate = _generate(server, json.loads, lambda study, force: runs.append(study) or ("out", []))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server, runs
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def _post(server, headers, body='{"study_id": "s"}'):
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port)
+    connection.request("POST", "/generate", body=body, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def test_generates_with_token(server):
+    server, runs = server
+    assert _post(server, {TOKEN_HEADER: TOKEN, "Content-Type": "application/json"}) == 200
+    assert runs == [{"study_id": "s"}]
+
+
+@pytest.mark.parametrize("headers, status", [
+    ({"Content-Type": "application/json"}, 401),
+    ({TOKEN_HEADER: "guess", "Content-Type": "application/json"}, 401),
+    # content types web pages post without a preflight request
+    ({TOKEN_HEADER: TOKEN, "Content-Type": "text/plain"}, 415),
+    ({TOKEN_HEADER: TOKEN, "Content-Type": "application/x-www-form-urlencoded"}, 415),
+    ({TOKEN_HEADER: TOKEN, "Content-Type": "application/json", "Host": "attacker.example:8765"}, 403),
+    ({TOKEN_HEADER: TOKEN, "Content-Type": "application/json", "Origin": "http://attacker.example"}, 403),
+])
+def test_rejects_requests(server, headers, status):
+    server, runs = server
+    assert _post(server, headers) == status
+    assert runs == []
@@ -0,0 +1,45 @@
+import pytest
+
+from cbio_importer.study_templates._singletons import TemporaryFilesDirectory
+from cbio_importer.study_templates.default_functions import flush_anonymization_data
+
+from .conftest import column, samples_study, write_table
+
+
+def test_report_lists_all_violations():
+    rows = [["id", "type"], ["a", "X"], [None, "A"], ["c", "Y"]]
+    columns = [{"id": "ID", "source_id": "id"}, {"id": "TYPE", "source_id": "type"}, {"id": "KIND", "value": "C"}]
+
+    with pytest.raises(ValueError) as error:
+        write_table(rows, columns, required=["ID"], allowed=[("TYPE", ["A", "B"]), ("KIND", ["A", "B"])])
+
+    message = str(error.value)
+    assert "TYPE: 2 rows with values not allowed (allowed: A, B) - values 'X' (1), 'Y' (1) - rows 0, 2" in message
+    # constants are reported as values of all rows
+    assert "KIND: 3 rows with values not allowed (allowed: A, B) - values 'C' (3)" in message
+    assert "ID: 1 rows with empty values" in message
+
+
+def test_functions_are_not_called_once_a_check_failed(tmp_path, monkeypatch):
+    monkeypatch.setattr(TemporaryFilesDirectory(None), "path", str(tmp_path))
+    rows = [["id", "type"], ["a", "X"], ["b", "A"]]
+    columns = [{"id": "ID", "source_id": "id", "function": {"name": "anonymize", "mapper_filename": "ids.csv"}},
+               {"id": "TYPE", "source_id": "type"}]
+
+    with pytest.raises(ValueError, match="TYPE: 1 rows with values not allowed"):
+        write_table(rows, columns, required=["ID"], allowed=[("TYPE", ["A"])])
+
+    # no IDs were generated for the rows that are not written, none are left to be stored later
+    flush_anonymization_data()
+    assert not (tmp_path / "ids.csv").exists()
+
+
+def test_failed_stream_leaves_no_partial_output(sources, generate, tmp_path):
+    # the kind of the last sample is missing: the chunks before it are valid
+    study = samples_study([], [])
+    study["samples"]["columns"][0] = column("PATIENT_ID", "kind")
+
+    with pytest.raises(ValueError, match="PATIENT_ID: 2 rows with empty values"):
+        generate(study, "out", chunk_size=2)
+
+    assert not (tmp_path / "out" / "data_clinical_samples.txt").exists()